@@ -13,12 +13,14 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
-from chat import routing
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "SocNet.settings")
+# sets up Django, the consumers import models
 django_asgi_app = get_asgi_application()
 
+from chat import routing
+
 application = ProtocolTypeRouter({
-    'http': get_asgi_application(),
+    'http': django_asgi_app,
     'websocket': AllowedHostsOriginValidator(AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns)))
 })
@@ -0,0 +1,405 @@
+"""Cache backend keeping hot keys in process memory in front of a shared cache.
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'SocNet.cache.TieredCache',
+            'LOCATION': 'shared',
+            'OPTIONS': {'MAX_ENTRIES': 10000, 'LOCAL_TIMEOUT': 5, 'SYNC_INTERVAL': 1},
+        },
+        'shared': {'BACKEND': 'SocNet.cache.DatabaseCache', 'LOCATION': 'cache_table'},
+    }
+
+LOCATION names the shared (L2) cache. Reads are answered from a per-process
+LRU (L1) when possible and fall through to L2 otherwise, writes go to both.
+Deletes, add, incr, decr and pop are decided by L2, so CacheTicketStore stays
+single-use across processes. ``pop()`` needs an L2 that has it, like the
+DatabaseCache below.
+
+Values are written to L2 stamped with their expiry, so an L1 copy never
+outlives the L2 entry, and is kept in L1 for at most LOCAL_TIMEOUT seconds.
+Misses are kept in L1 as well, so a hot key that is usually absent, like the
+read pin of SocNet.replicas, does not cost an L2 read either.
+
+A write, delete, incr or touch costs the L2 write only. The keys it changed
+are collected per process and journaled in L2 as one entry under a sequence
+number, at most once every SYNC_INTERVAL seconds, on its next cache call or on
+``flush()``. Each process replays the journal every SYNC_INTERVAL seconds, one
+L2 read when nothing changed, and drops those keys from its L1. So a changed
+key is served by another process for about two SYNC_INTERVALs while the
+writer is busy, and never past LOCAL_TIMEOUT. When a process fell too far
+behind or an entry is missing, it drops its whole L1 instead. ``clear()`` and
+``invalidate_local()`` replace the generation stamp in L2, which drops every
+L1 as well.
+
+The journal lives in L2, so L2 has to hold it: with DatabaseCache keep
+MAX_ENTRIES well above the entries written in JOURNAL_TIMEOUT seconds, its
+cull deletes in key order whatever the key.
+"""
+import base64
+import pickle
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from django.core.cache import caches
+from django.core.cache.backends import db
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.db import connections, models, router
+from django.utils.timezone import now as tz_now
+
+Entry = namedtuple('Entry', ['generation', 'value', 'expires'])
+
+# what TieredCache stores in L2, `expires` as returned by get_backend_timeout()
+Stamped = namedtuple('Stamped', ['expires', 'value'])
+
+# L1 value of a key L2 does not have
+MISSING = object()
+
+GENERATION_KEY = 'tiered-cache:generation'
+SEQUENCE_KEY = 'tiered-cache:sequence'
+CHANGE_KEY = 'tiered-cache:change:{}'
+
+# seconds journal entries are kept, a process that synced longer ago drops its L1,
+# longer than any LOCAL_TIMEOUT so the entries outlive the L1 copies they invalidate
+JOURNAL_TIMEOUT = 60
+# journal entries replayed in one sync before dropping the whole L1 is cheaper
+MAX_REPLAY = 1000
+
+
+class LocalStore:
+    """The L1 of one TieredCache LOCATION, shared by the threads of a process."""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.generation = None
+        self.synced_at = None
+        # last journal entry replayed, and the entries written by this process
+        self.sequence = 0
+        self.own = set()
+        # keys changed by this process since it last journaled
+        self.changed = set()
+        self.published_at = None
+        self.hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+
+
+_stores = {}
+_stores_lock = Lock()
+
+
+def get_store(location):
+    with _stores_lock:
+        return _stores.setdefault(location, LocalStore())
+
+
+class TieredCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.l2_alias = location
+        self.local_timeout = options.get('LOCAL_TIMEOUT', 5)
+        self.sync_interval = options.get('SYNC_INTERVAL', 1)
+        self.store = get_store(location)
+
+    @property
+    def l2(self):
+        return caches[self.l2_alias]
+
+    def sync(self):
+        """Replays the journal and the generation if SYNC_INTERVAL passed since the last look."""
+        store = self.store
+        now = time.monotonic()
+        with store.lock:
+            if store.synced_at is not None and now - store.synced_at < self.sync_interval:
+                return store.generation
+            # the other threads keep using L1 meanwhile
+            store.synced_at = now
+            last, own = store.sequence, set(store.own)
+        stamps = self.l2.get_many([GENERATION_KEY, SEQUENCE_KEY])
+        generation = stamps.get(GENERATION_KEY)
+        if generation is None:
+            self.l2.add(GENERATION_KEY, 0, None)
+            generation = self.l2.get(GENERATION_KEY, 0)
+        sequence = stamps.get(SEQUENCE_KEY, 0)
+        changed, complete = [], last <= sequence <= last + MAX_REPLAY
+        if complete and sequence > last:
+            pending = [number for number in range(last + 1, sequence + 1) if number not in own]
+            changes = self.l2.get_many([CHANGE_KEY.format(number) for number in pending]) if pending else {}
+            complete = len(changes) == len(pending)
+            changed = [key for keys in changes.values() for key in keys]
+        with store.lock:
+            if generation != store.generation or not complete:
+                store.entries.clear()
+                store.generation = generation
+            for key in changed:
+                store.entries.pop(key, None)
+            store.sequence = sequence
+            store.own = {number for number in store.own if number > sequence}
+        self.flush()
+        return generation
+
+    def publish(self, *keys):
+        """Queues a change of the L1 `keys` for the other processes, journaled
+        right away unless this process did so within SYNC_INTERVAL seconds."""
+        store = self.store
+        with store.lock:
+            store.changed.update(keys)
+            published_at = store.published_at
+        if published_at is None or time.monotonic() - published_at >= self.sync_interval:
+            self.flush()
+
+    def flush(self):
+        """Journals the queued changes as one entry."""
+        store = self.store
+        with store.lock:
+            keys, store.changed = store.changed, set()
+            if keys:
+                store.published_at = time.monotonic()
+        if not keys:
+            return
+        for _ in range(3):
+            try:
+                sequence = self.l2.incr(SEQUENCE_KEY)
+            except ValueError:
+                self.l2.add(SEQUENCE_KEY, 0, None)
+                continue
+            # incr of some backends is not atomic, whoever adds the entry owns the number
+            if self.l2.add(CHANGE_KEY.format(sequence), list(keys), JOURNAL_TIMEOUT):
+                with store.lock:
+                    store.own.add(sequence)
+                return
+        self.invalidate_local()
+
+    def invalidate_local(self):
+        """Makes every process drop its L1 within SYNC_INTERVAL seconds."""
+        # a fresh stamp rather than a counter, clear() may have removed the old one
+        self.l2.set(GENERATION_KEY, time.time_ns(), None)
+        with self.store.lock:
+            self.store.entries.clear()
+            self.store.changed.clear()
+            self.store.synced_at = None
+
+    def local_expiry(self, backend_expires):
+        expires = time.time() + self.local_timeout
+        return expires if backend_expires is None else min(expires, backend_expires)
+
+    def stamp(self, value, timeout):
+        return Stamped(self.l2.get_backend_timeout(timeout), value)
+
+    def unstamp(self, value):
+        """The value and how long L1 may keep it, values written to L2 by others are not stamped."""
+        if isinstance(value, Stamped):
+            return value.value, self.local_expiry(value.expires)
+        return value, self.local_expiry(None)
+
+    def local_get(self, key, generation):
+        store = self.store
+        with store.lock:
+            entry = store.entries.get(key)
+            if entry is None:
+                return None
+            if entry.generation != generation or entry.expires <= time.time():
+                del store.entries[key]
+                return None
+            store.entries.move_to_end(key)
+            store.hits += 1
+            return entry
+
+    def local_set(self, key, value, expires, generation):
+        store = self.store
+        with store.lock:
+            store.entries[key] = Entry(generation, value, expires)
+            store.entries.move_to_end(key)
+            while len(store.entries) > self._max_entries:
+                store.entries.popitem(last=False)
+
+    def local_delete(self, *keys):
+        with self.store.lock:
+            for key in keys:
+                self.store.entries.pop(key, None)
+
+    def count(self, l2_hits=0, misses=0):
+        with self.store.lock:
+            self.store.l2_hits += l2_hits
+            self.store.misses += misses
+
+    def get(self, key, default=None, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        generation = self.sync()
+        entry = self.local_get(local_key, generation)
+        if entry is not None:
+            return default if entry.value is MISSING else entry.value
+        # the sentinel tells a miss from a stored None
+        value = self.l2.get(key, MISSING, version)
+        if value is MISSING:
+            self.count(misses=1)
+            self.local_set(local_key, MISSING, self.local_expiry(None), generation)
+            return default
+        self.count(l2_hits=1)
+        value, expires = self.unstamp(value)
+        self.local_set(local_key, value, expires, generation)
+        return value
+
+    def get_many(self, keys, version=None):
+        generation = self.sync()
+        found, remote = {}, {}
+        for key in keys:
+            local_key = self.make_and_validate_key(key, version)
+            entry = self.local_get(local_key, generation)
+            if entry is None:
+                remote[key] = local_key
+            elif entry.value is not MISSING:
+                found[key] = entry.value
+        if remote:
+            fetched = self.l2.get_many(list(remote), version)
+            self.count(l2_hits=len(fetched), misses=len(remote) - len(fetched))
+            for key, local_key in remote.items():
+                if key not in fetched:
+                    self.local_set(local_key, MISSING, self.local_expiry(None), generation)
+                    continue
+                value, expires = self.unstamp(fetched[key])
+                self.local_set(local_key, value, expires, generation)
+                found[key] = value
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        generation = self.sync()
+        stamped = self.stamp(value, timeout)
+        self.l2.set(key, stamped, timeout, version)
+        self.local_set(local_key, value, self.local_expiry(stamped.expires), generation)
+        self.publish(local_key)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        local_keys = {key: self.make_and_validate_key(key, version) for key in data}
+        generation = self.sync()
+        stamped = {key: self.stamp(value, timeout) for key, value in data.items()}
+        failed = self.l2.set_many(stamped, timeout, version)
+        for key, value in data.items():
+            if key not in failed:
+                self.local_set(local_keys[key], value, self.local_expiry(stamped[key].expires), generation)
+        self.publish(*local_keys.values())
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        generation = self.sync()
+        stamped = self.stamp(value, timeout)
+        added = self.l2.add(key, stamped, timeout, version)
+        if added:
+            self.local_set(local_key, value, self.local_expiry(stamped.expires), generation)
+            self.publish(local_key)
+        else:
+            self.local_delete(local_key)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        self.local_delete(local_key)
+        value = self.l2.get(key, version=version)
+        if isinstance(value, Stamped):
+            # the stamp has to follow the new expiry
+            touched = self.l2.set(key, self.stamp(value.value, timeout), timeout, version) is not False
+        else:
+            touched = self.l2.touch(key, timeout, version)
+        if touched:
+            self.publish(local_key)
+        return touched
+
+    def delete(self, key, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        self.local_delete(local_key)
+        deleted = self.l2.delete(key, version)
+        if deleted:
+            self.publish(local_key)
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        local_keys = [self.make_and_validate_key(key, version) for key in keys]
+        self.local_delete(*local_keys)
+        self.l2.delete_many(keys, version)
+        self.publish(*local_keys)
+
+    def pop(self, key, default=None, version=None):
+        """Removes `key` and returns its value, `default` if L2 did not have it."""
+        local_key = self.make_and_validate_key(key, version)
+        self.local_delete(local_key)
+        value = self.l2.pop(key, MISSING, version)
+        if value is MISSING:
+            return default
+        self.publish(local_key)
+        return value.value if isinstance(value, Stamped) else value
+
+    def has_key(self, key, version=None):
+        local_key = self.make_and_validate_key(key, version)
+        entry = self.local_get(local_key, self.sync())
+        if entry is not None:
+            return entry.value is not MISSING
+        return self.l2.has_key(key, version)
+
+    def incr(self, key, delta=1, version=None):
+        """decr() comes through here as well."""
+        local_key = self.make_and_validate_key(key, version)
+        self.local_delete(local_key)
+        value = self.l2.get(key, version=version)
+        if isinstance(value, Stamped):
+            # read and write like BaseCache.incr, keeping the expiry
+            if value.expires is not None and value.expires <= time.time():
+                raise ValueError("Key '%s' not found." % key)
+            result = value.value + delta
+            timeout = None if value.expires is None else value.expires - time.time()
+            self.l2.set(key, Stamped(value.expires, result), timeout, version)
+        else:
+            result = self.l2.incr(key, delta, version)
+        self.publish(local_key)
+        return result
+
+    def clear(self):
+        self.l2.clear()
+        self.invalidate_local()
+
+    def close(self, **kwargs):
+        self.l2.close(**kwargs)
+
+    def stats(self):
+        store = self.store
+        with store.lock:
+            return {
+                'hits': store.hits,
+                'l2_hits': store.l2_hits,
+                'misses': store.misses,
+                'entries': len(store.entries),
+            }
+
+    def reset_stats(self):
+        with self.store.lock:
+            self.store.hits = self.store.l2_hits = self.store.misses = 0
+
+
+class DatabaseCache(db.DatabaseCache):
+    """Django's DatabaseCache with ``pop()``, one DELETE ... RETURNING, so
+    of two callers popping the same key only one gets the value. Needs a
+    database with RETURNING on DELETE: SQLite 3.35+, PostgreSQL, MariaDB 10.5+."""
+
+    def pop(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        connection = connections[router.db_for_write(self.cache_model_class)]
+        quote_name = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM %s WHERE %s = %%s RETURNING %s, %s' % (
+                    quote_name(self._table), quote_name('cache_key'), quote_name('value'), quote_name('expires')),
+                [key],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return default
+        value, expires = row
+        expression = models.Expression(output_field=models.DateTimeField())
+        for converter in connection.ops.get_db_converters(expression) + expression.get_db_converters(connection):
+            expires = converter(expires, expression, connection)
+        if expires < tz_now():
+            return default
+        return pickle.loads(base64.b64decode(connection.ops.process_clob(value).encode()))
@@ -0,0 +1,140 @@
+"""Resized and re-encoded variants of uploaded images.
+
+Variants are written next to the original, e.g. ``posts_pics/cat.jpg`` gets
+``posts_pics/variants/cat.jpg.65f3a1b2.thumbnail.webp``. Their names depend on
+the original name, extension included, and its modification time, so
+``cat.png`` or a re-upload of ``cat.jpg`` never get the variants of another
+file. A process pool renders them after the upload is committed, until then
+serializers link the original.
+"""
+import logging
+import multiprocessing
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from django.conf import settings
+from django.db import transaction
+from rest_framework import serializers
+
+logger = logging.getLogger(__name__)
+
+VARIANTS = {
+    'thumbnail': (150, 150),
+    'feed': (640, 640),
+    'full': (1600, 1600),
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+
+def image_version(mtime):
+    """Version of an image in the names of its variants, from its modification time in seconds."""
+    return f'{int(mtime):x}'
+
+
+def variant_name(name, version, variant, fmt):
+    directory, filename = os.path.split(name)
+    return os.path.join(directory, 'variants', f'{filename}.{version}.{variant}.{fmt}').replace(os.sep, '/')
+
+
+def last_variant_name(name, version):
+    """Rendered last, the other variants exist once it does."""
+    return variant_name(name, version, list(VARIANTS)[-1], list(FORMATS)[-1])
+
+
+def stored_version(field_file):
+    """Version of a stored image, None if it is missing."""
+    try:
+        return image_version(field_file.storage.get_modified_time(field_file.name).timestamp())
+    except (OSError, NotImplementedError):
+        return None
+
+
+def render_variants(media_root, name):
+    """Renders every missing variant of the image `name` and removes those of
+    its earlier versions. Runs in a worker process."""
+    from PIL import Image, ImageOps
+
+    path = os.path.join(media_root, name)
+    version = image_version(os.path.getmtime(path))
+    with Image.open(path) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB')
+    current = {os.path.join(media_root, variant_name(name, version, variant, fmt))
+               for variant in VARIANTS for fmt in FORMATS}
+    prefix = os.path.join(media_root, os.path.dirname(name), 'variants', os.path.basename(name) + '.')
+    for old in set(glob.glob(glob.escape(prefix) + '*.*.*')) - current:
+        _, variant, fmt = old[len(prefix):].split('.', 2)
+        if variant in VARIANTS and fmt in FORMATS:
+            os.remove(old)
+    for variant, size in VARIANTS.items():
+        resized = None
+        for fmt, (pil_format, options) in FORMATS.items():
+            path = os.path.join(media_root, variant_name(name, version, variant, fmt))
+            if os.path.exists(path):
+                continue
+            if resized is None:
+                resized = image.copy()
+                resized.thumbnail(size, Image.LANCZOS)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            resized.save(path + '.tmp', pil_format, **options)
+            os.replace(path + '.tmp', path)
+
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=getattr(settings, 'IMAGE_VARIANTS_WORKERS', 2),
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _executor
+
+
+def _log_failure(name, future):
+    if future.exception() is not None:
+        logger.error('Rendering variants of %s failed', name, exc_info=future.exception())
+
+
+def _submit(name):
+    future = get_executor().submit(render_variants, str(settings.MEDIA_ROOT), name)
+    future.add_done_callback(partial(_log_failure, name))
+
+
+def schedule_variants(field_file):
+    """Queues the variants of an image field for rendering once the current
+    transaction commits. Does nothing if they already exist."""
+    if not field_file or not hasattr(field_file.storage, 'path'):
+        return
+    version = stored_version(field_file)
+    if version is None or field_file.storage.exists(last_variant_name(field_file.name, version)):
+        return
+    transaction.on_commit(partial(_submit, field_file.name))
+
+
+class ImageVariantsField(serializers.Field):
+    """Read-only {variant: {format: url}} of an image field, the URL of the
+    original until its variants are rendered."""
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        request = self.context.get('request')
+        version = stored_version(value)
+        rendered = version is not None and value.storage.exists(last_variant_name(value.name, version))
+        urls = {}
+        for variant in VARIANTS:
+            urls[variant] = {}
+            for fmt in FORMATS:
+                url = value.storage.url(variant_name(value.name, version, variant, fmt) if rendered else value.name)
+                urls[variant][fmt] = request.build_absolute_uri(url) if request is not None else url
+        return urls
@@ -0,0 +1,161 @@
+"""Read/write splitting over the databases of READ_REPLICAS['ALIASES'].
+
+Views using ReplicaReadMixin run the reads of their GET, HEAD and OPTIONS
+requests on a replica, through ReplicaRouter, for the models of
+READ_REPLICAS['APPS']. Everything else, writes, other views, the cache table
+and token blacklist, stays on the primary.
+
+* Read-your-writes: a successful write request, or a chat message sent over
+  a websocket, pins the user to the primary for PIN_SECONDS. The pin is kept
+  in the shared cache, so it holds for every worker. TieredCache keeps the
+  miss of an unpinned user in process memory, so checking costs no query.
+  A pin is journaled right away and seen by the other workers within their
+  SYNC_INTERVAL.
+* Lag: the primary stamps ReplicaHeartbeat (``manage.py sync_replicas``) and
+  a replica whose copy of the stamp is older than MAX_LAG seconds, or that
+  fails to answer, is skipped until the next check, CHECK_INTERVAL seconds
+  later. With no replica left reads go to the primary.
+* A safe request that fails with a database error on a replica is run once
+  more on the primary.
+
+Locally a replica is just another SQLite file, kept in sync by
+``manage.py sync_replicas --interval 2``, see SOCNET_DB_REPLICAS in settings.
+"""
+import random
+import time
+from contextvars import ContextVar
+from threading import Lock
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError
+from django.utils import timezone
+
+_reading_from = ContextVar('reading_from', default=None)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReplicaSet:
+    def __init__(self, aliases=(), apps=(), pin_seconds=5, max_lag=10, check_interval=1):
+        self.aliases = list(aliases)
+        self.apps = set(apps)
+        self.pin_seconds = pin_seconds
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lock = Lock()
+        # alias -> (checked at, healthy)
+        self.health = {}
+
+    def lag(self, alias):
+        """Seconds the replica is behind, None if it has no heartbeat."""
+        from account.models import ReplicaHeartbeat
+
+        beat = ReplicaHeartbeat.objects.using(alias).values_list('beat', flat=True).first()
+        if beat is None:
+            return None
+        return max((timezone.now() - beat).total_seconds(), 0)
+
+    def healthy(self, alias):
+        now = time.monotonic()
+        with self.lock:
+            checked = self.health.get(alias)
+        if checked is not None and now - checked[0] < self.check_interval:
+            return checked[1]
+        try:
+            lag = self.lag(alias)
+        except DatabaseError:
+            lag = None
+        healthy = lag is not None and lag <= self.max_lag
+        with self.lock:
+            self.health[alias] = (now, healthy)
+        return healthy
+
+    def mark_failed(self, alias):
+        with self.lock:
+            self.health[alias] = (time.monotonic(), False)
+
+    def choose(self):
+        """A healthy replica, None for the primary."""
+        candidates = [alias for alias in self.aliases if self.healthy(alias)]
+        return random.choice(candidates) if candidates else None
+
+    def pin_key(self, user_pk):
+        return f'replicas:pinned:{user_pk}'
+
+    def pin(self, user_pk):
+        if not self.aliases:
+            return
+        cache.set(self.pin_key(user_pk), True, self.pin_seconds)
+        # the other workers have to see it before the user's next read, not SYNC_INTERVAL later
+        if hasattr(cache, 'flush'):
+            cache.flush()
+
+    def is_pinned(self, user_pk):
+        return cache.get(self.pin_key(user_pk), False)
+
+
+_config = getattr(settings, 'READ_REPLICAS', {})
+replicas = ReplicaSet(
+    aliases=_config.get('ALIASES', ()),
+    apps=_config.get('APPS', ()),
+    pin_seconds=_config.get('PIN_SECONDS', 5),
+    max_lag=_config.get('MAX_LAG', 10),
+    check_interval=_config.get('CHECK_INTERVAL', 1),
+)
+
+
+def stamp_heartbeat():
+    from account.models import ReplicaHeartbeat
+
+    ReplicaHeartbeat.objects.using(DEFAULT_DB_ALIAS).update_or_create(pk=1, defaults={'beat': timezone.now()})
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = _reading_from.get()
+        if alias is not None and model._meta.app_label in replicas.apps:
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replicas.aliases}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaReadMixin:
+    """Reads of safe requests go to a replica unless the user wrote recently,
+    successful writes pin the user to the primary."""
+
+    def dispatch(self, request, *args, **kwargs):
+        token = _reading_from.set(None)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            _reading_from.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and replicas.aliases and not replicas.is_pinned(request.user.pk):
+            _reading_from.set(replicas.choose())
+
+    def handle_exception(self, exc):
+        alias = _reading_from.get()
+        if alias is None or not isinstance(exc, DatabaseError):
+            return super().handle_exception(exc)
+        replicas.mark_failed(alias)
+        _reading_from.set(None)
+        handler = getattr(self, self.request.method.lower(), self.http_method_not_allowed)
+        try:
+            return handler(self.request, *self.args, **self.kwargs)
+        except Exception as retry_exc:
+            return super().handle_exception(retry_exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if request.method not in SAFE_METHODS and response.status_code < 400 and request.user.is_authenticated:
+            replicas.pin(request.user.pk)
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -40,13 +40,14 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'account.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     "PAGE_SIZE": 10,
 }
 
 MIDDLEWARE = [
+    "SocNet.timing.ServerTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -91,6 +92,49 @@ DATABASES = {
     }
 }
 
+# production profile of the SQLite database, enabled with SOCNET_DB_PROFILE=production:
+# WAL so readers and the writer do not block each other, pragmas applied to every
+# connection by SocNet/sqlite/base.py, and connections handed back to a pool at the
+# end of each request (CONN_MAX_AGE would keep one per request thread under ASGI)
+SQLITE_PRODUCTION_PROFILE = {
+    "ENGINE": "SocNet.sqlite",
+    "OPTIONS": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 5000,
+            "mmap_size": 268435456,
+            "cache_size": -65536,
+            "temp_store": "MEMORY",
+        },
+        "transaction_mode": "IMMEDIATE",
+        "pool_size": 8,
+    },
+}
+
+if os.environ.get("SOCNET_DB_PROFILE") == "production":
+    DATABASES["default"].update(SQLITE_PRODUCTION_PROFILE)
+
+# read replicas for the safe requests of the profile, post and message endpoints, see
+# SocNet/replicas.py. Locally each is a copy of the primary, e.g.
+# SOCNET_DB_REPLICAS=replica1.sqlite3,replica2.sqlite3, refreshed by `manage.py sync_replicas --interval 2`
+READ_REPLICAS = {
+    "ALIASES": [],
+    "APPS": ["account", "posts", "chat"],
+    # seconds a user reads from the primary after a write
+    "PIN_SECONDS": 5,
+    # replicas further behind are skipped
+    "MAX_LAG": 10,
+    "CHECK_INTERVAL": 1,
+}
+
+for index, path in enumerate(filter(None, os.environ.get("SOCNET_DB_REPLICAS", "").split(","))):
+    alias = f"replica{index + 1}"
+    DATABASES[alias] = dict(DATABASES["default"], NAME=BASE_DIR / path, TEST={"MIRROR": "default"})
+    READ_REPLICAS["ALIASES"].append(alias)
+
+DATABASE_ROUTERS = ["SocNet.replicas.ReplicaRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -104,6 +148,8 @@ AUTH_PASSWORD_VALIDATORS = [
     {"NAME": "django.contrib.auth.password_validation.NumericPasswordValidator",},
 ]
 
+# single process only, with several workers per host use chat.layers.UnixSocketChannelLayer
+# and start `manage.py run_channel_broker` next to them
 CHANNEL_LAYERS={
     'default': {
         'BACKEND': 'channels.layers.InMemoryChannelLayer'
@@ -178,15 +224,89 @@ SIMPLE_JWT = {
 CORS_ALLOW_ALL_ORIGINS = True
 
 #python manage.py createcachetable
+# hot keys are served from process memory for up to LOCAL_TIMEOUT seconds, changes made by
+# other processes reach it within SYNC_INTERVAL seconds, see SocNet/cache.py
 CACHES = {
     'default': {
-        "BACKEND": 'django.core.cache.backends.db.DatabaseCache',
+        "BACKEND": 'SocNet.cache.TieredCache',
+        "LOCATION": 'shared',
+        "OPTIONS": {
+            'MAX_ENTRIES': 10000,
+            'LOCAL_TIMEOUT': 5,
+            'SYNC_INTERVAL': 1,
+        },
+    },
+    # the cull deletes in key order, so room for the read pins and the journal
+    # of SocNet/cache.py as well, both are short-lived
+    'shared': {
+        "BACKEND": 'SocNet.cache.DatabaseCache',
         "LOCATION": 'cache_table',
-
-    }
+        "OPTIONS": {
+            'MAX_ENTRIES': 100000,
+        },
+    },
 }
 
 CORS_ALLOW_HEADERS = list(default_headers) + [
     "Ticket-Header",
 ]
 
+# authors with more followers than this are not fanned out on write,
+# their posts are pulled into the friends feed with a fan-in query instead
+FEED_FANOUT_LIMIT = 1000
+
+# write-behind batching of chat messages, e.g. {'MAX_BATCH': 100, 'MAX_DELAY': 0.05};
+# None writes every message with its own INSERT
+CHAT_MESSAGE_BUFFER = None
+
+# most messages replayed to a websocket reconnecting with since_seq
+CHAT_BACKFILL_LIMIT = 1000
+
+# typing and online state is kept in memory and broadcast at most once per INTERVAL seconds per conversation
+CHAT_PRESENCE = {
+    'INTERVAL': 0.5,
+    'TYPING_TIMEOUT': 5,
+    'HEARTBEAT_TIMEOUT': 30,
+}
+
+# latency samples kept per websocket metric, served at chat/metrics
+CHAT_METRICS = {
+    'WINDOW': 1000,
+}
+
+# single-use websocket tickets, use account.tickets.CacheTicketStore to share them between workers
+WEBSOCKET_TICKETS = {
+    'BACKEND': 'account.tickets.LocalMemoryTicketStore',
+    'OPTIONS': {
+        'TTL': 30,
+        'MAX_ENTRIES': 10000,
+    },
+}
+
+# worker processes rendering image variants, see SocNet/images.py
+IMAGE_VARIANTS_WORKERS = 2
+
+# users resolved from access tokens are kept this many seconds per process, see account/authentication.py
+JWT_IDENTITY_CACHE = {
+    'MAX_ENTRIES': 10000,
+    'TTL': 60,
+}
+
+# in-process front of the refresh token blacklist, see account/revocation.py;
+# prune the blacklist tables with `manage.py prune_token_blacklist` from cron
+TOKEN_REVOCATION_FILTER = {
+    'ERROR_RATE': 0.01,
+    'MAX_AGE': 300,
+    'RECENT_ENTRIES': 100000,
+}
+
+# seconds before the in-memory friend graph used for suggestions is rebuilt from the database
+FRIEND_GRAPH_MAX_AGE = 300
+
+# Server-Timing headers and per-endpoint percentiles (account/api/stats) for the DRF views of APPS;
+# SAMPLE_RATE is the share of requests timed, WINDOW the samples kept per endpoint
+SERVER_TIMING = {
+    'APPS': ['account', 'posts', 'chat'],
+    'SAMPLE_RATE': 1.0,
+    'WINDOW': 1000,
+}
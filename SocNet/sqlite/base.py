@@ -0,0 +1,113 @@
+"""SQLite backend with per-connection PRAGMAs, a configurable BEGIN and a connection pool.
+
+    DATABASES = {
+        'default': {
+            'ENGINE': 'SocNet.sqlite',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                'pragmas': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 5000},
+                'transaction_mode': 'IMMEDIATE',
+                'pool_size': 8,
+            },
+        }
+    }
+
+`pragmas` run on every new connection, in order.
+
+`transaction_mode` is put after the BEGIN of atomic blocks. With IMMEDIATE a
+transaction takes the write lock up front and waits for it up to
+busy_timeout. With the default DEFERRED a transaction that read first and
+then writes while another connection writes fails with "database is locked"
+at once, as waiting could deadlock.
+
+`pool_size` keeps that many idle connections per process. Django keeps a
+connection per thread, and under ASGI every request runs in a thread of its
+own, so CONN_MAX_AGE would leave a connection behind per request instead of
+reusing it. With a pool, CONN_MAX_AGE stays 0: closing at the end of a
+request hands the sqlite3 connection back, and the next request, in
+whichever thread, takes it again. Connections closed inside a transaction
+are really closed.
+
+The other OPTIONS go to sqlite3.connect() as usual.
+"""
+import re
+from threading import Lock
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class ConnectionPool:
+    def __init__(self, size):
+        self.size = size
+        self.idle = []
+        self.lock = Lock()
+
+    def get(self):
+        with self.lock:
+            return self.idle.pop() if self.idle else None
+
+    def put(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return True
+        return False
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def get_pool(name, size):
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ConnectionPool(size)
+        return _pools[name]
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    pool = None
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.pragmas = params.pop('pragmas', {})
+        self.transaction_mode = params.pop('transaction_mode', None)
+        pool_size = params.pop('pool_size', 0)
+        for name, value in self.pragmas.items():
+            if not PRAGMA_VALUE.match(name) or not PRAGMA_VALUE.match(str(value)):
+                raise ImproperlyConfigured(f'Invalid SQLite pragma {name} = {value!r}')
+        if self.transaction_mode is not None and self.transaction_mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(f'transaction_mode must be one of {", ".join(TRANSACTION_MODES)}')
+        self.pool = get_pool(str(params['database']), pool_size) if pool_size and not self.is_in_memory_db() else None
+        return params
+
+    def get_new_connection(self, conn_params):
+        if self.pool is not None:
+            conn = self.pool.get()
+            if conn is not None:
+                return conn
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _close(self):
+        if self.connection is not None and self.pool is not None and not self.connection.in_transaction:
+            if self.pool.put(self.connection):
+                return
+        super()._close()
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute(f'BEGIN {self.transaction_mode.upper()}')
@@ -0,0 +1,27 @@
+"""Helpers shared by the test modules of the apps."""
+
+
+def count_results(response):
+    return len(response.data['results'])
+
+
+class QueryCountMixin:
+    """Every endpoint must run the same number of queries whatever the page
+    size, so each one is run against every size of SIZES. Test cases supply
+    ``populate(size)``, which creates `size` rows of what the endpoint lists."""
+
+    SIZES = (2, 8)
+
+    def populate(self, size):
+        raise NotImplementedError
+
+    def assertSameQueries(self, queries, request, results=count_results):
+        """Runs `request` after populating each size, `results` tells the
+        rows of its response, None skips that check."""
+        for size in self.SIZES:
+            with self.subTest(size=size):
+                self.populate(size)
+                with self.assertNumQueries(queries):
+                    response = request()
+                if results is not None:
+                    self.assertEqual(results(response), size)
@@ -0,0 +1,158 @@
+"""Where the time of an API request goes.
+
+ServerTimingMiddleware times a sample of the requests answered by the DRF
+views of SERVER_TIMING['APPS']: the SQL queries (count and time, through a
+database execute wrapper), the serializers (serialization and validation of
+serializers using TimedSerializerMixin, lazy loads they trigger included) and
+the whole request. Each timed response gets a header like
+
+    Server-Timing: sql;dur=4.1;desc="6 queries", serializer;dur=1.3, total;dur=9.8
+
+and the numbers go into a window of the last WINDOW samples per endpoint,
+summarized by ``endpoint_stats.summary()``.
+"""
+import random
+import time
+from collections import deque
+from contextlib import ExitStack
+from contextvars import ContextVar
+from threading import Lock
+from django.conf import settings
+from django.db import connections
+
+METRICS = ('total', 'sql', 'queries', 'serializer')
+
+_current = ContextVar('request_timing', default=None)
+
+
+class RequestTiming:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql = 0.0
+        self.serializer = 0.0
+        # nested serializers are counted in the outermost one only
+        self.depth = 0
+
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql += time.perf_counter() - started
+            self.queries += 1
+
+    def header(self, total):
+        return (f'sql;dur={self.sql * 1000:.1f};desc="{self.queries} queries", '
+                f'serializer;dur={self.serializer * 1000:.1f}, total;dur={total * 1000:.1f}')
+
+
+class TimedSerializerMixin:
+    """Adds the time spent in to_representation and run_validation to the
+    timing of the current request, if it is being timed."""
+
+    def to_representation(self, instance):
+        timing = _current.get()
+        if timing is None:
+            return super().to_representation(instance)
+        return _timed(timing, super().to_representation, instance)
+
+    def run_validation(self, *args, **kwargs):
+        timing = _current.get()
+        if timing is None:
+            return super().run_validation(*args, **kwargs)
+        return _timed(timing, super().run_validation, *args, **kwargs)
+
+
+def _timed(timing, method, *args, **kwargs):
+    timing.depth += 1
+    started = time.perf_counter()
+    try:
+        return method(*args, **kwargs)
+    finally:
+        timing.depth -= 1
+        if timing.depth == 0:
+            timing.serializer += time.perf_counter() - started
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    return {
+        f'p{pct}': ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+        for pct in (50, 95, 99)
+    }
+
+
+class EndpointStats:
+    """The last `window` timings of every endpoint, in milliseconds."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+        self.lock = Lock()
+
+    def add(self, endpoint, total, sql, queries, serializer):
+        with self.lock:
+            samples = self.samples.get(endpoint)
+            if samples is None:
+                samples = self.samples[endpoint] = deque(maxlen=self.window)
+            samples.append((total * 1000, sql * 1000, queries, serializer * 1000))
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def summary(self):
+        with self.lock:
+            snapshot = {endpoint: (list(samples), self.counts[endpoint]) for endpoint, samples in self.samples.items()}
+        summary = {}
+        for endpoint, (samples, count) in sorted(snapshot.items()):
+            columns = zip(*samples)
+            summary[endpoint] = {'count': count, 'window': len(samples)}
+            for metric, values in zip(METRICS, columns):
+                summary[endpoint][metric] = percentiles(values)
+        return summary
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.counts.clear()
+
+
+_options = getattr(settings, 'SERVER_TIMING', {})
+endpoint_stats = EndpointStats(_options.get('WINDOW', 1000))
+
+
+def endpoint_name(request):
+    """'METHOD url-name' of a DRF view of one of the timed apps, else None."""
+    match = request.resolver_match
+    view_class = getattr(getattr(match, 'func', None), 'cls', None)
+    if view_class is None:
+        return None
+    options = getattr(settings, 'SERVER_TIMING', {})
+    if view_class.__module__.split('.')[0] not in options.get('APPS', ()):
+        return None
+    return f'{request.method} {match.view_name or match.route}'
+
+
+class ServerTimingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample_rate = getattr(settings, 'SERVER_TIMING', {}).get('SAMPLE_RATE', 1.0)
+        if sample_rate <= 0 or random.random() >= sample_rate:
+            return self.get_response(request)
+        timing = RequestTiming()
+        token = _current.set(timing)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timing.execute))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        endpoint = endpoint_name(request)
+        if endpoint is not None:
+            total = time.perf_counter() - timing.started
+            response['Server-Timing'] = timing.header(total)
+            endpoint_stats.add(endpoint, total, timing.sql, timing.queries, timing.serializer)
+        return response
@@ -0,0 +1,5 @@
+from rest_framework.pagination import CursorPagination
+
+
+class FriendPagination(CursorPagination):
+    ordering = ('-created_at', '-id')
@@ -1,10 +1,12 @@
 from rest_framework import serializers
+from SocNet.timing import TimedSerializerMixin
 from account.models import UserAccount, UserProfile
 from rest_framework.validators import UniqueValidator
 from django.core.exceptions import ValidationError
+from SocNet.images import ImageVariantsField
 
 
-class UserAccountSerializer(serializers.ModelSerializer):
+class UserAccountSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True)
     email = serializers.EmailField(required=True, validators = [UniqueValidator(queryset=UserAccount.objects.all())])
     username = serializers.CharField(required=True, validators = [UniqueValidator(queryset=UserAccount.objects.all())])
@@ -18,15 +20,17 @@ class UserAccountSerializer(serializers.ModelSerializer):
         user.save()
         return user
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(queryset=UserAccount.objects.all())
-    friends = serializers.PrimaryKeyRelatedField(queryset=UserProfile.objects.all(), many=True, required=False)
+    friends = serializers.PrimaryKeyRelatedField(queryset=UserProfile.objects.all(), many=True, required=False, write_only=True)
     profile_img = serializers.ImageField(required=False)
     background_img = serializers.ImageField(required=False)
+    profile_img_variants = ImageVariantsField(source='profile_img')
+    background_img_variants = ImageVariantsField(source='background_img')
 
     class Meta:
         model = UserProfile
-        fields = ['user', 'name', 'last_name', 'status', 'bio', 'profile_img', 'background_img','location', "friends", 'user']
+        fields = ['user', 'name', 'last_name', 'status', 'bio', 'profile_img', 'background_img', 'profile_img_variants', 'background_img_variants', 'location', "friends", 'friends_count', 'user']
 
     def validate(self, data):
         friends_pks = data.get('friends', [])
@@ -37,18 +41,23 @@ class UserProfileSerializer(serializers.ModelSerializer):
             raise ValidationError('A user cannot be friend with themselves.')
         return data
     
-class UserProfileWithUserInfoSerializer(serializers.ModelSerializer):
+class UserProfileWithUserInfoSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     user = UserAccountSerializer()
-    friends = serializers.PrimaryKeyRelatedField(queryset=UserProfile.objects.all(), many=True, required=False)
     profile_img = serializers.ImageField(required=False)
     background_img = serializers.ImageField(required=False)
+    profile_img_variants = ImageVariantsField(source='profile_img')
+    background_img_variants = ImageVariantsField(source='background_img')
 
     class Meta:
         model = UserProfile
-        fields = ['user', 'name', 'last_name', 'status', 'bio', 'profile_img', 'background_img','location', "friends", 'user']
+        fields = ['user', 'name', 'last_name', 'status', 'bio', 'profile_img', 'background_img', 'profile_img_variants', 'background_img_variants', 'location', 'friends_count', 'user']
 
-class UserProfileSimplifiedSerializer(serializers.ModelSerializer):
+class UserProfileSimplifiedSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = UserProfile
         fields = ['user_id']
-    
\ No newline at end of file
+    
+
+
+class FriendBatchSerializer(TimedSerializerMixin, serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=1000)
@@ -1,13 +1,10 @@
 from django.urls import path
-from account.api.views import getRoutes, MyTokenObtainPairView, RegisterFilterApiView
-
-from rest_framework_simplejwt.views import (
-    TokenRefreshView
-)
+from account.api.views import getRoutes, MyTokenObtainPairView, MyTokenRefreshView, RegisterFilterApiView, PerformanceStatsView
 
 urlpatterns = [
     path('', getRoutes),
-    path('ticket', RegisterFilterApiView.as_view()),
+    path('ticket', RegisterFilterApiView.as_view(), name='register-filter'),
     path('token', MyTokenObtainPairView.as_view(), name='token_obtain_pair'),
-    path('token/refresh', TokenRefreshView.as_view(), name='token_refresh'),
-]
\ No newline at end of file
+    path('token/refresh', MyTokenRefreshView.as_view(), name='token_refresh'),
+    path('stats', PerformanceStatsView.as_view(), name='performance_stats'),
+]
@@ -1,12 +1,14 @@
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from rest_framework_simplejwt.views import TokenObtainPairView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.views import APIView
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from account.authentication import CachedJWTAuthentication
 from uuid import uuid4
-from django.core.cache import cache
+from account.tickets import get_ticket_store
+from account.revocation import RotatingTokenRefreshSerializer
+from SocNet.timing import endpoint_stats
 
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
@@ -18,6 +20,9 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
 class MyTokenObtainPairView(TokenObtainPairView):
     serializer_class = MyTokenObtainPairSerializer
 
+class MyTokenRefreshView(TokenRefreshView):
+    serializer_class = RotatingTokenRefreshSerializer
+
 @api_view(['GET'])
 def getRoutes(request):
     routes = [
@@ -27,13 +32,17 @@ def getRoutes(request):
     return Response(routes)
 
 class RegisterFilterApiView(APIView):
-    authentication_classes = (JWTAuthentication, )
+    authentication_classes = (CachedJWTAuthentication, )
     permission_classes = (IsAuthenticated, )
     def get(self, request, *args, **kwargs):
         ticket_uuid = str(uuid4()) #generate the random number with the guarantee to secure privacy
-        if request.user.is_anonymous:
-            cache.set(ticket_uuid, False)
-        else: 
-            if request.META.get('HTTP_TICKET_HEADER'):
-                cache.set(ticket_uuid, {'user': request.user.id, 'socket_for': request.META.get('HTTP_TICKET_HEADER')})
-        return Response({'ticket_uuid': ticket_uuid})
\ No newline at end of file
+        if not request.user.is_anonymous and request.META.get('HTTP_TICKET_HEADER'):
+            get_ticket_store().issue(ticket_uuid, {'user': request.user.id, 'socket_for': request.META.get('HTTP_TICKET_HEADER')})
+        return Response({'ticket_uuid': ticket_uuid})
+
+class PerformanceStatsView(APIView):
+    """Percentiles of the requests timed by SocNet.timing.ServerTimingMiddleware in this process."""
+    authentication_classes = (CachedJWTAuthentication, )
+    permission_classes = (IsAdminUser, )
+    def get(self, request, *args, **kwargs):
+        return Response(endpoint_stats.summary())
@@ -0,0 +1,117 @@
+import copy
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from account.models import UserProfile
+
+Identity = namedtuple('Identity', ['user', 'has_profile', 'expires'])
+
+
+class IdentityCache:
+    """Process-local LRU of (user id, token jti) -> Identity.
+
+    An entry lives until the token expires or `ttl` seconds, whichever comes
+    first. Saving or deleting a user or profile drops every entry of that
+    user, see account.signals; changes made with queryset.update() are only
+    picked up after `ttl`."""
+
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.keys_by_user = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires < time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, user, has_profile, token_expires):
+        with self.lock:
+            self.entries[key] = Identity(user, has_profile, min(time.time() + self.ttl, token_expires))
+            self.entries.move_to_end(key)
+            self.keys_by_user.setdefault(key[0], set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, user_id):
+        with self.lock:
+            for key in self.keys_by_user.pop(user_id, ()):
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_user.clear()
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        keys = self.keys_by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_user[key[0]]
+
+
+_options = getattr(settings, 'JWT_IDENTITY_CACHE', {})
+identity_cache = IdentityCache(_options.get('MAX_ENTRIES', 10000), _options.get('TTL', 60))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that looks a user up once per access token: later
+    requests with the same token take the user from identity_cache. The
+    lookup also tells whether the user has a profile, so get_request_profile
+    needs no query either."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+        key = (user_id, validated_token.get(api_settings.JTI_CLAIM))
+        identity = identity_cache.get(key)
+        if identity is None:
+            try:
+                user = self.user_model.objects.select_related('profile').get(**{api_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            if not user.is_active:
+                raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+            # only the identity is cached, the profile row itself changes too often
+            has_profile = user._state.fields_cache.pop('profile', None) is not None
+            identity_cache.set(key, user, has_profile, validated_token['exp'])
+            identity = Identity(user, has_profile, None)
+        # views may change request.user, the cached instance stays untouched
+        user = copy.copy(identity.user)
+        user.has_profile = identity.has_profile
+        return user
+
+
+def get_request_profile(request):
+    """Profile of request.user, raising UserProfile.DoesNotExist like user.profile.
+
+    With CachedJWTAuthentication this costs no query: only the primary key is
+    loaded and the other fields are fetched on first access."""
+    if not hasattr(request, '_profile'):
+        user = request.user
+        has_profile = getattr(user, 'has_profile', None)
+        if has_profile is None:
+            has_profile = UserProfile.objects.filter(pk=user.pk).exists()
+        request._profile = UserProfile.from_db(user._state.db, ['user_id'], [user.pk]) if has_profile else None
+        if request._profile is not None:
+            request._profile.user = user
+    if request._profile is None:
+        raise UserProfile.DoesNotExist('The user has no profile')
+    return request._profile
@@ -0,0 +1,45 @@
+from functools import partial
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.dispatch import Signal
+from account.models import Friendship, UserProfile
+from account.suggestions import friend_graph
+
+# sent inside the transaction that changed friendships with `added` or `removed`,
+# a list of (from profile pk, to profile pk) pairs, from here and from the m2m signal
+friendships_changed = Signal()
+
+
+def refresh_friends_count(profile_pks):
+    counts = Friendship.objects.filter(from_profile=OuterRef('pk')).values('from_profile').annotate(
+        count=Count('*')).values('count')
+    UserProfile.objects.filter(pk__in=profile_pks).update(friends_count=Coalesce(Subquery(counts), 0))
+
+
+def get_friends_count(profile_pk):
+    return UserProfile.objects.values_list('friends_count', flat=True).get(pk=profile_pk)
+
+
+def add_friends(profile_pk, friend_pks):
+    """Adds a batch of friends with one insert, whatever the size of the
+    current friend list. Unknown ids, the profile itself and existing friends
+    are skipped."""
+    candidates = set(friend_pks) - {profile_pk}
+    existing = list(UserProfile.objects.filter(pk__in=candidates).values_list('pk', flat=True))
+    with transaction.atomic():
+        Friendship.objects.bulk_create(
+            [Friendship(from_profile_id=profile_pk, to_profile_id=friend_pk) for friend_pk in existing],
+            ignore_conflicts=True,
+        )
+        refresh_friends_count([profile_pk])
+        friendships_changed.send(Friendship, added=[(profile_pk, friend_pk) for friend_pk in existing])
+        transaction.on_commit(partial(friend_graph.add_edges, profile_pk, existing))
+
+
+def remove_friends(profile_pk, friend_pks):
+    with transaction.atomic():
+        Friendship.objects.filter(from_profile_id=profile_pk, to_profile_id__in=friend_pks).delete()
+        refresh_friends_count([profile_pk])
+        friendships_changed.send(Friendship, removed=[(profile_pk, friend_pk) for friend_pk in friend_pks])
+        transaction.on_commit(partial(friend_graph.remove_edges, profile_pk, list(friend_pks)))
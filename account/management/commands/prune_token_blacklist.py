@@ -0,0 +1,34 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+from rest_framework_simplejwt.utils import aware_utcnow
+
+
+class Command(BaseCommand):
+    help = ('Deletes expired outstanding and blacklisted tokens in small transactions, '
+            'meant to run from cron, e.g. hourly')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.05,
+                            help='seconds to sleep between batches so writers get the lock')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        now = aware_utcnow()
+        expired = OutstandingToken.objects.filter(expires_at__lte=now).order_by('pk')
+        last_pk = 0
+        deleted = 0
+        while True:
+            pks = list(expired.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            with transaction.atomic():
+                # the blacklisted rows go with them, as one DELETE per table
+                OutstandingToken.objects.filter(pk__in=pks).delete()
+            last_pk = pks[-1]
+            deleted += len(pks)
+            if len(pks) == batch_size and options['pause']:
+                time.sleep(options['pause'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired tokens'))
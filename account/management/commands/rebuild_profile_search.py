@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from account.models import UserProfile, ProfileSearchTerm
+from account.search import get_search_terms
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the profile search index, replacing the terms of one batch of profiles at a '
+            'time so searches keep working meanwhile')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        profiles = UserProfile.objects.select_related('user').order_by('pk')
+        last_pk = None
+        indexed = 0
+        while True:
+            batch = profiles if last_pk is None else profiles.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic():
+                ProfileSearchTerm.objects.filter(profile__in=batch).delete()
+                ProfileSearchTerm.objects.bulk_create([
+                    ProfileSearchTerm(profile=profile, term=term, position=position)
+                    for profile in batch
+                    for term, position in get_search_terms(profile).items()
+                ], batch_size=batch_size)
+            last_pk = batch[-1].pk
+            indexed += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} profiles'))
@@ -0,0 +1,180 @@
+import random
+import time
+from itertools import accumulate
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from account.models import UserAccount, UserProfile, Friendship, ProfileSearchTerm
+from account.search import get_search_terms
+from chat.models import Conversation, Message, Participant
+from posts.models import Post, TimelineEntry
+
+FIRST_NAMES = ['Anna', 'Boris', 'Clara', 'Dmitri', 'Elena', 'Felix', 'Galina', 'Hugo', 'Irina', 'Jonas',
+               'Katya', 'Leon', 'Maria', 'Nikolai', 'Olga', 'Pavel', 'Rosa', 'Sergei', 'Tanya', 'Viktor']
+LAST_NAMES = ['Ivanova', 'Smith', 'Petrov', 'Garcia', 'Bulatova', 'Muller', 'Rossi', 'Novak', 'Kowalski',
+              'Jensen', 'Sokolov', 'Dubois', 'Silva', 'Kim', 'Larsen', 'Popescu', 'Horvat', 'Nagy']
+
+
+class Command(BaseCommand):
+    help = ('Fills the database with synthetic users, profiles, a power-law friend graph, posts, '
+            'conversations and messages for load tests. Every user gets the password --password and '
+            'is called <prefix><n>, e.g. seed0 / seed0@example.com.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--friends', type=float, default=20, help='average friends per profile')
+        parser.add_argument('--exponent', type=float, default=0.8,
+                            help='skew of the popularity distribution, higher means more celebrities')
+        parser.add_argument('--posts', type=float, default=3, help='average posts per profile')
+        parser.add_argument('--conversations', type=int, default=None,
+                            help='two-person conversations, by default one per two users')
+        parser.add_argument('--messages', type=int, default=20, help='messages per conversation')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--prefix', default='seed')
+        parser.add_argument('--password', default='seedpass')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.chunk_size = options['chunk_size']
+        self.rng = random.Random(options['seed'])
+        prefix = options['prefix']
+        if UserAccount.objects.filter(username=f'{prefix}0').exists():
+            raise CommandError(f'The database was already seeded with prefix {prefix!r}, pick another --prefix')
+        profile_pks = self.step('users and profiles', self.create_profiles, options['users'])
+        followers = self.step('friendships', self.create_friendships, profile_pks)
+        self.step('posts', self.create_posts, profile_pks, followers)
+        conversations = options['conversations']
+        if conversations is None:
+            conversations = len(profile_pks) // 2
+        self.step('conversations and messages', self.create_conversations, profile_pks, conversations)
+
+    def step(self, name, method, *args):
+        started = time.perf_counter()
+        result = method(*args)
+        self.stdout.write(f'{name}: {self.created} rows in {time.perf_counter() - started:.1f}s')
+        return result
+
+    def chunks(self, items):
+        for start in range(0, len(items), self.chunk_size):
+            yield items[start:start + self.chunk_size]
+
+    def power_law(self, mean):
+        # Pareto with shape 2 has mean 2, so this averages to `mean` with a long tail
+        return int(mean / 2 * self.rng.paretovariate(2))
+
+    def create_profiles(self, count):
+        prefix = self.options['prefix']
+        password = make_password(self.options['password'])
+        self.created = 0
+        profile_pks = []
+        for indexes in self.chunks(range(count)):
+            with transaction.atomic():
+                usernames = [f'{prefix}{i}' for i in indexes]
+                UserAccount.objects.bulk_create([
+                    UserAccount(username=username, email=f'{username}@example.com', password=password)
+                    for username in usernames
+                ])
+                users = UserAccount.objects.filter(username__in=usernames).order_by('pk')
+                profiles = [
+                    UserProfile(user=user, name=self.rng.choice(FIRST_NAMES), last_name=self.rng.choice(LAST_NAMES))
+                    for user in users
+                ]
+                UserProfile.objects.bulk_create(profiles)
+                # bulk_create skips the signal that indexes profiles for search
+                ProfileSearchTerm.objects.bulk_create([
+                    ProfileSearchTerm(profile=profile, term=term, position=position)
+                    for profile in profiles
+                    for term, position in get_search_terms(profile).items()
+                ], batch_size=self.chunk_size)
+            profile_pks.extend(profile.pk for profile in profiles)
+            self.created += len(profiles) * 2
+        return profile_pks
+
+    def create_friendships(self, profile_pks):
+        """Out-degrees and the popularity of targets both follow power laws,
+        with different profiles at the head of each. Returns the follower count of every profile."""
+        popular = list(profile_pks)
+        self.rng.shuffle(popular)
+        cum_weights = list(accumulate(1 / (rank ** self.options['exponent']) for rank in range(1, len(popular) + 1)))
+        followers = dict.fromkeys(profile_pks, 0)
+        self.created = 0
+        for sources in self.chunks(profile_pks):
+            rows = []
+            for source in sources:
+                degree = min(self.power_law(self.options['friends']), len(popular) - 1)
+                targets = set(self.rng.choices(popular, cum_weights=cum_weights, k=degree))
+                targets.discard(source)
+                rows.extend(Friendship(from_profile_id=source, to_profile_id=target) for target in targets)
+                for target in targets:
+                    followers[target] += 1
+            with transaction.atomic():
+                Friendship.objects.bulk_create(rows, batch_size=self.chunk_size)
+                # friends_count is kept by the m2m_changed signal, which bulk_create does not send
+                UserProfile.objects.filter(pk__in=sources).update(friends_count=Coalesce(Subquery(
+                    Friendship.objects.filter(from_profile=OuterRef('pk'))
+                    .values('from_profile').annotate(count=Count('pk')).values('count')), 0))
+            self.created += len(rows)
+        return followers
+
+    def create_posts(self, profile_pks, followers):
+        """Posts of authors with at most FEED_FANOUT_LIMIT followers get timeline
+        entries like PostViewSet.perform_create writes them, the other authors
+        are marked popular."""
+        limit = getattr(settings, 'FEED_FANOUT_LIMIT', 1000)
+        self.created = 0
+        for authors in self.chunks(profile_pks):
+            posts = [
+                Post(author_id=author, text_content=f'Post {n} of {author}', fanned_out=followers[author] <= limit)
+                for author in authors
+                for n in range(self.power_law(self.options['posts']))
+            ]
+            fanned_out = [post.author_id for post in posts if post.fanned_out and followers[post.author_id]]
+            with transaction.atomic():
+                Post.objects.bulk_create(posts, batch_size=self.chunk_size)
+                UserProfile.objects.filter(
+                    pk__in={post.author_id for post in posts if not post.fanned_out}).update(popular=True)
+                followers_of = {}
+                for author, follower in Friendship.objects.filter(
+                        to_profile__in=set(fanned_out)).values_list('to_profile', 'from_profile'):
+                    followers_of.setdefault(author, []).append(follower)
+                entries = [
+                    TimelineEntry(owner_id=follower, post=post)
+                    for post in posts if post.fanned_out
+                    for follower in followers_of.get(post.author_id, ())
+                ]
+                TimelineEntry.objects.bulk_create(entries, batch_size=self.chunk_size)
+            self.created += len(posts) + len(entries)
+
+    def create_conversations(self, profile_pks, count):
+        usernames = dict(UserProfile.objects.filter(pk__in=profile_pks).values_list('pk', 'user__username'))
+        pairs = set()
+        while len(pairs) < min(count, len(profile_pks) * (len(profile_pks) - 1) // 2):
+            first, second = self.rng.sample(profile_pks, 2)
+            pairs.add((min(first, second), max(first, second)))
+        self.created = 0
+        for chunk in self.chunks(sorted(pairs)):
+            with transaction.atomic():
+                names = {'.'.join(sorted((usernames[first], usernames[second]))): (first, second)
+                         for first, second in chunk}
+                # bulk_create skips Conversation.save, which derives the key
+                Conversation.objects.bulk_create([
+                    Conversation(name=name, key=Conversation.make_key(name)) for name in names
+                ], batch_size=self.chunk_size)
+                conversations = dict(Conversation.objects.filter(name__in=names).values_list('name', 'pk'))
+                Participant.objects.bulk_create([
+                    Participant(conversation_id=conversations[name], profile_id=profile)
+                    for name, members in names.items()
+                    for profile in members
+                ], batch_size=self.chunk_size)
+                # create_batch numbers the messages and keeps the inbox columns up to date
+                Message.objects.create_batch([
+                    Message(conversation_id=conversations[name], from_user_id=self.rng.choice(members),
+                            content=f'Message {n}')
+                    for name, members in names.items()
+                    for n in range(self.options['messages'])
+                ])
+            self.created += len(names) * (3 + self.options['messages'])
@@ -0,0 +1,41 @@
+import sqlite3
+import time
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from SocNet.replicas import replicas, stamp_heartbeat
+
+
+class Command(BaseCommand):
+    help = ('Stamps the replication heartbeat on the primary and copies the primary into the SQLite '
+            'replicas of READ_REPLICAS. Replicas of other databases only get the heartbeat, their '
+            'replication is left to the database. With --interval it keeps doing so, e.g. next to '
+            'runserver or from a service')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='seconds between syncs, 0 syncs once')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            copied = self.sync()
+            self.stdout.write(f'Copied the primary to {len(copied)} replicas in {time.perf_counter() - started:.2f}s')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def sync(self):
+        stamp_heartbeat()
+        primary = connections[DEFAULT_DB_ALIAS]
+        primary.ensure_connection()
+        copied = []
+        for alias in replicas.aliases:
+            if connections[alias].vendor != 'sqlite':
+                continue
+            target = sqlite3.connect(str(connections[alias].settings_dict['NAME']))
+            try:
+                primary.connection.backup(target)
+            finally:
+                target.close()
+            copied.append(alias)
+        return copied
@@ -91,11 +91,19 @@ class UserProfile(models.Model):
     profile_img = models.ImageField(upload_to='profile_pics', default = 'profile_pics/default_profile.jpg')
     background_img = models.ImageField(upload_to='background_pics', default = 'background_pics/default_bg.jpg')
     location = models.CharField(max_length=100, null=True, blank=True)
-    friends = models.ManyToManyField('self', blank=True, symmetrical=False)
+    friends = models.ManyToManyField('self', blank=True, symmetrical=False, through='Friendship',
+                                     through_fields=('from_profile', 'to_profile'))
+    # kept in sync with `friends` by account.signals
+    friends_count = models.PositiveIntegerField(default=0, editable=False)
+    # set once the profile wrote a post with too many followers to fan out, see posts.feed
+    popular = models.BooleanField(default=False, editable=False)
 
     class Meta:
         verbose_name = 'User Profile'
         verbose_name_plural = 'User Profiles'
+        indexes = [
+            models.Index(fields=['user'], condition=models.Q(popular=True), name='profile_popular_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user.username} profile'
@@ -104,5 +112,38 @@ class UserProfile(models.Model):
         super().clean()
         if self.friends.filter(pk=self.pk).exists() or self.friends.filter(pk=self.pk).exists():
             raise ValidationError('A user cannot be friend with themselves.')
-    
 
+
+class Friendship(models.Model):
+    from_profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='friendships')
+    to_profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='friend_of')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['from_profile', 'to_profile'], name='friendship_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['from_profile', 'created_at', 'id'], name='friendship_from_created_idx'),
+            models.Index(fields=['to_profile', 'from_profile'], name='friendship_to_from_idx'),
+        ]
+
+
+class ProfileSearchTerm(models.Model):
+    """Suffixes of the lowercased username, name and last name of a profile.
+    `position` is where the suffix starts in its word, 0 means a prefix match."""
+    profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=30)
+    position = models.PositiveSmallIntegerField()
+
+    class Meta:
+        indexes = [
+            # in rank order, a search page stops reading after its rows
+            models.Index(fields=['position', 'term', 'profile'], name='profile_search_rank_idx'),
+        ]
+
+
+class ReplicaHeartbeat(models.Model):
+    """A single row the primary stamps regularly (see sync_replicas), so the
+    age of its copy on a replica tells how far that replica lags behind."""
+    beat = models.DateTimeField()
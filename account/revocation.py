@@ -0,0 +1,150 @@
+import math
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import RLock
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.utils import aware_utcnow, datetime_from_epoch
+
+
+class BloomFilter:
+    """Set membership with false positives at about `error_rate` and no false negatives."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        digest = blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+
+class RevocationFilter:
+    """Process-local front of the token blacklist.
+
+    A Bloom filter holds the jtis of every unexpired blacklisted token, loaded
+    from the database and rebuilt after MAX_AGE seconds, plus the ones
+    blacklisted here since. A bounded set holds the jtis blacklisted here
+    recently, so refresh replays seen by this process are rejected without a
+    query. `check` answers True (revoked), False (not revoked as far as this
+    process knows) or None (ask the database)."""
+
+    def __init__(self, error_rate=0.01, max_age=300, recent_entries=100000):
+        self.error_rate = error_rate
+        self.max_age = max_age
+        self.recent_entries = recent_entries
+        self.lock = RLock()
+        self.bloom = None
+        self.recent = OrderedDict()
+        self.loaded_at = None
+
+    def reset(self):
+        with self.lock:
+            self.bloom = None
+            self.recent.clear()
+            self.loaded_at = None
+
+    def load(self, jtis):
+        jtis = list(jtis)
+        # room to grow until the next rebuild
+        bloom = BloomFilter(max(len(jtis) * 2, 10000), self.error_rate)
+        for jti in jtis:
+            bloom.add(jti)
+        with self.lock:
+            for jti in self.recent:
+                bloom.add(jti)
+            self.bloom = bloom
+            self.loaded_at = time.monotonic()
+
+    def ensure_loaded(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.max_age:
+            self.load(BlacklistedToken.objects.filter(
+                token__expires_at__gt=aware_utcnow()).values_list('token__jti', flat=True).iterator(chunk_size=10000))
+
+    def add(self, jti):
+        with self.lock:
+            self.recent[jti] = True
+            self.recent.move_to_end(jti)
+            while len(self.recent) > self.recent_entries:
+                self.recent.popitem(last=False)
+            if self.bloom is not None:
+                self.bloom.add(jti)
+
+    def check(self, jti):
+        self.ensure_loaded()
+        with self.lock:
+            if jti in self.recent:
+                return True
+            if jti not in self.bloom:
+                return False
+        return None
+
+
+_options = getattr(settings, 'TOKEN_REVOCATION_FILTER', {})
+revocation_filter = RevocationFilter(
+    error_rate=_options.get('ERROR_RATE', 0.01),
+    max_age=_options.get('MAX_AGE', 300),
+    recent_entries=_options.get('RECENT_ENTRIES', 100000),
+)
+
+
+def rotation_blacklists():
+    return api_settings.ROTATE_REFRESH_TOKENS and api_settings.BLACKLIST_AFTER_ROTATION
+
+
+class RotatingRefreshToken(RefreshToken):
+    """RefreshToken checked against revocation_filter before the database.
+
+    A token the filter has not seen may still have been blacklisted by another
+    process. That is caught when it is rotated: blacklisting it again fails on
+    the unique token_id and the refresh is rejected. So the filter is only
+    trusted while every refresh rotates and blacklists the old token."""
+
+    def check_blacklist(self):
+        revoked = revocation_filter.check(self.payload[api_settings.JTI_CLAIM])
+        if revoked:
+            raise TokenError(_("Token is blacklisted"))
+        if revoked is None or not rotation_blacklists():
+            super().check_blacklist()
+
+    def blacklist(self):
+        jti = self.payload[api_settings.JTI_CLAIM]
+        token, _created = OutstandingToken.objects.get_or_create(
+            jti=jti,
+            defaults={
+                "token": str(self),
+                "expires_at": datetime_from_epoch(self.payload["exp"]),
+            },
+        )
+        try:
+            with transaction.atomic():
+                blacklisted = BlacklistedToken.objects.create(token=token)
+        except IntegrityError:
+            # rotated before, this is a replay of an old refresh token
+            revocation_filter.add(jti)
+            raise TokenError(_("Token is blacklisted"))
+        transaction.on_commit(lambda: revocation_filter.add(jti))
+        return blacklisted, True
+
+
+class RotatingTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = RotatingRefreshToken
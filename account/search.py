@@ -0,0 +1,68 @@
+from django.db.models import Exists, OuterRef, Q
+from account.models import ProfileSearchTerm
+
+MAX_TERM_LENGTH = ProfileSearchTerm._meta.get_field('term').max_length
+
+
+def get_search_terms(profile):
+    """Maps every suffix of the searchable words of `profile` to the lowest
+    position it starts at."""
+    terms = {}
+    for word in (profile.user.username, profile.name, profile.last_name):
+        if not word:
+            continue
+        word = word.lower()
+        for position in range(len(word)):
+            term = word[position:position + MAX_TERM_LENGTH]
+            if position < terms.get(term, position + 1):
+                terms[term] = position
+    return terms
+
+
+def index_profile(profile):
+    ProfileSearchTerm.objects.filter(profile=profile).delete()
+    ProfileSearchTerm.objects.bulk_create([
+        ProfileSearchTerm(profile=profile, term=term, position=position)
+        for term, position in get_search_terms(profile).items()
+    ])
+
+
+def search_profiles(queryset, query, after=None, size=10):
+    """Page of the profiles with a username, name or last name containing
+    `query`, prefix matches first, and the cursor of the next page (None on the
+    last page). An empty query pages through every profile.
+
+    Walks the term index in (position, term, profile) order and stops after
+    the page, so neither a count nor a ranking runs over every match. A
+    profile is listed at its first matching term in that order. Raises
+    ValueError for a malformed `after`.
+    """
+    query = query.strip().lower()[:MAX_TERM_LENGTH]
+    if not query:
+        profiles = queryset.order_by('pk')
+        if after is not None:
+            profiles = profiles.filter(pk__gt=int(after))
+        profiles = list(profiles[:size + 1])
+        if len(profiles) > size:
+            return profiles[:size], str(profiles[size - 1].pk)
+        return profiles, None
+
+    matches = ProfileSearchTerm.objects.filter(term__gte=query, term__lt=query + '\uffff')
+    earlier = matches.filter(profile=OuterRef('profile')).filter(
+        Q(position__lt=OuterRef('position')) | Q(position=OuterRef('position'), term__lt=OuterRef('term')))
+    matches = matches.exclude(Exists(earlier))
+    if after is not None:
+        position, profile_pk, term = after.split(':', 2)
+        position, profile_pk = int(position), int(profile_pk)
+        matches = matches.filter(
+            Q(position__gt=position)
+            | Q(position=position, term__gt=term)
+            | Q(position=position, term=term, profile_id__gt=profile_pk))
+    rows = list(matches.order_by('position', 'term', 'profile_id').values_list(
+        'position', 'term', 'profile_id')[:size + 1])
+    profiles = queryset.in_bulk([profile_pk for _, _, profile_pk in rows[:size]])
+    page = [profiles[profile_pk] for _, _, profile_pk in rows[:size] if profile_pk in profiles]
+    if len(rows) > size:
+        position, term, profile_pk = rows[size - 1]
+        return page, f'{position}:{profile_pk}:{term}'
+    return page, None
@@ -0,0 +1,92 @@
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.db import transaction
+from functools import partial
+from account.models import UserAccount, UserProfile, Friendship
+from account.authentication import identity_cache
+from account.friendships import refresh_friends_count, friendships_changed
+from account.suggestions import friend_graph
+from account.search import index_profile
+from SocNet.images import schedule_variants
+
+SEARCHABLE_PROFILE_FIELDS = {'name', 'last_name'}
+
+
+@receiver(post_save, sender=UserProfile)
+def index_saved_profile(sender, instance, created, update_fields, **kwargs):
+    if update_fields is not None and not SEARCHABLE_PROFILE_FIELDS & set(update_fields):
+        return
+    index_profile(instance)
+
+
+@receiver(post_save, sender=UserAccount)
+def index_renamed_user(sender, instance, created, update_fields, **kwargs):
+    if created or (update_fields is not None and 'username' not in update_fields):
+        return
+    profile = UserProfile.objects.filter(user=instance).select_related('user').first()
+    if profile is not None:
+        index_profile(profile)
+
+
+@receiver(post_save, sender=UserAccount)
+@receiver(post_delete, sender=UserAccount)
+def invalidate_user_identity(sender, instance, **kwargs):
+    identity_cache.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_profile_identity(sender, instance, **kwargs):
+    identity_cache.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=UserProfile)
+def render_profile_images(sender, instance, **kwargs):
+    schedule_variants(instance.profile_img)
+    schedule_variants(instance.background_img)
+
+
+@receiver(pre_delete, sender=UserProfile)
+def collect_followers(sender, instance, **kwargs):
+    # the friendships pointing at the profile are gone by post_delete
+    instance._followers = list(Friendship.objects.filter(to_profile=instance).exclude(
+        from_profile=instance).values_list('from_profile_id', flat=True))
+
+
+@receiver(post_delete, sender=UserProfile)
+def unfollow_deleted_profile(sender, instance, **kwargs):
+    followers = instance.__dict__.pop('_followers', [])
+    if followers:
+        refresh_friends_count(followers)
+    transaction.on_commit(partial(friend_graph.remove_edges, instance.pk))
+    for from_pk in followers:
+        transaction.on_commit(partial(friend_graph.remove_edges, from_pk, [instance.pk]))
+
+
+@receiver(m2m_changed, sender=UserProfile.friends.through)
+def update_friends(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # the profiles that are cleared are not reported after the clear
+        cleared = UserProfile.objects.filter(friends=instance) if reverse else instance.friends.all()
+        instance._cleared_friends = list(cleared.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_friends', [])
+    pairs = [(pk, instance.pk) if reverse else (instance.pk, pk) for pk in pk_set]
+    if action == 'post_add':
+        friendships_changed.send(Friendship, added=pairs)
+    else:
+        friendships_changed.send(Friendship, removed=pairs)
+    if not reverse:
+        instance.friends_count = instance.friends.count()
+        UserProfile.objects.filter(pk=instance.pk).update(friends_count=instance.friends_count)
+        if action == 'post_add':
+            transaction.on_commit(partial(friend_graph.add_edges, instance.pk, pk_set))
+        else:
+            transaction.on_commit(partial(friend_graph.remove_edges, instance.pk, pk_set))
+        return
+    refresh_friends_count(pk_set)
+    update_graph = friend_graph.add_edges if action == 'post_add' else friend_graph.remove_edges
+    for from_pk in pk_set:
+        transaction.on_commit(partial(update_graph, from_pk, [instance.pk]))
@@ -0,0 +1,82 @@
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from heapq import nlargest
+from threading import RLock
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from account.models import Friendship
+
+
+class FriendGraph:
+    """Process-local copy of the friendship table: profile id -> sorted
+    array('q') of friend ids. Built lazily from the database, updated in
+    place on friendship changes and rebuilt after FRIEND_GRAPH_MAX_AGE seconds
+    to pick up changes made by other processes."""
+
+    def __init__(self):
+        self.lock = RLock()
+        self.neighbors = {}
+        self.loaded_at = None
+
+    def reset(self):
+        with self.lock:
+            self.neighbors = {}
+            self.loaded_at = None
+
+    def load(self, edges):
+        adjacency = {}
+        for from_pk, to_pk in edges:
+            adjacency.setdefault(from_pk, []).append(to_pk)
+        neighbors = {pk: array('q', sorted(set(friends))) for pk, friends in adjacency.items()}
+        with self.lock:
+            self.neighbors = neighbors
+            self.loaded_at = time.monotonic()
+
+    def ensure_loaded(self):
+        max_age = getattr(settings, 'FRIEND_GRAPH_MAX_AGE', 300)
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > max_age:
+            # from the primary, a stale replica would miss edges that add_edges never sees again
+            self.load(Friendship.objects.using(DEFAULT_DB_ALIAS).values_list('from_profile_id', 'to_profile_id').iterator(chunk_size=10000))
+
+    def add_edges(self, from_pk, to_pks):
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            neighbors = self.neighbors.setdefault(from_pk, array('q'))
+            for to_pk in to_pks:
+                index = bisect_left(neighbors, to_pk)
+                if index == len(neighbors) or neighbors[index] != to_pk:
+                    neighbors.insert(index, to_pk)
+
+    def remove_edges(self, from_pk, to_pks=None):
+        """Removes the given edges of `from_pk`, or all of them when `to_pks` is None."""
+        with self.lock:
+            if self.loaded_at is None or from_pk not in self.neighbors:
+                return
+            if to_pks is None:
+                del self.neighbors[from_pk]
+                return
+            neighbors = self.neighbors[from_pk]
+            for to_pk in to_pks:
+                index = bisect_left(neighbors, to_pk)
+                if index < len(neighbors) and neighbors[index] == to_pk:
+                    del neighbors[index]
+
+    def suggest(self, pk, limit=10):
+        """Top `limit` (profile id, mutual friend count) pairs for `pk`, most
+        mutual friends first, ignoring `pk` itself and its current friends."""
+        self.ensure_loaded()
+        with self.lock:
+            friends = self.neighbors.get(pk, ())
+            counts = Counter()
+            for friend in friends:
+                counts.update(self.neighbors.get(friend, ()))
+            for friend in friends:
+                counts.pop(friend, None)
+        counts.pop(pk, None)
+        return nlargest(limit, counts.items(), key=lambda item: (item[1], -item[0]))
+
+
+friend_graph = FriendGraph()
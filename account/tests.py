@@ -1,12 +1,40 @@
-from django.test import TestCase
-from account.models import UserAccount, UserAccountManager, UserProfile
-from django.core.exceptions import ValidationError
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from account.api.serializers import UserAccountSerializer, UserProfileSerializer
-from rest_framework.test import APITestCase
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections, transaction
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.test import APITestCase, APIClient
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
 from rest_framework_simplejwt.tokens import RefreshToken
+from account.api.serializers import UserAccountSerializer, UserProfileSerializer
+from account.authentication import IdentityCache, identity_cache
+from account.models import (
+    UserAccount, UserAccountManager, UserProfile, ProfileSearchTerm, Friendship, ReplicaHeartbeat,
+)
+from account.revocation import BloomFilter, revocation_filter
+from account.suggestions import FriendGraph, friend_graph
+from account.tickets import LocalMemoryTicketStore, CacheTicketStore, get_ticket_store
+from chat.models import Conversation, Participant
+from posts.models import Post, TimelineEntry
+from SocNet.cache import CHANGE_KEY, MAX_REPLAY, SEQUENCE_KEY, LocalStore, Stamped, TieredCache
+from SocNet.replicas import replicas
+from SocNet.sqlite.base import DatabaseWrapper as SQLiteWrapper
+from SocNet.testing import QueryCountMixin
+from SocNet.timing import endpoint_stats
 
 
 class UserAccountManagerTest(TestCase):
@@ -283,3 +311,691 @@ class AuthenticationTest(APITestCase):
         url = reverse("register-filter")
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class CachedJWTAuthenticationTest(APITestCase):
+    def setUp(self):
+        identity_cache.clear()
+        self.user = User.objects.create_user(username='cached', password='testpass', email='cached@example.com')
+        self.profile = UserProfile.objects.create(user=self.user)
+        self.authenticate(RefreshToken.for_user(self.user).access_token)
+
+    def authenticate(self, token):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_user_is_looked_up_once_per_token(self):
+        self.client.get(reverse('posts-feed'))
+        # timeline and fan-in posts, the user and profile cost nothing
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('posts-feed'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.authenticate(RefreshToken.for_user(self.user).access_token)
+        with self.assertNumQueries(3):
+            self.client.get(reverse('posts-feed'))
+
+    def test_create_post_uses_cached_profile(self):
+        self.client.get(reverse('posts-feed'))
+        response = self.client.post(reverse('posts-list'), {'text_content': 'cached'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['author'], self.profile.pk)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get(reverse('posts-feed'))
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(reverse('posts-feed'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deleted_profile_is_noticed(self):
+        self.client.post(reverse('profile-add-friends'), {'ids': []}, format='json')
+        self.profile.delete()
+        response = self.client.post(reverse('profile-add-friends'), {'ids': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cache_is_bounded(self):
+        cache = IdentityCache(max_entries=2, ttl=60)
+        for jti in ('a', 'b', 'c'):
+            cache.set((1, jti), self.user, True, time.time() + 60)
+        self.assertIsNone(cache.get((1, 'a')))
+        self.assertIsNotNone(cache.get((1, 'c')))
+        cache.set((2, 'd'), self.user, True, time.time() - 1)
+        self.assertIsNone(cache.get((2, 'd')))
+        cache.invalidate(1)
+        self.assertEqual(cache.entries, {})
+
+
+class TokenRevocationTest(APITestCase):
+    def setUp(self):
+        revocation_filter.reset()
+        self.user = User.objects.create_user(username='rotating', password='testpass', email='rotating@example.com')
+        self.refresh = RefreshToken.for_user(self.user)
+
+    def rotate(self, token):
+        return self.client.post(reverse('token_refresh'), {'refresh': str(token)}, format='json')
+
+    def test_replayed_refresh_token_is_rejected(self):
+        response = self.rotate(self.refresh)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.rotate(self.refresh).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.rotate(response.data['refresh']).status_code, status.HTTP_200_OK)
+
+    def test_refresh_skips_blacklist_lookup(self):
+        revocation_filter.ensure_loaded()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.rotate(self.refresh).status_code, status.HTTP_200_OK)
+        lookups = [query['sql'] for query in queries
+                   if query['sql'].startswith('SELECT') and 'token_blacklist_blacklistedtoken' in query['sql']]
+        self.assertEqual(lookups, [])
+
+    def test_token_blacklisted_by_another_process_is_rejected(self):
+        revocation_filter.ensure_loaded()
+        BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=self.refresh['jti']))
+        self.assertEqual(self.rotate(self.refresh).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_prune_deletes_expired_tokens_only(self):
+        expired = timezone.now() - timedelta(days=1)
+        for i in range(5):
+            token = OutstandingToken.objects.create(jti=f'expired{i}', token='', expires_at=expired)
+            BlacklistedToken.objects.create(token=token)
+        call_command('prune_token_blacklist', batch_size=2, pause=0, stdout=StringIO())
+        self.assertEqual(list(OutstandingToken.objects.values_list('jti', flat=True)), [self.refresh['jti']])
+        self.assertEqual(BlacklistedToken.objects.count(), 0)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f'member{i}')
+        self.assertTrue(all(f'member{i}' in bloom for i in range(1000)))
+        false_positives = sum(f'other{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class TicketStoreTest(TestCase):
+    def test_local_memory_ticket_is_single_use(self):
+        store = LocalMemoryTicketStore(ttl=30)
+        store.issue('ticket', {'user': 1})
+        self.assertEqual(store.redeem('ticket'), {'user': 1})
+        self.assertIsNone(store.redeem('ticket'))
+
+    def test_local_memory_ticket_expires(self):
+        store = LocalMemoryTicketStore(ttl=0)
+        store.issue('ticket', {'user': 1})
+        self.assertIsNone(store.redeem('ticket'))
+        self.assertEqual(len(store.tickets), 0)
+
+    def test_local_memory_store_is_bounded(self):
+        store = LocalMemoryTicketStore(ttl=30, max_entries=2)
+        for ticket in ('first', 'second', 'third'):
+            store.issue(ticket, {'user': 1})
+        self.assertIsNone(store.redeem('first'))
+        self.assertEqual(store.redeem('third'), {'user': 1})
+
+    def test_cache_ticket_is_single_use(self):
+        store = CacheTicketStore(ttl=30)
+        store.issue('ticket', {'user': 1})
+        self.assertEqual(store.redeem('ticket'), {'user': 1})
+        self.assertIsNone(store.redeem('ticket'))
+
+    def test_cache_ticket_is_consumed_in_one_statement(self):
+        store = CacheTicketStore(ttl=30, cache_alias='shared')
+        store.issue('ticket', {'user': 1})
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(store.redeem('ticket'), {'user': 1})
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0]['sql'].startswith('DELETE'))
+        store.issue('expired', {'user': 1})
+        caches['shared'].touch(store.key_prefix + 'expired', -1)
+        self.assertIsNone(store.redeem('expired'))
+
+    def test_ticket_view_issues_redeemable_ticket(self):
+        user = User.objects.create_user(username='tickets', password='testpass', email='tickets@example.com')
+        client = APIClient()
+        client.force_authenticate(user=user)
+        response = client.get(reverse('register-filter'), HTTP_TICKET_HEADER='chat')
+        self.assertEqual(get_ticket_store().redeem(response.data['ticket_uuid']), {'user': user.id, 'socket_for': 'chat'})
+
+
+class TieredCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache.reset_stats()
+
+    def other_process(self):
+        other = TieredCache('shared', settings.CACHES['default'])
+        other.store = LocalStore()
+        return other
+
+    def test_hot_key_is_served_from_memory(self):
+        cache.set('hot', {'user': 1})
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(10):
+                self.assertEqual(cache.get('hot'), {'user': 1})
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(cache.stats()['hits'], 10)
+
+    def test_get_many_fetches_missing_keys_in_one_query(self):
+        caches['shared'].set_many({'a': 1, 'b': 2})
+        cache.set('c', 3)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(cache.get_many(['a', 'b', 'c', 'd']), {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(len(queries), 1)
+        # the miss of 'd' is kept as well
+        self.assertEqual(cache.stats(), {'hits': 1, 'l2_hits': 2, 'misses': 1, 'entries': 4})
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(cache.get_many(['a', 'b', 'd']), {'a': 1, 'b': 2})
+        self.assertEqual(len(queries), 0)
+
+    def test_cached_miss_is_invalidated_by_write_elsewhere(self):
+        other = self.other_process()
+        self.assertIsNone(other.get('absent'))
+        self.assertFalse(other.has_key('absent'))
+        cache.set('absent', 1)
+        cache.flush()
+        other.store.synced_at = None
+        self.assertEqual(other.get('absent'), 1)
+
+    def test_invalidate_local_reaches_other_processes(self):
+        other = self.other_process()
+        cache.set('key', 1)
+        self.assertEqual(other.get('key'), 1)
+        caches['shared'].set('key', 2)
+        self.assertEqual(other.get('key'), 1)
+        cache.invalidate_local()
+        # past SYNC_INTERVAL
+        other.store.synced_at = None
+        self.assertEqual(other.get('key'), 2)
+
+    def test_writes_reach_other_processes_per_key(self):
+        other = self.other_process()
+        cache.set_many({'changed': 1, 'deleted': 1, 'counter': 1, 'kept': 1})
+        cache.flush()
+        for key in ('changed', 'deleted', 'counter', 'kept'):
+            other.get(key)
+        cache.set('changed', 2)
+        cache.delete('deleted')
+        cache.incr('counter')
+        cache.flush()
+        self.assertEqual(other.get('changed'), 1)
+        other.store.synced_at = None
+        self.assertEqual(other.get('changed'), 2)
+        self.assertIsNone(other.get('deleted'))
+        self.assertEqual(other.get('counter'), 2)
+        # untouched keys stay in L1
+        hits = other.stats()['hits']
+        self.assertEqual(other.get('kept'), 1)
+        self.assertEqual(other.stats()['hits'], hits + 1)
+
+    def test_lagging_process_drops_its_l1(self):
+        other = self.other_process()
+        cache.set('key', 1)
+        other.get('key')
+        cache.set('key', 2)
+        cache.flush()
+        caches['shared'].delete(CHANGE_KEY.format(other.l2.get(SEQUENCE_KEY)))
+        other.store.synced_at = None
+        self.assertEqual(other.get('key'), 2)
+
+    def test_far_behind_process_drops_its_l1_without_replaying(self):
+        other = self.other_process()
+        cache.set('key', 1)
+        other.get('key')
+        cache.set('key', 2)
+        cache.flush()
+        other.store.sequence = other.l2.get(SEQUENCE_KEY) - MAX_REPLAY - 1
+        other.store.synced_at = None
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(other.get('key'), 2)
+        # the stamps and the key, no journal entries
+        self.assertEqual(len(queries), 2)
+
+    def test_writes_are_journaled_once_per_sync_interval(self):
+        cache.set('first', 1)
+        cache.flush()
+        sequence = caches['shared'].get(SEQUENCE_KEY)
+        with CaptureQueriesContext(connection) as queries:
+            cache.set('second', 2)
+        caches['shared'].set('probe', 0)
+        with CaptureQueriesContext(connection) as l2_set:
+            caches['shared'].set('probe', 1)
+        self.assertEqual(len(queries), len(l2_set))
+        self.assertEqual(caches['shared'].get(SEQUENCE_KEY), sequence)
+        cache.flush()
+        self.assertEqual(caches['shared'].get(SEQUENCE_KEY), sequence + 1)
+        self.assertEqual(caches['shared'].get(CHANGE_KEY.format(sequence + 1)), [cache.make_key('second')])
+
+    def test_local_copy_does_not_outlive_shared_entry(self):
+        other = self.other_process()
+        cache.set('short', 1, timeout=1)
+        self.assertEqual(other.get('short'), 1)
+        self.assertLessEqual(other.store.entries[other.make_key('short')].expires, time.time() + 1)
+        self.assertEqual(cache.incr('short'), 2)
+        self.assertIsInstance(caches['shared'].get('short'), Stamped)
+
+    def test_delete_is_decided_by_shared_cache(self):
+        other = self.other_process()
+        cache.set('key', 1)
+        self.assertTrue(other.delete('key'))
+        self.assertFalse(cache.delete('key'))
+        self.assertIsNone(cache.get('key'))
+
+
+class ServerTimingTest(APITestCase):
+    def setUp(self):
+        endpoint_stats.clear()
+        self.user = User.objects.create_user(username='timed', password='testpass', email='timed@example.com')
+        UserProfile.objects.create(user=self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def test_api_response_has_server_timing(self):
+        response = self.client.get(reverse('profile-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertRegex(response['Server-Timing'],
+                         r'^sql;dur=[0-9.]+;desc="\d+ queries", serializer;dur=[0-9.]+, total;dur=[0-9.]+$')
+        summary = endpoint_stats.summary()
+        self.assertEqual(summary['GET profile-list']['count'], 1)
+        self.assertGreater(summary['GET profile-list']['queries']['p50'], 0)
+        self.assertGreater(summary['GET profile-list']['serializer']['p50'], 0)
+
+    def test_unsampled_request_is_not_timed(self):
+        with self.settings(SERVER_TIMING={'APPS': ['account'], 'SAMPLE_RATE': 0}):
+            response = self.client.get(reverse('profile-list'))
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(endpoint_stats.summary(), {})
+
+    def test_stats_are_admin_only(self):
+        self.client.get(reverse('profile-list'))
+        self.assertEqual(self.client.get(reverse('performance_stats')).status_code, status.HTTP_403_FORBIDDEN)
+        admin = User.objects.create_superuser(username='admin', password='testpass', email='admin@example.com')
+        self.client.force_authenticate(user=admin)
+        response = self.client.get(reverse('performance_stats'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['GET profile-list']), {'count', 'window', 'total', 'sql', 'queries', 'serializer'})
+
+
+class SeedDataTest(TestCase):
+    def test_seeded_rows_are_consistent(self):
+        call_command('seed_data', users=60, friends=6, posts=2, messages=3, chunk_size=25, stdout=StringIO())
+        profiles = UserProfile.objects.filter(user__username__startswith='seed')
+        self.assertEqual(profiles.count(), 60)
+        self.assertTrue(self.client.login(email='seed0@example.com', password='seedpass'))
+        for profile in profiles.annotate(actual=Count('friendships')):
+            self.assertEqual(profile.friends_count, profile.actual)
+        self.assertTrue(ProfileSearchTerm.objects.filter(profile__user__username='seed7', term='seed7').exists())
+        expected_entries = sum(
+            Friendship.objects.filter(to_profile=post.author_id).count()
+            for post in Post.objects.filter(fanned_out=True))
+        self.assertEqual(TimelineEntry.objects.count(), expected_entries)
+        self.assertEqual(Conversation.objects.count(), 30)
+        self.assertEqual(set(Conversation.objects.values_list('last_seq', flat=True)), {3})
+        self.assertEqual(Participant.objects.count(), 60)
+
+    def test_refuses_to_seed_twice(self):
+        call_command('seed_data', users=2, stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('seed_data', users=2, stdout=StringIO())
+
+
+class SQLiteProductionProfileTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'profile.sqlite3')
+
+    def wrapper(self, **options):
+        profile = dict(settings.SQLITE_PRODUCTION_PROFILE, NAME=self.path)
+        profile['OPTIONS'] = dict(profile['OPTIONS'], **options)
+        settings_dict = connections.configure_settings({'default': profile})['default']
+        wrapper = SQLiteWrapper(settings_dict, alias='sqlite_profile')
+        self.addCleanup(wrapper.close)
+        self.addCleanup(lambda: wrapper.pool and wrapper.pool.clear())
+        return wrapper
+
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_pragmas_applied(self):
+        wrapper = self.wrapper()
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        # NORMAL
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 1)
+        self.assertEqual(self.pragma(wrapper, 'busy_timeout'), 5000)
+        # Django's own pragma still runs
+        self.assertEqual(self.pragma(wrapper, 'foreign_keys'), 1)
+
+    def test_atomic_begins_immediate(self):
+        wrapper = self.wrapper()
+        connections['sqlite_profile'] = wrapper
+        self.addCleanup(connections.__delitem__, 'sqlite_profile')
+        wrapper.ensure_connection()
+        with CaptureQueriesContext(wrapper) as queries:
+            with transaction.atomic(using=wrapper.alias):
+                pass
+        self.assertEqual(queries.captured_queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+    def test_closed_connection_goes_back_to_pool(self):
+        wrapper = self.wrapper(pool_size=1)
+        wrapper.ensure_connection()
+        first = wrapper.connection
+        wrapper.close()
+        wrapper.ensure_connection()
+        self.assertIs(wrapper.connection, first)
+        # a second connection does not fit into the pool and is closed
+        other = self.wrapper(pool_size=1)
+        other.ensure_connection()
+        second = other.connection
+        wrapper.close()
+        other.close()
+        self.assertEqual(wrapper.pool.idle, [first])
+        self.assertRaises(Exception, second.execute, 'SELECT 1')
+
+    def test_invalid_options(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.wrapper(pragmas={'journal_mode': 'WAL; DROP TABLE x'}).ensure_connection()
+        with self.assertRaises(ImproperlyConfigured):
+            self.wrapper(transaction_mode='LATER').ensure_connection()
+
+
+class ReadReplicaTest(TransactionTestCase):
+    alias = 'replica_test'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'replica.sqlite3')
+        connections.settings[self.alias] = connections.configure_settings({
+            'default': settings.DATABASES['default'],
+            self.alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': self.path},
+        })[self.alias]
+        self.addCleanup(connections.settings.pop, self.alias)
+        self.addCleanup(connections.__delitem__, self.alias)
+        self.addCleanup(lambda: connections[self.alias].close())
+        aliases, replicas.aliases = replicas.aliases, [self.alias]
+        self.addCleanup(setattr, replicas, 'aliases', aliases)
+        replicas.health.clear()
+        self.addCleanup(replicas.health.clear)
+
+        self.profile = UserProfile.objects.create(
+            user=User.objects.create_user(username='reader', password='testpass', email='reader@example.com'),
+            name='Before')
+        self.addCleanup(cache.delete, replicas.pin_key(self.profile.user.pk))
+        call_command('sync_replicas', stdout=StringIO())
+        UserProfile.objects.filter(pk=self.profile.pk).update(name='After')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.profile.user)
+
+    def name(self, client=None):
+        response = (client or self.client).get(reverse('profile-detail', args=[self.profile.pk]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['name']
+
+    def test_safe_reads_go_to_replica(self):
+        self.assertEqual(self.name(), 'Before')
+        call_command('sync_replicas', stdout=StringIO())
+        self.assertEqual(self.name(), 'After')
+
+    def test_write_pins_user_to_primary(self):
+        other = APIClient()
+        other.force_authenticate(user=User.objects.create_user(
+            username='other', password='testpass', email='other@example.com'))
+        response = self.client.patch(
+            reverse('profile-detail', args=[self.profile.pk]), {'last_name': 'Writer'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.name(), 'After')
+        self.assertEqual(self.name(other), 'Before')
+        cache.delete(replicas.pin_key(self.profile.user.pk))
+        self.assertEqual(self.name(), 'Before')
+
+    def test_unpinned_check_is_served_from_memory(self):
+        self.assertFalse(replicas.is_pinned(self.profile.user.pk))
+        cache.store.synced_at = time.monotonic()
+        with self.assertNumQueries(0):
+            self.assertFalse(replicas.is_pinned(self.profile.user.pk))
+        replicas.pin(self.profile.user.pk)
+        self.assertTrue(replicas.is_pinned(self.profile.user.pk))
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        ReplicaHeartbeat.objects.using(self.alias).update(beat=timezone.now() - timedelta(seconds=replicas.max_lag + 1))
+        self.assertEqual(self.name(), 'After')
+
+    def test_failing_replica_retried_on_primary(self):
+        replica = sqlite3.connect(self.path)
+        replica.execute('DROP TABLE account_userprofile')
+        replica.close()
+        self.assertEqual(self.name(), 'After')
+        self.assertFalse(replicas.healthy(self.alias))
+
+
+class ProfileSearchTest(APITestCase):
+    def setUp(self):
+        self.hanna = self.create_profile('bob', name='Bob', last_name='Hanna')
+        self.annabel = self.create_profile('annabel', name='Zoe')
+        self.create_profile('carl', name='Carl')
+        self.client.force_authenticate(user=self.annabel.user)
+
+    def create_profile(self, username, **fields):
+        user = User.objects.create_user(username=username, password='testpass', email=f'{username}@example.com')
+        return UserProfile.objects.create(user=user, **fields)
+
+    def search(self, query):
+        response = self.client.get(reverse('search_profiles'), {'name': query})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [profile['user'] for profile in response.data['results']]
+
+    def test_prefix_matches_rank_first(self):
+        self.assertEqual(self.search('ANN'), [self.annabel.pk, self.hanna.pk])
+
+    def test_search_is_case_insensitive_substring(self):
+        self.assertEqual(self.search('oe'), [self.annabel.pk])
+
+    def test_index_follows_profile_and_username_changes(self):
+        self.hanna.last_name = 'Smith'
+        self.hanna.save()
+        self.assertEqual(self.search('hann'), [])
+        self.hanna.user.username = 'hannibal'
+        self.hanna.user.save()
+        self.assertEqual(self.search('hann'), [self.hanna.pk])
+
+    def test_empty_query_returns_all_profiles(self):
+        self.assertEqual(len(self.search('')), 3)
+
+    def test_rebuild_command_restores_index(self):
+        ProfileSearchTerm.objects.filter(profile=self.hanna).delete()
+        ProfileSearchTerm.objects.create(profile=self.annabel, term='stale', position=0)
+        call_command('rebuild_profile_search', batch_size=2, stdout=StringIO())
+        self.assertEqual(self.search('ann'), [self.annabel.pk, self.hanna.pk])
+        self.assertEqual(self.search('stale'), [])
+
+    def test_pages_walk_matches_once_without_count(self):
+        # usernames and names match at 0, each profile is listed once at its username
+        profiles = [self.create_profile(f'anna{i}', name='Annabel') for i in range(12)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('search_profiles'), {'name': 'ann'})
+        self.assertFalse([query for query in queries.captured_queries if 'COUNT' in query['sql']])
+        found = [profile['user'] for profile in response.data['results']]
+        response = self.client.get(response.data['next'])
+        found += [profile['user'] for profile in response.data['results']]
+        self.assertIsNone(response.data['next'])
+        ranked = sorted(profiles, key=lambda profile: profile.user.username)
+        self.assertEqual(found, [profile.pk for profile in ranked] + [self.annabel.pk, self.hanna.pk])
+
+    def test_malformed_cursor_is_rejected(self):
+        response = self.client.get(reverse('search_profiles'), {'name': 'ann', 'after': 'nope'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProfileQueryCountTest(QueryCountMixin, APITestCase):
+    """Sizes are the other profiles, all friends of each other."""
+
+    def populate(self, size):
+        User.objects.all().delete()
+        profiles = []
+        for i in range(size + 1):
+            user = User.objects.create_user(username=f'member{i}', password='testpass', email=f'member{i}@example.com')
+            profiles.append(UserProfile.objects.create(user=user, name=f'Member{i}'))
+        for profile in profiles:
+            profile.friends.add(*[friend for friend in profiles if friend != profile])
+        self.profile = profiles[0]
+        self.client.force_authenticate(user=self.profile.user)
+
+    def test_list(self):
+        self.assertSameQueries(
+            2, lambda: self.client.get(reverse('profile-list')),
+            lambda response: len(response.data['results']) - 1)
+
+    def test_retrieve(self):
+        self.assertSameQueries(
+            1, lambda: self.client.get(reverse('profile-detail', args=[self.profile.pk])),
+            lambda response: response.data['friends_count'])
+        self.assertNotIn('friends', self.client.get(reverse('profile-detail', args=[self.profile.pk])).data)
+
+    def test_all_except_user(self):
+        self.assertSameQueries(2, lambda: self.client.get(reverse('all_except_user')))
+
+    def test_friends(self):
+        self.assertSameQueries(
+            2, lambda: self.client.get(reverse('profile-friends', args=[self.profile.pk])))
+
+    def test_search(self):
+        self.assertSameQueries(
+            2, lambda: self.client.get(reverse('search_profiles'), {'name': 'member'}),
+            lambda response: len(response.data['results']) - 1)
+
+
+class FriendsTest(APITestCase):
+    def setUp(self):
+        self.profiles = [
+            UserProfile.objects.create(user=User.objects.create_user(
+                username=f'friend{i}', password='testpass', email=f'friend{i}@example.com'))
+            for i in range(13)
+        ]
+        self.profile = self.profiles[0]
+        self.client.force_authenticate(user=self.profile.user)
+
+    def count(self, profile):
+        profile.refresh_from_db(fields=['friends_count'])
+        return profile.friends_count
+
+    def test_friends_count_follows_changes(self):
+        self.profile.friends.add(*self.profiles[1:4])
+        self.assertEqual(self.count(self.profile), 3)
+        self.profile.friends.remove(self.profiles[1])
+        self.assertEqual(self.count(self.profile), 2)
+        self.profiles[5].userprofile_set.add(self.profile)
+        self.assertEqual(self.count(self.profile), 3)
+        self.profiles[2].userprofile_set.clear()
+        self.assertEqual(self.count(self.profile), 2)
+        self.profile.friends.clear()
+        self.assertEqual(self.count(self.profile), 0)
+
+    def test_deleted_profile_leaves_friends_counts(self):
+        self.profile.friends.add(*self.profiles[1:4])
+        self.profiles[4].friends.add(self.profiles[1])
+        self.profiles[1].friends.add(self.profile)
+        self.profiles[1].delete()
+        self.assertEqual(self.count(self.profile), 2)
+        self.assertEqual(self.count(self.profiles[4]), 0)
+
+    def test_patch_friends_updates_count(self):
+        response = self.client.patch(
+            reverse('profile-detail', args=[self.profile.pk]), {'friends': [self.profiles[1].pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['friends_count'], 1)
+
+    def test_friends_endpoint_is_cursor_paginated(self):
+        self.profile.friends.add(*self.profiles[1:])
+        url = reverse('profile-friends', args=[self.profile.pk])
+        response = self.client.get(url)
+        users = [friend['user']['id'] for friend in response.data['results']]
+        response = self.client.get(response.data['next'])
+        users += [friend['user']['id'] for friend in response.data['results']]
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(users, [profile.pk for profile in reversed(self.profiles[1:])])
+
+    def post_batch(self, name, ids):
+        return self.client.post(reverse(f'profile-{name}'), {'ids': ids}, format='json')
+
+    def test_add_friends_skips_self_unknown_and_existing(self):
+        self.profile.friends.add(self.profiles[1])
+        response = self.post_batch('add-friends', [self.profiles[1].pk, self.profiles[2].pk, self.profile.pk, 99999])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['friends_count'], 2)
+        self.assertEqual(set(self.profile.friends.values_list('pk', flat=True)), {self.profiles[1].pk, self.profiles[2].pk})
+
+    def test_remove_friends(self):
+        self.profile.friends.add(*self.profiles[1:5])
+        response = self.post_batch('remove-friends', [self.profiles[1].pk, self.profiles[2].pk])
+        self.assertEqual(response.data['friends_count'], 2)
+
+    def test_batch_must_not_be_empty(self):
+        response = self.post_batch('add-friends', [])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_friend_mutations_do_not_scale_with_friend_list(self):
+        for friends in (self.profiles[1:3], self.profiles[1:12]):
+            self.profile.friends.set(friends)
+            # one query of each backfills or prunes the timeline of the profile
+            with self.assertNumQueries(8):
+                self.post_batch('add-friends', [self.profiles[12].pk])
+            with self.assertNumQueries(7):
+                self.post_batch('remove-friends', [self.profiles[12].pk])
+
+
+class FriendGraphTest(TestCase):
+    def test_ranks_by_mutual_friends(self):
+        graph = FriendGraph()
+        graph.load([(1, 2), (1, 3), (2, 4), (3, 4), (2, 5), (3, 1), (2, 3)])
+        self.assertEqual(graph.suggest(1), [(4, 2), (5, 1)])
+
+    def test_incremental_updates(self):
+        graph = FriendGraph()
+        graph.load([(1, 2), (2, 3)])
+        graph.add_edges(1, [4, 2])
+        graph.add_edges(4, [5])
+        self.assertEqual(graph.suggest(1), [(3, 1), (5, 1)])
+        graph.remove_edges(1, [2])
+        self.assertEqual(graph.suggest(1), [(5, 1)])
+        graph.remove_edges(1)
+        self.assertEqual(graph.suggest(1), [])
+
+
+class SuggestionsTest(APITestCase):
+    def setUp(self):
+        friend_graph.reset()
+        self.profiles = [
+            UserProfile.objects.create(user=User.objects.create_user(
+                username=f'user{i}', password='testpass', email=f'user{i}@example.com'))
+            for i in range(5)
+        ]
+        me, a, b, c, d = self.profiles
+        me.friends.add(a, b)
+        a.friends.add(c, d)
+        b.friends.add(c)
+        self.client.force_authenticate(user=me.user)
+
+    def suggestions(self):
+        response = self.client.get(reverse('profile-suggestions'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(profile['user']['id'], profile['mutual_friends']) for profile in response.data]
+
+    def test_suggestions_ranked_by_mutual_friends(self):
+        me, a, b, c, d = self.profiles
+        self.assertEqual(self.suggestions(), [(c.pk, 2), (d.pk, 1)])
+
+    def test_graph_follows_friend_endpoints(self):
+        me, a, b, c, d = self.profiles
+        self.suggestions()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('profile-add-friends'), {'ids': [c.pk]}, format='json')
+        self.assertEqual(self.suggestions(), [(d.pk, 1)])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('profile-remove-friends'), {'ids': [a.pk]}, format='json')
+        self.assertEqual(self.suggestions(), [])
+
+    def test_graph_forgets_deleted_profile(self):
+        me, a, b, c, d = self.profiles
+        self.suggestions()
+        with self.captureOnCommitCallbacks(execute=True):
+            c.delete()
+        self.assertEqual(self.suggestions(), [(d.pk, 1)])
@@ -0,0 +1,101 @@
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+class BaseTicketStore:
+    """Short-lived, single-use websocket tickets issued by RegisterFilterApiView."""
+
+    def __init__(self, ttl=30, **options):
+        self.ttl = ttl
+
+    def issue(self, ticket, payload):
+        raise NotImplementedError
+
+    def redeem(self, ticket):
+        """Returns the payload of `ticket` and removes it, or None if it is
+        unknown, expired or was already redeemed."""
+        raise NotImplementedError
+
+    async def aredeem(self, ticket):
+        return await database_sync_to_async(self.redeem)(ticket)
+
+
+class LocalMemoryTicketStore(BaseTicketStore):
+    """Per-process store for single-process deployments. Holds at most
+    `max_entries` tickets, the oldest ones are dropped first."""
+
+    def __init__(self, ttl=30, max_entries=10000, **options):
+        super().__init__(ttl, **options)
+        self.max_entries = max_entries
+        self.tickets = OrderedDict()
+        self.lock = Lock()
+
+    def issue(self, ticket, payload):
+        now = time.monotonic()
+        with self.lock:
+            # every ticket lives for the same ttl, so insertion order is expiry order
+            while self.tickets and next(iter(self.tickets.values()))[0] <= now:
+                self.tickets.popitem(last=False)
+            if len(self.tickets) >= self.max_entries:
+                self.tickets.popitem(last=False)
+            self.tickets[ticket] = (now + self.ttl, payload)
+
+    def redeem(self, ticket):
+        with self.lock:
+            expires_at, payload = self.tickets.pop(ticket, (0, None))
+        if expires_at <= time.monotonic():
+            return None
+        return payload
+
+    async def aredeem(self, ticket):
+        return self.redeem(ticket)
+
+
+class CacheTicketStore(BaseTicketStore):
+    """Store shared by all workers, kept in one of the configured CACHES.
+    Only the caller whose delete actually removed the entry gets the payload,
+    so a ticket cannot be redeemed twice. With a cache that has ``pop()``, like
+    SocNet.cache.TieredCache, that is a single round trip."""
+
+    def __init__(self, ttl=30, cache_alias='default', key_prefix='ws-ticket:', **options):
+        super().__init__(ttl, **options)
+        self.cache_alias = cache_alias
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def issue(self, ticket, payload):
+        self.cache.set(self.key_prefix + ticket, payload, self.ttl)
+
+    def redeem(self, ticket):
+        key = self.key_prefix + ticket
+        if hasattr(self.cache, 'pop'):
+            return self.cache.pop(key)
+        payload = self.cache.get(key)
+        if payload is None or not self.cache.delete(key):
+            return None
+        return payload
+
+
+@lru_cache(maxsize=None)
+def get_ticket_store():
+    config = getattr(settings, 'WEBSOCKET_TICKETS', {})
+    backend = import_string(config.get('BACKEND', 'account.tickets.LocalMemoryTicketStore'))
+    options = {name.lower(): value for name, value in config.get('OPTIONS', {}).items()}
+    return backend(**options)
+
+
+@receiver(setting_changed)
+def reset_ticket_store(setting, **kwargs):
+    if setting == 'WEBSOCKET_TICKETS':
+        get_ticket_store.cache_clear()
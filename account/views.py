@@ -1,22 +1,28 @@
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from account.authentication import CachedJWTAuthentication, get_request_profile
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
-from account.api.serializers import UserProfileSerializer, UserAccountSerializer, UserProfileWithUserInfoSerializer
-from account.models import UserAccount, UserProfile
+from account.api.serializers import UserProfileSerializer, UserAccountSerializer, UserProfileWithUserInfoSerializer, FriendBatchSerializer
+from account.models import UserAccount, UserProfile, Friendship
+from account.friendships import add_friends, remove_friends, get_friends_count
+from account.suggestions import friend_graph
 from rest_framework import viewsets, generics
 from rest_framework.decorators import action
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework import status
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
-from django.db.models import Q
+from rest_framework.utils.urls import replace_query_param
+from account.search import search_profiles
+from account.api.paginators import FriendPagination
+from SocNet.replicas import ReplicaReadMixin
 
-class ProfileViewSet(viewsets.ModelViewSet):
+class ProfileViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     pagination_class = PageNumberPagination
-    authentication_classes = (JWTAuthentication, )
+    authentication_classes = (CachedJWTAuthentication, )
     permission_classes = (IsAuthenticated, )
     parser_classes = (MultiPartParser, FormParser, JSONParser)
     serializer_class = UserProfileSerializer
-    queryset = UserProfile.objects.all()
+    queryset = UserProfile.objects.select_related('user')
 
     def get_serializer_class(self):
         if self.action == 'retrieve':
@@ -37,17 +43,65 @@ class ProfileViewSet(viewsets.ModelViewSet):
         serializer = UserProfileWithUserInfoSerializer(page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
 
+    @action(detail=True, pagination_class=FriendPagination)
+    def friends(self, request, pk=None):
+        profile = self.get_object()
+        friendships = Friendship.objects.filter(from_profile=profile).select_related('to_profile__user')
+        page = self.paginate_queryset(friendships)
+        serializer = UserProfileWithUserInfoSerializer(
+            [friendship.to_profile for friendship in page], many=True, context={'request': request})
+        return self.get_paginated_response(serializer.data)
+
+    def get_own_profile(self, request):
+        try:
+            return get_request_profile(request)
+        except UserProfile.DoesNotExist:
+            raise NotFound('Profile not found')
+
+    @action(detail=False, methods=['post'])
+    def add_friends(self, request):
+        profile = self.get_own_profile(request)
+        serializer = FriendBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        add_friends(profile.pk, serializer.validated_data['ids'])
+        return Response({'friends_count': get_friends_count(profile.pk)})
+
+    @action(detail=False, methods=['post'])
+    def remove_friends(self, request):
+        profile = self.get_own_profile(request)
+        serializer = FriendBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        remove_friends(profile.pk, serializer.validated_data['ids'])
+        return Response({'friends_count': get_friends_count(profile.pk)})
+
+    @action(detail=False)
+    def suggestions(self, request):
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), 50)
+        except ValueError:
+            return Response({'error': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        ranked = friend_graph.suggest(request.user.pk, limit)
+        profiles = self.queryset.in_bulk([pk for pk, _ in ranked])
+        ranked = [(profiles[pk], mutual_friends) for pk, mutual_friends in ranked if pk in profiles]
+        serializer = UserProfileWithUserInfoSerializer(
+            [profile for profile, _ in ranked], many=True, context={'request': request})
+        for data, (_, mutual_friends) in zip(serializer.data, ranked):
+            data['mutual_friends'] = mutual_friends
+        return Response(serializer.data)
+
     @action(detail=False)
     def search(self, request):
         query = request.query_params.get('name', '')
-        profiles = self.queryset.filter(
-            Q(user__username__icontains=query) |
-            Q(name__icontains=query) |
-            Q(last_name__icontains=query)
-        )
-        page=self.paginate_queryset(profiles)
-        serializer = self.get_serializer(page, many=True)
-        return self.get_paginated_response(serializer.data)
+        try:
+            profiles, after = search_profiles(
+                self.queryset, query, after=request.query_params.get('after'), size=self.paginator.page_size)
+        except ValueError:
+            return Response({'error': 'after must be a cursor from a previous page'}, status=status.HTTP_400_BAD_REQUEST)
+        next_url = None
+        if after is not None:
+            next_url = replace_query_param(request.build_absolute_uri(), 'after', after)
+        serializer = self.get_serializer(profiles, many=True)
+        return Response({'next': next_url, 'results': serializer.data})
 
 
 class RegisterUserAccountView(generics.CreateAPIView):
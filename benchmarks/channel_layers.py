@@ -0,0 +1,136 @@
+"""Throughput and latency of UnixSocketChannelLayer against InMemoryChannelLayer.
+
+The broker runs in its own process (``manage.py run_channel_broker``), sender
+and receiver use separate layer instances, i.e. separate broker connections,
+like two Daphne workers would. Three measurements per layer:
+
+* ping-pong round trips between two channels (latency percentiles)
+* a stream of sends drained by one receiver (messages per second)
+* group_send to a group of channels, all members drained (deliveries per second)
+
+    python -m benchmarks.channel_layers --messages 20000 --group-size 100
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import setup_django, percentile, Stopwatch
+
+# the default of both layers, the broker reads its own from CHANNEL_LAYERS
+CAPACITY = 100
+
+MESSAGE = {'type': 'form_message_echo', 'name': {'id': 1, 'username': 'bench'}, 'message': {'content': 'x' * 64}}
+
+
+async def ping_pong(sender, receiver, rounds):
+    ping, pong = await receiver.new_channel(), await sender.new_channel()
+    samples = []
+
+    async def echo():
+        for _ in range(rounds):
+            await receiver.send(pong, await receiver.receive(ping))
+
+    echoing = asyncio.ensure_future(echo())
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await sender.send(ping, MESSAGE)
+        await sender.receive(pong)
+        samples.append(time.perf_counter() - started)
+    await echoing
+    return samples
+
+
+async def stream(sender, receiver, messages, capacity):
+    channel = await receiver.new_channel()
+    received = 0
+
+    async def drain():
+        nonlocal received
+        for _ in range(messages):
+            await receiver.receive(channel)
+            received += 1
+
+    draining = asyncio.ensure_future(drain())
+    with Stopwatch() as elapsed:
+        for sent in range(messages):
+            # stay below the channel capacity instead of retrying on ChannelFull
+            while sent - received >= capacity // 2:
+                await asyncio.sleep(0)
+            await sender.send(channel, MESSAGE)
+        await draining
+    return messages / elapsed.elapsed
+
+
+async def fan_out(sender, receiver, sends, group_size):
+    channels = [await receiver.new_channel() for _ in range(group_size)]
+    for channel in channels:
+        await receiver.group_add('bench', channel)
+
+    async def drain(channel):
+        for _ in range(sends):
+            await receiver.receive(channel)
+
+    draining = asyncio.gather(*(drain(channel) for channel in channels))
+    with Stopwatch() as elapsed:
+        for _ in range(sends):
+            await sender.group_send('bench', MESSAGE)
+        await draining
+    for channel in channels:
+        await receiver.group_discard('bench', channel)
+    return sends * group_size / elapsed.elapsed
+
+
+async def run(name, make_layer, args):
+    sender = make_layer()
+    receiver = sender if name == 'in-memory' else make_layer()
+    samples = await ping_pong(sender, receiver, args.rounds)
+    throughput = await stream(sender, receiver, args.messages, CAPACITY)
+    deliveries = await fan_out(sender, receiver, args.group_sends, args.group_size)
+    for layer in {sender, receiver}:
+        await layer.close()
+    print(f'{name:>12}: rtt p50 {percentile(samples, 50) * 1e6:7.0f}us '
+          f'p99 {percentile(samples, 99) * 1e6:7.0f}us, '
+          f'{throughput:9.0f} msgs/s, {deliveries:9.0f} group deliveries/s')
+
+
+def start_broker(path):
+    broker = subprocess.Popen([
+        sys.executable, 'manage.py', 'run_channel_broker', '--path', path,
+    ], env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'SocNet.settings'}, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        if os.path.exists(path):
+            return broker
+        time.sleep(0.1)
+    broker.kill()
+    raise RuntimeError('channel broker did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=2000, help='ping-pong round trips')
+    parser.add_argument('--messages', type=int, default=20000, help='messages in the stream test')
+    parser.add_argument('--group-sends', type=int, default=100)
+    parser.add_argument('--group-size', type=int, default=100)
+    args = parser.parse_args()
+
+    setup_django()
+    from channels.layers import InMemoryChannelLayer
+    from chat.layers import UnixSocketChannelLayer
+
+    asyncio.run(run('in-memory', lambda: InMemoryChannelLayer(capacity=CAPACITY), args))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'channels.sock')
+        broker = start_broker(path)
+        try:
+            asyncio.run(run('unix-socket', lambda: UnixSocketChannelLayer(path=path), args))
+        finally:
+            broker.terminate()
+            broker.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Throughput of AsyncChatConsumer.
+
+It opens N sockets concurrently (N/2 two-person conversations), then every socket sends M messages and we wait until all
+echoes arrived. Reports connects per second and delivered messages per second.
+
+    python -m benchmarks.chat_consumers --sockets 200 --messages 20
+"""
+import argparse
+import asyncio
+
+from benchmarks.common import setup_django, test_database, Stopwatch
+
+
+def seed(sockets):
+    from account.models import UserAccount, UserProfile
+
+    users = UserAccount.objects.bulk_create([
+        UserAccount(email=f'bench{i}@example.com', username=f'bench{i}') for i in range(sockets)
+    ])
+    UserProfile.objects.bulk_create([UserProfile(user=user) for user in users])
+    return [(user.id, user.username) for user in users]
+
+
+async def run(consumer_class, users, messages, timeout):
+    from channels.testing import WebsocketCommunicator
+    from account.tickets import get_ticket_store
+
+    application = consumer_class.as_asgi()
+    paths = []
+    for index, (user_id, username) in enumerate(users):
+        partner = users[index ^ 1][1]
+        ticket = f'{consumer_class.__name__}-{username}'
+        get_ticket_store().issue(ticket, {'user': user_id, 'socket_for': 'bench'})
+        conv_name = '.'.join(sorted((username, partner)))
+        paths.append(f'/?ticket_uuid={ticket}&conv_name={conv_name}')
+
+    communicators = [WebsocketCommunicator(application, path) for path in paths]
+    with Stopwatch() as connect_time:
+        results = await asyncio.gather(*(communicator.connect(timeout) for communicator in communicators))
+    connected = sum(1 for ok, _ in results if ok)
+
+    async def chat(communicator):
+        for i in range(messages):
+            await communicator.send_json_to({'type': 'form_message', 'message': str(i)})
+        for _ in range(messages * 2):
+            await communicator.receive_json_from(timeout)
+
+    with Stopwatch() as chat_time:
+        await asyncio.gather(*(chat(communicator) for communicator in communicators))
+    await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+
+    delivered = connected * messages * 2
+    print(f'{consumer_class.__name__:>18}: {connected} sockets, '
+          f'{connected / connect_time.elapsed:8.1f} connects/s, '
+          f'{delivered / chat_time.elapsed:8.1f} delivered msgs/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sockets', type=int, default=100, help='even number of concurrent sockets')
+    parser.add_argument('--messages', type=int, default=10, help='messages sent per socket')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    setup_django()
+    from chat.consumers import AsyncChatConsumer
+
+    with test_database():
+        users = seed(args.sockets - args.sockets % 2)
+        asyncio.run(run(AsyncChatConsumer, users, args.messages, args.timeout))
+
+
+if __name__ == '__main__':
+    main()
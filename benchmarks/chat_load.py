@@ -0,0 +1,91 @@
+"""Load generator for the chat websockets, reporting chat.metrics.
+
+Opens N synthetic sockets on AsyncChatConsumer in groups of --group-size
+participants per conversation, then every socket sends M messages, one every
+--interval seconds. Each message carries the time it was sent, so next to the
+server-side numbers of chat_metrics the client-side send-to-echo latency is
+reported as well, plus the channel layer queue depth at the end.
+
+    python -m benchmarks.chat_load --sockets 500 --messages 20 --group-size 5
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.common import setup_django, test_database, percentile, Stopwatch
+from benchmarks.chat_consumers import seed
+
+
+async def run(users, args):
+    from channels.layers import get_channel_layer
+    from channels.testing import WebsocketCommunicator
+    from account.tickets import get_ticket_store
+    from chat.consumers import AsyncChatConsumer
+    from chat.metrics import chat_metrics, layer_stats
+
+    chat_metrics.reset()
+    application = AsyncChatConsumer.as_asgi()
+    communicators, members = [], {}
+    for index, (user_id, username) in enumerate(users):
+        start = index - index % args.group_size
+        conv_name = '.'.join(sorted(name for _, name in users[start:start + args.group_size]))
+        members[conv_name] = members.get(conv_name, 0) + 1
+        ticket = f'load-{username}'
+        get_ticket_store().issue(ticket, {'user': user_id, 'socket_for': 'bench'})
+        communicators.append((conv_name, WebsocketCommunicator(application, f'/?ticket_uuid={ticket}&conv_name={conv_name}')))
+
+    with Stopwatch() as connect_time:
+        await asyncio.gather(*(communicator.connect(args.timeout) for _, communicator in communicators))
+
+    latencies = []
+
+    async def send(communicator):
+        for _ in range(args.messages):
+            await communicator.send_json_to({'type': 'form_message', 'message': json.dumps(time.time())})
+            await asyncio.sleep(args.interval)
+
+    async def receive(communicator, expected):
+        while expected:
+            event = await communicator.receive_json_from(args.timeout)
+            # presence updates are interleaved with the echoes
+            if event['type'] == 'form_message_echo':
+                latencies.append(time.time() - json.loads(event['message']['content']))
+                expected -= 1
+
+    with Stopwatch() as chat_time:
+        await asyncio.gather(
+            *(send(communicator) for _, communicator in communicators),
+            *(receive(communicator, members[conv_name] * args.messages) for conv_name, communicator in communicators),
+        )
+    layer = await layer_stats(get_channel_layer())
+    await asyncio.gather(*(communicator.disconnect() for _, communicator in communicators))
+
+    print(f'{len(communicators)} sockets connected in {connect_time.elapsed:.2f}s, '
+          f'{len(latencies)} echoes in {chat_time.elapsed:.2f}s ({len(latencies) / chat_time.elapsed:.0f}/s)')
+    print(f'client send-to-echo: p50 {percentile(latencies, 50) * 1000:.1f}ms '
+          f'p95 {percentile(latencies, 95) * 1000:.1f}ms p99 {percentile(latencies, 99) * 1000:.1f}ms')
+    snapshot = chat_metrics.snapshot()
+    print(f"counters: {snapshot['counters']}")
+    for name, latency in snapshot['latency_ms'].items():
+        print(f"{name:>10}: n={latency['count']:<7} p50 {latency['p50']:7.2f}ms "
+              f"p95 {latency['p95']:7.2f}ms p99 {latency['p99']:7.2f}ms")
+    print(f'channel layer at the end: {layer}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sockets', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=10, help='messages sent per socket')
+    parser.add_argument('--group-size', type=int, default=2, help='sockets per conversation')
+    parser.add_argument('--interval', type=float, default=0.01, help='seconds between the messages of a socket')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    setup_django()
+    with test_database():
+        asyncio.run(run(seed(args.sockets), args))
+
+
+if __name__ == '__main__':
+    main()
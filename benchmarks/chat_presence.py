@@ -0,0 +1,90 @@
+"""Broadcast rate of typing indicators with many active typers.
+
+Drives chat.presence.PresenceCoalescer the way the consumers do, without
+sockets or a database: every typer joins their conversation, then sends a
+keystroke every 50-250 ms and now and then a message, which stops typing.
+The channel layer is an InMemoryChannelLayer that counts group_send calls.
+The broadcast rate stays below conversations / interval whatever the number
+of keystrokes, where sending every keystroke would fan out each of them.
+
+    python -m benchmarks.chat_presence --typers 1000 --conversations 200 --seconds 10
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.common import setup_django
+
+
+async def typer(presence, conversation, profile_pk, deadline, rng, stats):
+    presence.join(conversation, profile_pk)
+    while time.monotonic() < deadline:
+        await asyncio.sleep(rng.uniform(0.05, 0.25))
+        if rng.random() < 0.05:
+            presence.stop_typing(conversation, profile_pk)
+        else:
+            presence.start_typing(conversation, profile_pk)
+            stats['keystrokes'] += 1
+    presence.leave(conversation, profile_pk)
+
+
+async def run(args):
+    from channels.layers import InMemoryChannelLayer
+    from chat.conversations import ResolvedConversation
+    from chat.presence import PresenceCoalescer
+
+    class CountingLayer(InMemoryChannelLayer):
+        async def group_send(self, group, message):
+            stats['broadcasts'] += 1
+            stats['deliveries'] += len(self.groups.get(group, ()))
+            await super().group_send(group, message)
+
+    stats = {'keystrokes': 0, 'broadcasts': 0, 'deliveries': 0}
+    layer = CountingLayer(capacity=10 ** 6)
+    presence = PresenceCoalescer(layer, interval=args.interval)
+    rng = random.Random(args.seed)
+    conversations = [
+        ResolvedConversation(id=i, key=f'bench{i}', name=f'bench{i}', participants=frozenset())
+        for i in range(args.conversations)
+    ]
+    typers = []
+    for profile_pk in range(args.typers):
+        conversation = conversations[profile_pk % args.conversations]
+        await layer.group_add(conversation.key, f'socket.{profile_pk}')
+        typers.append((conversation, profile_pk))
+
+    started = time.monotonic()
+    deadline = started + args.seconds
+    await asyncio.gather(*(
+        typer(presence, conversation, profile_pk, deadline, rng, stats) for conversation, profile_pk in typers
+    ))
+    elapsed = time.monotonic() - started
+    if presence.flusher is not None:
+        await presence.flusher
+
+    members = args.typers / args.conversations
+    print(f'{args.typers} typers in {args.conversations} conversations for {elapsed:.1f}s, interval {args.interval}s')
+    print(f'  keystrokes:            {stats["keystrokes"] / elapsed:10.0f}/s')
+    print(f'  naive broadcasts:      {stats["keystrokes"] / elapsed:10.0f}/s, '
+          f'{stats["keystrokes"] * members / elapsed:10.0f} frames/s delivered')
+    print(f'  coalesced broadcasts:  {stats["broadcasts"] / elapsed:10.0f}/s, '
+          f'{stats["deliveries"] / elapsed:10.0f} frames/s delivered')
+    print(f'  bound:                 {args.conversations / args.interval:10.0f}/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--typers', type=int, default=1000)
+    parser.add_argument('--conversations', type=int, default=200)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--interval', type=float, default=0.5, help='CHAT_PRESENCE INTERVAL')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    setup_django()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Friend-of-friend suggestions on a synthetic power-law graph.
+
+Builds a FriendGraph in memory (no database) where the number of friends per
+profile follows a Zipf-like distribution, then times `suggest` for the
+profiles with the largest second-degree neighbourhoods.
+
+    python -m benchmarks.friend_suggestions --profiles 200000 --edges 5000000
+"""
+import argparse
+import random
+import time
+
+from benchmarks.common import setup_django, percentile, Stopwatch
+
+
+def power_law_edges(profiles, edges, exponent, seed):
+    rng = random.Random(seed)
+    weights = [1 / (rank ** exponent) for rank in range(1, profiles + 1)]
+    # both the number of friends and the number of followers are power-law
+    # distributed, with different profiles at the head of each distribution
+    shuffled = list(range(1, profiles + 1))
+    rng.shuffle(shuffled)
+    sources = rng.choices(shuffled, weights=weights, k=edges)
+    targets = rng.choices(range(1, profiles + 1), weights=weights, k=edges)
+    return ((source, target) for source, target in zip(sources, targets) if source != target)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', type=int, default=100000)
+    parser.add_argument('--edges', type=int, default=1000000)
+    parser.add_argument('--exponent', type=float, default=0.8)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    setup_django()
+    from account.suggestions import FriendGraph
+
+    graph = FriendGraph()
+    with Stopwatch() as build:
+        graph.load(power_law_edges(args.profiles, args.edges, args.exponent, args.seed))
+    graph.ensure_loaded = lambda: None
+    edge_count = sum(len(friends) for friends in graph.neighbors.values())
+    print(f'built graph: {len(graph.neighbors)} profiles, {edge_count} edges in {build.elapsed:.2f}s')
+
+    def second_degree(pk):
+        return sum(len(graph.neighbors.get(friend, ())) for friend in graph.neighbors[pk])
+
+    candidates = sorted(graph.neighbors, key=second_degree, reverse=True)[:args.samples]
+    print(f'second-degree connections of sampled profiles: '
+          f'{second_degree(candidates[-1])} .. {second_degree(candidates[0])}')
+
+    latencies = []
+    for pk in candidates:
+        started = time.perf_counter()
+        graph.suggest(pk, args.limit)
+        latencies.append((time.perf_counter() - started) * 1000)
+    print(f'suggest top-{args.limit}: p50 {percentile(latencies, 50):.2f} ms, '
+          f'p95 {percentile(latencies, 95):.2f} ms, p99 {percentile(latencies, 99):.2f} ms')
+
+    with Stopwatch() as update:
+        for pk in candidates:
+            graph.add_edges(pk, [1, 2, 3])
+            graph.remove_edges(pk, [1, 2, 3])
+    print(f'incremental add+remove of 3 edges: {update.elapsed / len(candidates) * 1e6:.1f} us per profile')
+
+
+if __name__ == '__main__':
+    main()
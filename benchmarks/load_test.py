@@ -0,0 +1,355 @@
+"""Scripted HTTP and websocket workloads against a running ASGI server.
+
+Seed a database first, then point this at it; unless --url is given a Daphne
+server is started on the configured database for the run:
+
+    python manage.py seed_data --users 1000000
+    python -m benchmarks.load_test --output results/$(git rev-parse --short HEAD).json
+    python -m benchmarks.load_test --compare results/abc1234.json results/def5678.json
+
+Every HTTP workload runs for --duration seconds on --concurrency keep-alive
+connections, each authenticated as a different seeded user. The chat
+workload opens --sockets websockets in pairs on seeded conversations and
+measures the time from sending a message to receiving its own echo.
+Results (requests, errors, requests per second, latency percentiles in
+milliseconds) are written as JSON together with the commit they were
+measured on, so runs can be compared across commits.
+"""
+import argparse
+import asyncio
+import base64
+import http.client
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import quote, urlsplit
+
+from benchmarks.common import setup_django, percentile
+
+SEARCH_TERMS = ['an', 'ova', 'ser', 'kim', 'rosa', 'petr', 'ele', 'ko']
+
+
+def register(client, fixtures, rng):
+    username = f'load_{uuid.uuid4().hex[:20]}'
+    return 'POST', '/account/register/', {'email': f'{username}@example.com', 'username': username, 'password': 'loadpass'}
+
+
+def token(client, fixtures, rng):
+    return 'POST', '/account/api/token', {'email': client.email, 'password': fixtures['password']}
+
+
+def profile(client, fixtures, rng):
+    return 'GET', f"/account/{rng.choice(fixtures['profiles'])}/", None
+
+
+def search(client, fixtures, rng):
+    return 'GET', f'/account/search?name={rng.choice(SEARCH_TERMS)}', None
+
+
+def by_author(client, fixtures, rng):
+    return 'GET', f"/posts/by_author/{rng.choice(fixtures['profiles'])}/", None
+
+
+def by_conversation(client, fixtures, rng):
+    return 'GET', f"/chat/messages/by_conversation/?conversation_name={quote(rng.choice(fixtures['conversations']))}", None
+
+
+HTTP_WORKLOADS = {
+    'register': register,
+    'token': token,
+    'profile': profile,
+    'search': search,
+    'by_author': by_author,
+    'by_conversation': by_conversation,
+}
+WORKLOADS = list(HTTP_WORKLOADS) + ['chat']
+
+
+class Client:
+    """One keep-alive HTTP connection, authenticated as one seeded user."""
+
+    def __init__(self, host, port, email):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+        self.email = email
+        self.access = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = {'Content-Type': 'application/json', **(headers or {})}
+        if self.access is not None:
+            headers['Authorization'] = f'Bearer {self.access}'
+        try:
+            self.connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            raise
+        return response.status, data
+
+    def login(self, password):
+        status, data = self.request('POST', '/account/api/token', {'email': self.email, 'password': password})
+        if status != 200:
+            raise RuntimeError(f'could not log in as {self.email}: {status} {data[:200]!r}')
+        self.access = json.loads(data)['access']
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        **{f'p{pct}': round(percentile(latencies, pct) * 1000, 2) for pct in (50, 95, 99)},
+        'max': round(max(latencies, default=0) * 1000, 2),
+    }
+
+
+def run_http(name, clients, fixtures, args):
+    workload = HTTP_WORKLOADS[name]
+    latencies, errors = [], []
+    deadline = time.monotonic() + args.duration
+
+    def worker(index, client):
+        rng = random.Random(args.seed + index)
+        mine, failed = [], 0
+        while time.monotonic() < deadline:
+            method, path, body = workload(client, fixtures, rng)
+            started = time.perf_counter()
+            try:
+                status, _ = client.request(method, path, body)
+            except (http.client.HTTPException, OSError):
+                status = None
+            mine.append(time.perf_counter() - started)
+            if status is None or status >= 400:
+                failed += 1
+        latencies.extend(mine)
+        errors.append(failed)
+
+    threads = [threading.Thread(target=worker, args=(index, client)) for index, client in enumerate(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, sum(errors), time.perf_counter() - started)
+
+
+class WebSocket:
+    """Just enough of a websocket client for JSON text frames. Autobahn is
+    installed, but Daphne already tied txaio to Twisted in this process."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host, port, path):
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            f'GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\nOrigin: http://{host}:{port}\r\n\r\n'
+        ).encode())
+        status = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        if b' 101 ' not in status:
+            writer.close()
+            raise ConnectionError(f'websocket {path} was rejected: {status!r}')
+        return cls(reader, writer)
+
+    def send_json(self, content):
+        payload = json.dumps(content).encode('utf-8')
+        mask = os.urandom(4)
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x81, 0x80 | len(payload))
+        else:
+            header = struct.pack('!BBH', 0x81, 0x80 | 126, len(payload))
+        self.writer.write(header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+
+    async def receive_json(self):
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7f
+            if length == 126:
+                (length,) = struct.unpack('!H', await self.reader.readexactly(2))
+            elif length == 127:
+                (length,) = struct.unpack('!Q', await self.reader.readexactly(8))
+            payload = await self.reader.readexactly(length)
+            opcode = first & 0x0f
+            if opcode == 0x1:
+                return json.loads(payload)
+            if opcode == 0x8:
+                raise ConnectionError('websocket closed by the server')
+
+    async def close(self):
+        self.writer.write(struct.pack('!BB', 0x88, 0x80) + os.urandom(4))
+        await self.writer.drain()
+        self.writer.close()
+
+
+async def run_chat(pairs, host, port, args):
+    """`pairs` are (conversation name, client) for both participants of each conversation."""
+    latencies = []
+
+    async def chat(conv_name, client):
+        status, data = await asyncio.to_thread(
+            client.request, 'GET', '/account/api/ticket', None, {'Ticket-Header': 'chat'})
+        ticket = json.loads(data)['ticket_uuid']
+        websocket = await WebSocket.connect(host, port, f'/?ticket_uuid={ticket}&conv_name={quote(conv_name)}')
+        for n in range(args.messages):
+            sent = time.perf_counter()
+            content = f'{client.email} {n}'
+            websocket.send_json({'type': 'form_message', 'message': content})
+            while True:
+                frame = await asyncio.wait_for(websocket.receive_json(), 60)
+                if frame.get('type') == 'form_message_echo' and frame['message']['content'] == content:
+                    break
+            latencies.append(time.perf_counter() - sent)
+        await websocket.close()
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(chat(conv_name, client) for conv_name, client in pairs), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        print(f'chat: {len(errors)} sockets failed, e.g. {errors[0]!r}', file=sys.stderr)
+    return summarize(latencies, len(errors), elapsed)
+
+
+def load_fixtures(args):
+    setup_django()
+    from account.models import UserProfile
+    from chat.models import Conversation
+
+    rng = random.Random(args.seed)
+    profiles = list(UserProfile.objects.filter(user__username__startswith=args.prefix)
+                    .order_by('pk').values_list('pk', 'user__email')[:args.sample])
+    if len(profiles) < args.concurrency:
+        sys.exit(f'found {len(profiles)} users called {args.prefix}<n>, run manage.py seed_data first')
+    conversations = list(Conversation.objects.filter(name__startswith=args.prefix)
+                         .order_by('pk').values_list('name', flat=True)[:args.sample])
+    rng.shuffle(profiles)
+    return {
+        'password': args.password,
+        'profiles': [pk for pk, _ in profiles],
+        'emails': [email for _, email in profiles],
+        'conversations': conversations,
+    }
+
+
+def start_server(port):
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'SocNet.asgi:application'],
+        env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'SocNet.settings'},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    for _ in range(300):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('daphne did not start')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, host, port):
+    fixtures = load_fixtures(args)
+    clients = [Client(host, port, email) for email in fixtures['emails'][:args.concurrency]]
+    for client in clients:
+        client.login(args.password)
+    results = {}
+    for name in args.workloads:
+        if name == 'chat':
+            by_username = {email.split('@')[0]: email for email in fixtures['emails']}
+            pairs = []
+            for conv_name in fixtures['conversations']:
+                usernames = conv_name.split('.')
+                if all(username in by_username for username in usernames):
+                    for username in usernames:
+                        client = Client(host, port, by_username[username])
+                        client.login(args.password)
+                        pairs.append((conv_name, client))
+                if len(pairs) >= args.sockets:
+                    break
+            results[name] = asyncio.run(run_chat(pairs, host, port, args))
+        else:
+            results[name] = run_http(name, clients, fixtures, args)
+        print(f"{name:>16}: {results[name]['throughput']:8.1f}/s p50 {results[name]['p50']:8.2f}ms "
+              f"p95 {results[name]['p95']:8.2f}ms p99 {results[name]['p99']:8.2f}ms errors {results[name]['errors']}")
+    return results
+
+
+def compare(old_path, new_path):
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    print(f"{'':>16}  {(old['commit'] or '?')[:10]:>21}  {(new['commit'] or '?')[:10]:>21}")
+    for name in new['results']:
+        if name not in old['results']:
+            continue
+        for metric in ('throughput', 'p50', 'p99'):
+            before, after = old['results'][name][metric], new['results'][name][metric]
+            change = (after - before) / before * 100 if before else 0
+            print(f'{name:>16} {metric:>10}: {before:10.2f} -> {after:10.2f} ({change:+6.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='an already running server, e.g. http://127.0.0.1:8000')
+    parser.add_argument('--port', type=int, default=8765, help='port of the Daphne started otherwise')
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=WORKLOADS)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per HTTP workload')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--sockets', type=int, default=100, help='websockets of the chat workload')
+    parser.add_argument('--messages', type=int, default=20, help='messages per websocket')
+    parser.add_argument('--prefix', default='seed', help='as given to seed_data')
+    parser.add_argument('--password', default='seedpass', help='as given to seed_data')
+    parser.add_argument('--sample', type=int, default=10000, help='seeded profiles and conversations to draw from')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    server = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        host, port = '127.0.0.1', args.port
+        server = start_server(port)
+    try:
+        results = run(args, host, port)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as output:
+            json.dump({
+                'commit': git_commit(),
+                'measured_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'options': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+                'results': results,
+            }, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
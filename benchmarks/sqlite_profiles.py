@@ -0,0 +1,121 @@
+"""Concurrent reads and writes against the default SQLite setup and SQLITE_PRODUCTION_PROFILE.
+
+Reader threads run single SELECTs, writer threads read a row and update it in
+an atomic block, both like a request each: the connection is closed at the
+end, as close_old_connections does with CONN_MAX_AGE 0. Every profile gets a
+fresh database file and runs for --duration seconds; reported are the
+operations per second, the latency percentiles and the "database is locked"
+errors.
+
+    python -m benchmarks.sqlite_profiles --readers 8 --writers 4 --duration 5
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from benchmarks.common import setup_django, percentile
+
+ROWS = 10000
+
+
+def configure(alias, profile, path):
+    from django.conf import settings
+    from django.db import connections
+
+    profile = dict(profile, NAME=path)
+    connections.settings[alias] = connections.configure_settings(
+        {'default': settings.DATABASES['default'], alias: profile})[alias]
+
+
+def prepare(alias):
+    from django.db import connections, transaction
+
+    with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+        cursor.execute('CREATE TABLE counter (id INTEGER PRIMARY KEY, value INTEGER NOT NULL)')
+        cursor.executemany('INSERT INTO counter (id, value) VALUES (%s, 0)', [(i,) for i in range(ROWS)])
+    connections[alias].close()
+
+
+def read(alias, rng):
+    from django.db import connections
+
+    with connections[alias].cursor() as cursor:
+        cursor.execute('SELECT value FROM counter WHERE id = %s', [rng.randrange(ROWS)])
+        cursor.fetchone()
+
+
+def write(alias, rng):
+    from django.db import connections, transaction
+
+    row = rng.randrange(ROWS)
+    with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+        cursor.execute('SELECT value FROM counter WHERE id = %s', [row])
+        value = cursor.fetchone()[0]
+        cursor.execute('UPDATE counter SET value = %s WHERE id = %s', [value + 1, row])
+
+
+def worker(alias, operation, deadline, seed, results):
+    from django.db import OperationalError, connections
+
+    rng = random.Random(seed)
+    latencies, locked = [], 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            operation(alias, rng)
+            latencies.append(time.perf_counter() - started)
+        except OperationalError as error:
+            if 'locked' not in str(error):
+                raise
+            locked += 1
+        finally:
+            connections[alias].close()
+    results.append((operation.__name__, latencies, locked))
+
+
+def run(name, profile, args):
+    with tempfile.TemporaryDirectory() as directory:
+        alias = f'bench_{name}'
+        configure(alias, profile, os.path.join(directory, 'bench.sqlite3'))
+        prepare(alias)
+        results = []
+        deadline = time.perf_counter() + args.duration
+        threads = [
+            threading.Thread(target=worker, args=(alias, operation, deadline, seed, results))
+            for seed, operation in enumerate([read] * args.readers + [write] * args.writers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        from SocNet.sqlite.base import _pools
+        for pool in _pools.values():
+            pool.clear()
+
+    print(f'{name}:')
+    for operation in ('read', 'write'):
+        latencies = [sample for op, samples, _ in results if op == operation for sample in samples]
+        locked = sum(errors for op, _, errors in results if op == operation)
+        print(f'  {operation:>5}s: {len(latencies) / args.duration:8.0f}/s  p50 {percentile(latencies, 50) * 1000:6.2f}ms '
+              f'p99 {percentile(latencies, 99) * 1000:7.2f}ms  locked: {locked}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+
+    run('default', {'ENGINE': 'django.db.backends.sqlite3'}, args)
+    run('production', settings.SQLITE_PRODUCTION_PROFILE, args)
+
+
+if __name__ == '__main__':
+    main()
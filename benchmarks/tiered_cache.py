@@ -0,0 +1,54 @@
+"""Reads of a skewed key set through TieredCache against the DatabaseCache alone.
+
+Keys are drawn from a Zipf-like distribution, so a small set of hot keys takes
+most of the reads, the way tickets and other small lookups would.
+
+    python -m benchmarks.tiered_cache --keys 10000 --reads 50000
+"""
+import argparse
+import random
+import time
+
+from benchmarks.common import setup_django, test_database, percentile, Stopwatch
+
+
+def run(name, cache, keys, args):
+    rng = random.Random(args.seed)
+    weights = [1 / (rank ** args.exponent) for rank in range(1, len(keys) + 1)]
+    reads = rng.choices(keys, weights=weights, k=args.reads)
+    samples = []
+    with Stopwatch() as elapsed:
+        for key in reads:
+            started = time.perf_counter()
+            cache.get(key)
+            samples.append(time.perf_counter() - started)
+        for start in range(0, len(reads), args.batch):
+            cache.get_many(reads[start:start + args.batch])
+    stats = cache.stats() if hasattr(cache, 'stats') else {}
+    print(f'{name:>8}: p50 {percentile(samples, 50) * 1e6:6.0f}us p99 {percentile(samples, 99) * 1e6:6.0f}us, '
+          f'{args.reads / elapsed.elapsed:8.0f} reads/s overall {stats}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--reads', type=int, default=50000)
+    parser.add_argument('--batch', type=int, default=50, help='keys per get_many')
+    parser.add_argument('--exponent', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.core.cache import caches
+
+    with test_database():
+        keys = [f'bench:{i}' for i in range(args.keys)]
+        # DatabaseCache culls beyond MAX_ENTRIES (300 by default)
+        caches['shared']._max_entries = caches['default']._max_entries = args.keys * 2
+        caches['shared'].set_many({key: {'user': i, 'socket_for': 'chat'} for i, key in enumerate(keys)}, None)
+        run('database', caches['shared'], keys, args)
+        run('tiered', caches['default'], keys, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,15 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination
 
 
-class MessagePagination(PageNumberPagination):
+class MessagePagination(CursorPagination):
     page_size = 5
     page_size_query_param = "page_size"
-    max_page_size = 10
\ No newline at end of file
+    max_page_size = 10
+    ordering = ('-timestamp', '-id')
+
+
+class InboxPagination(CursorPagination):
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+    ordering = ('-last_activity_at', '-id')
@@ -1,16 +1,44 @@
 from rest_framework import serializers
-from chat.models import Conversation, Message
+from SocNet.timing import TimedSerializerMixin
+from chat.models import Conversation, Message, Participant
 from account.models import UserProfile
 
-class ConversationSerializer(serializers.ModelSerializer):
+class ConversationSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    # declared explicitly, through models make the default field read only
+    participants = serializers.PrimaryKeyRelatedField(many=True, required=False, queryset=UserProfile.objects.all())
+
     class Meta:
         model = Conversation
         fields = ['id', 'name', 'participants']
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     conversation = serializers.PrimaryKeyRelatedField(queryset=Conversation.objects.all())
     from_user = serializers.PrimaryKeyRelatedField(queryset=UserProfile.objects.all())
 
     class Meta:
         model = Message
-        fields = ['id', 'conversation', 'from_user', 'content', 'timestamp']
\ No newline at end of file
+        fields = ['id', 'conversation', 'from_user', 'content', 'timestamp', 'seq']
+
+class InboxSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    conversation = serializers.ReadOnlyField(source='conversation_id')
+    name = serializers.ReadOnlyField(source='conversation.name')
+    last_message = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Participant
+        fields = ['conversation', 'name', 'last_message', 'unread_count', 'last_activity_at']
+
+    def get_last_message(self, participant):
+        conversation = participant.conversation
+        if conversation.last_message_id is None:
+            return None
+        return {
+            'id': conversation.last_message_id,
+            'from_user': conversation.last_message_from_id,
+            'preview': conversation.last_message_preview,
+            'timestamp': serializers.DateTimeField().to_representation(conversation.last_message_at),
+        }
+
+
+class ReadMarkerSerializer(TimedSerializerMixin, serializers.Serializer):
+    message = serializers.IntegerField(required=False, min_value=1)
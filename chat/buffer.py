@@ -0,0 +1,69 @@
+import asyncio
+from weakref import WeakKeyDictionary
+from channels.db import database_sync_to_async
+from django.conf import settings
+from chat.models import Message
+
+
+class MessageWriteBuffer:
+    """Collects messages from every consumer running on one event loop and
+    inserts them with a single create_batch once `max_batch` messages are
+    pending or `max_delay` seconds passed since the first one.
+
+    `write` only returns after the batch is committed, so the caller gets the
+    message with its database id and timestamp and can acknowledge it. A crash
+    before the flush loses only messages that were never acknowledged.
+    """
+
+    def __init__(self, max_batch=100, max_delay=0.05):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = []
+        self.timer = None
+
+    async def write(self, message):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((message, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self.write_batch(batch))
+
+    async def write_batch(self, batch):
+        try:
+            messages = await database_sync_to_async(Message.objects.create_batch)([message for message, _ in batch])
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            for message, (_, future) in zip(messages, batch):
+                # the writer is gone when its consumer was cancelled, the row is committed anyway
+                if not future.done():
+                    future.set_result(message)
+
+
+_buffers = WeakKeyDictionary()
+
+
+def get_message_buffer():
+    """Buffer of the running event loop, or None when CHAT_MESSAGE_BUFFER is not configured."""
+    options = getattr(settings, 'CHAT_MESSAGE_BUFFER', None)
+    if not options:
+        return None
+    loop = asyncio.get_running_loop()
+    if loop not in _buffers:
+        _buffers[loop] = MessageWriteBuffer(
+            max_batch=options.get('MAX_BATCH', 100),
+            max_delay=options.get('MAX_DELAY', 0.05),
+        )
+    return _buffers[loop]
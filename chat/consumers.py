@@ -1,79 +1,303 @@
 import json
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+import time
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from urllib.parse import parse_qsl
-from django.core.cache import cache
 from chat.models import Conversation, Message
+from chat.buffer import get_message_buffer
+from chat.presence import get_presence
+from chat.metrics import chat_metrics, delivered
+from chat.conversations import aresolve_conversation, conversations_of, messages_since, is_participant
 from datetime import datetime
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from chat.api.serializers import MessageSerializer, ConversationSerializer
 from uuid import UUID
 from account.models import UserProfile
+from account.tickets import get_ticket_store
 from account.api.serializers import UserProfileSimplifiedSerializer
+from SocNet.replicas import replicas
 
 
 class UUIDEncoder(json.JSONEncoder):
-    def defautl(self, obj):
+    def default(self, obj):
         if isinstance(obj, UUID):
             return obj.hex
         return json.JSONEncoder.default(self, obj)
 
 
-class ChatConsumer(JsonWebsocketConsumer):
+# messages per backfill frame
+BACKFILL_FRAME_SIZE = 100
+
+
+def parse_seq(value):
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        return None
+    return seq if seq >= 0 else None
+
+
+def backfill_frames(conversation, since_seq, **extra):
+    """Frames replaying the messages a client missed since `since_seq`: batches
+    of BACKFILL_FRAME_SIZE messages, then a backfill_done frame with the last
+    sequence number sent. `truncated` means more than CHAT_BACKFILL_LIMIT were
+    missed, the client resumes from last_seq again to get the rest."""
+    messages, truncated = messages_since(
+        conversation.id, since_seq, getattr(settings, 'CHAT_BACKFILL_LIMIT', 1000))
+    data = MessageSerializer(messages, many=True).data
+    frames = [
+        {'type': 'backfill', **extra, 'messages': data[start:start + BACKFILL_FRAME_SIZE]}
+        for start in range(0, len(data), BACKFILL_FRAME_SIZE)
+    ]
+    last_seq = messages[-1].seq if messages else since_seq
+    frames.append({'type': 'backfill_done', **extra, 'last_seq': last_seq, 'truncated': truncated})
+    return frames
+
+
+def is_backfilled(backfilled, event):
+    # echoes queued while the backfill ran may already have been replayed
+    message = event['message']
+    return (message.get('seq') or 0) <= backfilled.get(message['conversation'], 0)
+
+
+class AsyncChatConsumer(AsyncJsonWebsocketConsumer):
+    """The socket never holds a thread: DB work runs through
+    database_sync_to_async and the channel layer is awaited."""
 
     def __init__(self, *args, **kwargs):
-        super().__init__(args, kwargs)
+        super().__init__(*args, **kwargs)
         self.user = None
         self.conv_name = None
         self.conversation = None
-        self.conv_participants = None
-        self.conv_participants_list = None
-
-    def connect(self):
-        try:
-            query_string = self.scope['query_string'].decode('utf-8')
-            query_params = dict(parse_qsl(query_string))
-            ticket_uuid = query_params.get('ticket_uuid')
-            self.scope['has_ticket'] = cache.get(ticket_uuid)
-            if self.scope['has_ticket']:
-                self.user =  UserProfile.objects.get(user_id=self.scope['has_ticket']['user']) 
-            if not cache.delete(ticket_uuid):
-                raise Exception('Ticket not found')
-        except:
-            print('Error happened in chat consumer')
-            self.close()
+        self.backfilled = {}
+
+    async def connect(self):
+        started = time.perf_counter()
+        query_params = dict(parse_qsl(self.scope['query_string'].decode('utf-8')))
         self.conv_name = query_params.get('conv_name')
-        self.conv_participants_list = self.conv_name.split('.')
-        self.conversation, created = Conversation.objects.get_or_create(name=self.conv_name)
-        if (created):
-            self.conv_participants = UserProfile.objects.filter(user__username__in=self.conv_participants_list)
-            self.conversation.participants.add(*self.conv_participants)
-        async_to_sync(self.channel_layer.group_add)(self.conv_name, self.channel_name)
-        self.accept()
-
-    def disconnect(self, code):
-        return super().disconnect(code)
-
-    def receive_json(self, content, **kwargs):
-        message_type = content["type"]
+        self.user = await self.redeem_ticket(query_params.get('ticket_uuid'))
+        if self.user is None or not self.conv_name:
+            chat_metrics.incr('rejected')
+            await self.close()
+            return
+        conversation = await aresolve_conversation(self.conv_name)
+        if not await database_sync_to_async(is_participant)(conversation.id, self.user.pk):
+            chat_metrics.incr('rejected')
+            await self.close()
+            return
+        self.conversation = conversation
+        await self.channel_layer.group_add(self.conversation.key, self.channel_name)
+        await self.accept()
+        self.accepted(started, subscriptions=1)
+        since_seq = parse_seq(query_params.get('since_seq'))
+        if since_seq is not None:
+            await self.backfill(self.conversation, since_seq)
+        get_presence(self.channel_layer).join(self.conversation, self.user.pk)
+
+    async def disconnect(self, code):
+        if self.conversation is not None:
+            chat_metrics.gauge('sockets', -1)
+            chat_metrics.gauge('subscriptions', -1)
+            get_presence(self.channel_layer).leave(self.conversation, self.user.pk)
+            await self.channel_layer.group_discard(self.conversation.key, self.channel_name)
+
+    def accepted(self, started, subscriptions):
+        chat_metrics.observe('connect', time.perf_counter() - started)
+        chat_metrics.incr('connects')
+        chat_metrics.gauge('sockets', 1)
+        chat_metrics.gauge('subscriptions', subscriptions)
+
+    async def receive_json(self, content, **kwargs):
+        message_type = content.get("type")
         if message_type == 'form_message':
-            message=Message.objects.create(from_user=self.user, 
-                                            content=content['message'],
-                                            conversation=self.conversation)
-            message.save()
-            async_to_sync(self.channel_layer.group_send)(self.conv_name, {
+            received_at = time.time()
+            message = await self.create_message(self.conversation, content['message'])
+            await self.broadcast(self.conversation, {
                 "type": "form_message_echo",
+                "sent_at": received_at,
                 "name": UserProfileSimplifiedSerializer(self.user).data,
-                "message": MessageSerializer(message).data,
+                "message": message,
             })
-        return super().receive_json(content, **kwargs)
-    
-    def form_message_echo(self, event):
-        self.send_json(event)
-    
+        elif message_type in ('typing', 'heartbeat'):
+            self.update_presence(self.conversation, content)
+
+    def update_presence(self, conversation, content):
+        presence = get_presence(self.channel_layer)
+        if content['type'] == 'heartbeat':
+            presence.heartbeat(conversation, self.user.pk)
+        elif content.get('typing', True):
+            presence.start_typing(conversation, self.user.pk)
+        else:
+            presence.stop_typing(conversation, self.user.pk)
+
+    async def presence_update(self, event):
+        await self.send_json(event)
+
+    async def form_message_echo(self, event):
+        event = delivered(event)
+        if not is_backfilled(self.backfilled, event):
+            await self.send_json(event)
+
+    async def broadcast(self, conversation, event):
+        with chat_metrics.timer('group_send'):
+            await self.channel_layer.group_send(conversation.key, event)
+
+    async def backfill(self, conversation, since_seq, **extra):
+        frames = await database_sync_to_async(backfill_frames)(conversation, since_seq, **extra)
+        for frame in frames:
+            await self.send_json(frame)
+        self.backfilled[conversation.id] = frames[-1]['last_seq']
+
     @classmethod
-    def encode_json(cls, content):
+    async def encode_json(cls, content):
         return json.dumps(content, cls=UUIDEncoder)
-    
 
-    
\ No newline at end of file
+    async def redeem_ticket(self, ticket_uuid):
+        ticket = await get_ticket_store().aredeem(ticket_uuid) if ticket_uuid else None
+        if not ticket:
+            return None
+        return await self.get_profile(ticket['user'])
+
+    @database_sync_to_async
+    def get_profile(self, user_id):
+        return UserProfile.objects.filter(user_id=user_id).first()
+
+    async def create_message(self, conversation, content):
+        chat_metrics.incr('messages_received')
+        # whoever sends a message has stopped typing it
+        get_presence(self.channel_layer).stop_typing(conversation, self.user.pk)
+        buffer = get_message_buffer()
+        with chat_metrics.timer('db_write'):
+            if buffer is None:
+                return await self.save_message(conversation, content)
+            message = await buffer.write(Message(from_user=self.user, content=content, conversation_id=conversation.id))
+        if replicas.aliases:
+            await database_sync_to_async(replicas.pin)(self.user.user_id)
+        return MessageSerializer(message).data
+
+    @database_sync_to_async
+    def save_message(self, conversation, content):
+        message = Message.objects.create(from_user=self.user, content=content, conversation_id=conversation.id)
+        # the sender's next history request has to see it
+        replicas.pin(self.user.user_id)
+        return MessageSerializer(message).data
+
+
+def user_group(profile_pk):
+    return f'user_{profile_pk}'
+
+
+class MultiplexChatConsumer(AsyncChatConsumer):
+    """One socket per user instead of one per conversation.
+
+    The socket joins the group of the user and the groups of all of their
+    conversations on connect. Frames carry the conversation they are about:
+    ``subscribe`` / ``unsubscribe`` with a ``conv_name``, and ``form_message``
+    with a ``conv_name`` and a ``message``. Echoes carry the ``conv_name`` too.
+    A ``subscribe`` with a ``since_seq`` replays the messages after it first.
+    ``typing`` needs a ``conv_name``, a ``heartbeat`` covers every subscription.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.subscriptions = {}
+
+    async def connect(self):
+        started = time.perf_counter()
+        query_params = dict(parse_qsl(self.scope['query_string'].decode('utf-8')))
+        self.user = await self.redeem_ticket(query_params.get('ticket_uuid'))
+        if self.user is None:
+            chat_metrics.incr('rejected')
+            await self.close()
+            return
+        await self.channel_layer.group_add(user_group(self.user.pk), self.channel_name)
+        for conversation in await database_sync_to_async(conversations_of)(self.user.pk):
+            await self.subscribe(conversation)
+        await self.accept()
+        self.accepted(started, subscriptions=0)
+
+    async def disconnect(self, code):
+        if self.user is None:
+            return
+        chat_metrics.gauge('sockets', -1)
+        chat_metrics.gauge('subscriptions', -len(self.subscriptions))
+        presence = get_presence(self.channel_layer)
+        for key, conversation in list(self.subscriptions.items()):
+            presence.leave(conversation, self.user.pk)
+            await self.channel_layer.group_discard(key, self.channel_name)
+        self.subscriptions.clear()
+        await self.channel_layer.group_discard(user_group(self.user.pk), self.channel_name)
+
+    async def subscribe(self, conversation):
+        if conversation.key not in self.subscriptions:
+            self.subscriptions[conversation.key] = conversation
+            chat_metrics.gauge('subscriptions', 1)
+            await self.channel_layer.group_add(conversation.key, self.channel_name)
+            get_presence(self.channel_layer).join(conversation, self.user.pk)
+
+    async def receive_json(self, content, **kwargs):
+        message_type = content.get("type")
+        conv_name = content.get('conv_name')
+        if message_type == 'heartbeat':
+            for conversation in self.subscriptions.values():
+                self.update_presence(conversation, content)
+            return
+        if message_type not in ('subscribe', 'unsubscribe', 'form_message', 'typing'):
+            return
+        if not conv_name:
+            await self.send_error('conv_name is required', content)
+            return
+        if message_type == 'subscribe':
+            await self.receive_subscribe(conv_name, content)
+        elif message_type == 'unsubscribe':
+            conversation = self.subscriptions.pop(Conversation.make_key(conv_name), None)
+            if conversation is not None:
+                chat_metrics.gauge('subscriptions', -1)
+                get_presence(self.channel_layer).leave(conversation, self.user.pk)
+                await self.channel_layer.group_discard(conversation.key, self.channel_name)
+            await self.send_json({'type': 'unsubscribed', 'conv_name': conv_name})
+        else:
+            conversation = self.subscriptions.get(Conversation.make_key(conv_name))
+            if conversation is None:
+                await self.send_error('not subscribed to this conversation', content)
+                return
+            if message_type == 'typing':
+                self.update_presence(conversation, content)
+                return
+            received_at = time.time()
+            message = await self.create_message(conversation, content['message'])
+            await self.broadcast(conversation, {
+                "type": "form_message_echo",
+                "sent_at": received_at,
+                "conv_name": conversation.name,
+                "name": UserProfileSimplifiedSerializer(self.user).data,
+                "message": message,
+            })
+
+    async def receive_subscribe(self, conv_name, content):
+        conversation = await aresolve_conversation(conv_name)
+        if not await database_sync_to_async(is_participant)(conversation.id, self.user.pk):
+            await self.send_error('not a participant of this conversation', content)
+            return
+        await self.subscribe(conversation)
+        await self.send_json({'type': 'subscribed', 'conv_name': conversation.name, 'conversation': conversation.id})
+        since_seq = parse_seq(content.get('since_seq'))
+        if since_seq is not None:
+            await self.backfill(conversation, since_seq, conv_name=conversation.name)
+        # sockets of the other participants pick the conversation up without a round trip
+        for participant in conversation.participants - {self.user.pk}:
+            await self.channel_layer.group_send(user_group(participant), {
+                "type": "conversation_added",
+                "conv_name": conversation.name,
+            })
+
+    async def conversation_added(self, event):
+        conversation = await aresolve_conversation(event['conv_name'])
+        if conversation.key not in self.subscriptions and await database_sync_to_async(is_participant)(
+                conversation.id, self.user.pk):
+            await self.subscribe(conversation)
+            await self.send_json({'type': 'subscribed', 'conv_name': conversation.name, 'conversation': conversation.id})
+
+    async def send_error(self, error, content):
+        await self.send_json({'type': 'error', 'error': error, 'request': content})
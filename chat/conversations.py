@@ -0,0 +1,139 @@
+import time
+from collections import OrderedDict, namedtuple
+from channels.db import database_sync_to_async
+from threading import Lock
+from django.conf import settings
+from django.db.models import Count, OuterRef, Prefetch, Q, Subquery
+from django.db.models.functions import Coalesce
+from account.models import UserProfile
+from chat.models import Conversation, Message, Participant
+
+ResolvedConversation = namedtuple('ResolvedConversation', ['id', 'key', 'name', 'participants'])
+
+
+class ConversationCache:
+    """Process-local LRU of conv_name key -> ResolvedConversation.
+
+    Entries are dropped when the participants of a conversation change or the
+    conversation is deleted, see chat.signals. Those signals only reach the
+    process that made the change, so entries also expire after `ttl` seconds
+    and the participants must not be trusted for authorization, see
+    is_participant."""
+
+    def __init__(self, max_entries=10000, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (expires at, entry)
+        self.entries = OrderedDict()
+        self.keys_by_id = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            expires, entry = item
+            if expires <= time.monotonic():
+                del self.entries[key]
+                self.keys_by_id.pop(entry.id, None)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, entry):
+        with self.lock:
+            self.entries[entry.key] = (time.monotonic() + self.ttl, entry)
+            self.entries.move_to_end(entry.key)
+            self.keys_by_id[entry.id] = entry.key
+            while len(self.entries) > self.max_entries:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.keys_by_id.pop(evicted.id, None)
+
+    def invalidate(self, conversation_ids):
+        with self.lock:
+            for conversation_id in conversation_ids:
+                key = self.keys_by_id.pop(conversation_id, None)
+                if key is not None:
+                    self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_id.clear()
+
+
+conversation_cache = ConversationCache(
+    getattr(settings, 'CHAT_CONVERSATION_CACHE_SIZE', 10000),
+    getattr(settings, 'CHAT_CONVERSATION_CACHE_TTL', 30),
+)
+
+
+def resolve_conversation(conv_name):
+    """Returns the conversation of the participants named in `conv_name`,
+    creating it on first use. Cached lookups do not touch the database."""
+    key = Conversation.make_key(conv_name)
+    entry = conversation_cache.get(key)
+    if entry is not None:
+        return entry
+    conversation, created = Conversation.objects.get_or_create(key=key, defaults={'name': conv_name})
+    if created:
+        conversation.participants.add(*UserProfile.objects.filter(user__username__in=conv_name.split('.')))
+    entry = ResolvedConversation(
+        id=conversation.id,
+        key=key,
+        name=conversation.name,
+        participants=frozenset(conversation.participants.values_list('pk', flat=True)),
+    )
+    conversation_cache.set(entry)
+    return entry
+
+
+def conversations_of(profile_pk):
+    """Every conversation `profile_pk` takes part in, in two queries. Also warms the cache."""
+    conversations = Conversation.objects.filter(participants=profile_pk).prefetch_related(
+        Prefetch('participants', queryset=UserProfile.objects.only('user')))
+    entries = []
+    for conversation in conversations:
+        entry = ResolvedConversation(
+            id=conversation.id,
+            key=conversation.key or Conversation.make_key(conversation.name),
+            name=conversation.name,
+            participants=frozenset(participant.pk for participant in conversation.participants.all()),
+        )
+        conversation_cache.set(entry)
+        entries.append(entry)
+    return entries
+
+
+def is_participant(conversation_id, profile_pk):
+    """Asks the database, the cached participants may be stale on this worker."""
+    return Participant.objects.filter(conversation_id=conversation_id, profile_id=profile_pk).exists()
+
+
+def messages_since(conversation_id, since_seq, limit):
+    """Up to `limit` messages after `since_seq`, oldest first, and whether more were left out."""
+    messages = list(Message.objects.filter(
+        conversation_id=conversation_id, seq__gt=since_seq).order_by('seq')[:limit + 1])
+    return messages[:limit], len(messages) > limit
+
+
+def mark_read(participant, message_id):
+    """Moves the read marker of `participant` forward to `message_id` and
+    recounts the unread messages after it in the same UPDATE, so a message
+    arriving meanwhile is not lost. Markers never move backwards."""
+    unread = Message.objects.filter(
+        conversation=OuterRef('conversation_id'), pk__gt=message_id,
+    ).exclude(from_user=OuterRef('profile_id')).values('conversation').annotate(count=Count('*')).values('count')
+    Participant.objects.filter(
+        Q(last_read_message__isnull=True) | Q(last_read_message__lt=message_id), pk=participant.pk,
+    ).update(last_read_message=message_id, unread_count=Coalesce(Subquery(unread), 0))
+    participant.refresh_from_db(fields=['last_read_message', 'unread_count'])
+    return participant
+
+
+async def aresolve_conversation(conv_name):
+    entry = conversation_cache.get(Conversation.make_key(conv_name))
+    if entry is not None:
+        return entry
+    return await database_sync_to_async(resolve_conversation)(conv_name)
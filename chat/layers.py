@@ -0,0 +1,358 @@
+"""Channel layer shared by all worker processes of one host.
+
+A single broker process (``python manage.py run_channel_broker``) owns every
+queue and group, the workers talk to it over a Unix domain socket. Frames are
+a 4 byte big-endian length followed by a JSON object, so messages have to be
+made of JSON types, like with any other out-of-process layer.
+
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.UnixSocketChannelLayer',
+            'CONFIG': {'path': '/run/socnet/channels.sock', 'capacity': 100, 'expiry': 60},
+        }
+    }
+
+Expiry and capacity are enforced by the broker, which reads them from the same
+CONFIG. Groups live in the broker only, a restarted broker starts empty.
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+import string
+import struct
+import time
+import weakref
+from collections import deque
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from chat.metrics import queue_depths
+
+DEFAULT_PATH = '/tmp/socnet-channels.sock'
+
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def encode_frame(payload):
+    data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    if len(data) > MAX_FRAME_SIZE:
+        raise ValueError(f'channel layer frame of {len(data)} bytes is too large')
+    return HEADER.pack(len(data)) + data
+
+
+async def read_frame(reader):
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ConnectionError(f'channel layer frame of {length} bytes is too large')
+    return json.loads(await reader.readexactly(length))
+
+
+class ChannelBroker(BaseChannelLayer):
+    """Holds the queues and groups for every UnixSocketChannelLayer client."""
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 sweep_interval=1.0, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.group_expiry = group_expiry
+        self.sweep_interval = sweep_interval
+        # channel -> deque of (expires, message)
+        self.queues = {}
+        # channel -> deque of (client writer, request id) waiting in receive
+        self.waiters = {}
+        # group -> {channel: joined}
+        self.groups = {}
+        # channel -> groups it joined, the reverse of `groups`
+        self.memberships = {}
+
+    async def serve(self, path=DEFAULT_PATH):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.clients = {}
+        self.server = await asyncio.start_unix_server(self.handle_client, path=path)
+        os.chmod(path, 0o660)
+        self.sweeper = asyncio.create_task(self.sweep_forever())
+        return self.server
+
+    async def serve_forever(self, path=DEFAULT_PATH):
+        await self.serve(path)
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+            if os.path.exists(path):
+                os.unlink(path)
+
+    async def close(self):
+        self.sweeper.cancel()
+        self.server.close()
+        for writer in self.clients.values():
+            writer.close()
+        await asyncio.gather(*self.clients, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def handle_client(self, reader, writer):
+        self.clients[asyncio.current_task()] = writer
+        try:
+            while True:
+                request = await read_frame(reader)
+                reply = self.dispatch(writer, request)
+                if reply is not None:
+                    reply['id'] = request['id']
+                    writer.write(encode_frame(reply))
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.clients[asyncio.current_task()]
+            for waiters in self.waiters.values():
+                for waiter in [waiter for waiter in waiters if waiter[0] is writer]:
+                    waiters.remove(waiter)
+            writer.close()
+
+    def dispatch(self, writer, request):
+        op = request['op']
+        if op == 'send':
+            try:
+                self.send(request['channel'], request['message'])
+            except ChannelFull:
+                return {'error': 'full'}
+        elif op == 'receive':
+            message = self.receive(request['channel'])
+            if message is None:
+                self.waiters.setdefault(request['channel'], deque()).append((writer, request['id']))
+                return None
+            return {'channel': request['channel'], 'message': message}
+        elif op == 'group_add':
+            self.group_add(request['group'], request['channel'])
+        elif op == 'group_discard':
+            self.group_discard(request['group'], request['channel'])
+        elif op == 'group_send':
+            self.group_send(request['group'], request['message'])
+        elif op == 'flush':
+            self.queues = {}
+            self.groups = {}
+            self.memberships = {}
+        elif op == 'stats':
+            stats = queue_depths({channel: len(queue) for channel, queue in self.queues.items()}, len(self.groups))
+            stats['waiting_receives'] = sum(len(waiters) for waiters in self.waiters.values())
+            return stats
+        else:
+            return {'error': f'unknown operation {op!r}'}
+        return {}
+
+    def send(self, channel, message):
+        waiters = self.waiters.get(channel)
+        while waiters:
+            writer, request_id = waiters.popleft()
+            if not waiters:
+                del self.waiters[channel]
+            if not writer.is_closing():
+                writer.write(encode_frame({'id': request_id, 'channel': channel, 'message': message}))
+                return
+        queue = self.queues.setdefault(channel, deque())
+        self.expire(channel, queue)
+        if len(queue) >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.append((time.time() + self.expiry, message))
+
+    def receive(self, channel):
+        queue = self.queues.get(channel)
+        if queue is None:
+            return None
+        self.expire(channel, queue)
+        message = queue.popleft()[1] if queue else None
+        if not queue:
+            del self.queues[channel]
+        return message
+
+    def group_add(self, group, channel):
+        self.groups.setdefault(group, {})[channel] = time.time()
+        self.memberships.setdefault(channel, set()).add(group)
+
+    def group_discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+        groups = self.memberships.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.memberships[channel]
+
+    def group_send(self, group, message):
+        for channel in list(self.groups.get(group, ())):
+            try:
+                self.send(channel, message)
+            except ChannelFull:
+                pass
+
+    def expire(self, channel, queue):
+        now = time.time()
+        expired = False
+        while queue and queue[0][0] < now:
+            queue.popleft()
+            expired = True
+        if expired:
+            # a message nobody picked up means the consumer behind the channel is gone
+            for group in list(self.memberships.get(channel, ())):
+                self.group_discard(group, channel)
+
+    def sweep(self):
+        for channel, queue in list(self.queues.items()):
+            self.expire(channel, queue)
+            if not queue:
+                del self.queues[channel]
+        timeout = time.time() - self.group_expiry
+        for group, members in list(self.groups.items()):
+            for channel, joined in list(members.items()):
+                if joined < timeout:
+                    self.group_discard(group, channel)
+
+    async def sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+
+class BrokerConnection:
+    """One socket to the broker, with requests multiplexed by id."""
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = itertools.count()
+        self.pending = {}
+        self.closed = False
+        self.writer = None
+        self.opened = asyncio.ensure_future(self.open())
+
+    async def open(self):
+        try:
+            reader, self.writer = await asyncio.open_unix_connection(self.path)
+        except OSError:
+            self.closed = True
+            raise
+        self.reader_task = asyncio.create_task(self.read_replies(reader))
+
+    async def read_replies(self, reader):
+        try:
+            while True:
+                reply = await read_frame(reader)
+                future = self.pending.pop(reply.pop('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+                elif 'message' in reply:
+                    # the receive() that asked for it was cancelled, hand it back to the broker
+                    self.requeue(reply)
+        except (asyncio.IncompleteReadError, ConnectionError) as exc:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f'channel broker went away: {exc!r}'))
+            self.pending.clear()
+
+    def requeue(self, reply):
+        self.writer.write(encode_frame({
+            'op': 'send', 'id': next(self.ids), 'channel': reply['channel'], 'message': reply['message'],
+        }))
+
+    async def request(self, op, **params):
+        if self.closed:
+            raise ConnectionError('channel broker connection is closed')
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(encode_frame({'op': op, 'id': request_id, **params}))
+        await self.writer.drain()
+        reply = await future
+        if reply.get('error') == 'full':
+            raise ChannelFull(params.get('channel'))
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply
+
+    async def close(self):
+        self.closed = True
+        if self.writer is not None:
+            self.reader_task.cancel()
+            self.writer.close()
+            await self.writer.wait_closed()
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """Channel layer client of ChannelBroker, usable from several processes at once."""
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path=DEFAULT_PATH, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.path = path
+        self.client_prefix = ''.join(random.choice(string.ascii_letters) for _ in range(8))
+        # one connection per event loop, async_to_sync runs every call on a fresh loop
+        self.connections = weakref.WeakKeyDictionary()
+
+    async def connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self.connections.get(loop)
+        if connection is None or connection.closed:
+            connection = self.connections[loop] = BrokerConnection(self.path)
+        await connection.opened
+        return connection
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+        connection = await self.connection()
+        await connection.request('send', channel=channel, message=message)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        connection = await self.connection()
+        reply = await connection.request('receive', channel=channel)
+        return reply['message']
+
+    async def new_channel(self, prefix="specific."):
+        return "%s%s!%s" % (
+            prefix,
+            self.client_prefix,
+            "".join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        connection = await self.connection()
+        await connection.request('group_add', group=group, channel=channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+        connection = await self.connection()
+        await connection.request('group_discard', group=group, channel=channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        connection = await self.connection()
+        await connection.request('group_send', group=group, message=message)
+
+    async def flush(self):
+        connection = await self.connection()
+        await connection.request('flush')
+
+    async def stats(self):
+        """Queue depth and group count as seen by the broker, for all processes."""
+        connection = await self.connection()
+        return await connection.request('stats')
+
+    async def close(self):
+        connection = self.connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None:
+            await connection.close()
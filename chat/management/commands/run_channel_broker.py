@@ -0,0 +1,26 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat.layers import ChannelBroker, DEFAULT_PATH
+
+
+class Command(BaseCommand):
+    help = 'Runs the broker behind chat.layers.UnixSocketChannelLayer, start it before the workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--alias', default='default', help='CHANNEL_LAYERS entry to read the config from')
+        parser.add_argument('--path', help='socket path, overrides the one in the config')
+
+    def handle(self, *args, **options):
+        layers = getattr(settings, 'CHANNEL_LAYERS', {})
+        if options['alias'] not in layers:
+            raise CommandError(f"No channel layer called {options['alias']!r} in CHANNEL_LAYERS")
+        config = dict(layers[options['alias']].get('CONFIG', {}))
+        path = options['path'] or config.pop('path', DEFAULT_PATH)
+        config.pop('path', None)
+        broker = ChannelBroker(**config)
+        self.stdout.write(f'Channel broker listening on {path}')
+        try:
+            asyncio.run(broker.serve_forever(path))
+        except KeyboardInterrupt:
+            pass
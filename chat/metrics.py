@@ -0,0 +1,111 @@
+"""Counters and latency windows of the chat websockets of this process.
+
+The consumers record:
+
+* ``connect``: from the start of connect() to accept()
+* ``db_write``: saving a message (or handing it to the write-behind buffer)
+* ``group_send``: the channel layer call fanning an echo out
+* ``delivery``: from receive_json() of the sender to form_message_echo() of
+  each recipient, stamped into the event as ``sent_at`` (wall clock, so it
+  also works across processes on one host)
+
+``chat_metrics.snapshot()`` summarizes them next to the socket, subscription
+and message counters, ``layer_stats()`` adds the queue depth of the channel
+layer. Both are served at chat/metrics.
+"""
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from django.conf import settings
+from SocNet.timing import percentiles
+
+LATENCIES = ('connect', 'db_write', 'group_send', 'delivery')
+
+# deepest channels listed by queue_depths
+DEEPEST_CHANNELS = 10
+
+
+class ChatMetrics:
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = Lock()
+        self.counters = {}
+        # values that go up and down, like open sockets
+        self.gauges = {}
+        self.latencies = {name: deque(maxlen=window) for name in LATENCIES}
+        self.observed = dict.fromkeys(LATENCIES, 0)
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def gauge(self, name, delta):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.latencies[name].append(seconds * 1000)
+            self.observed[name] += 1
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = {name: list(samples) for name, samples in self.latencies.items()}
+            snapshot = {'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+            observed = dict(self.observed)
+        snapshot['latency_ms'] = {
+            name: {'count': observed[name], **percentiles(samples)}
+            for name, samples in latencies.items() if samples
+        }
+        return snapshot
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            for samples in self.latencies.values():
+                samples.clear()
+            self.observed = dict.fromkeys(LATENCIES, 0)
+
+
+chat_metrics = ChatMetrics(getattr(settings, 'CHAT_METRICS', {}).get('WINDOW', 1000))
+
+
+def delivered(event):
+    """The event without its stamp, after recording how long it took to get here."""
+    sent_at = event.pop('sent_at', None)
+    if sent_at is not None:
+        chat_metrics.observe('delivery', max(time.time() - sent_at, 0))
+    chat_metrics.incr('echoes')
+    return event
+
+
+def queue_depths(depths, groups):
+    """Summary of {channel: queued messages}."""
+    deepest = sorted(depths.items(), key=lambda item: item[1], reverse=True)[:DEEPEST_CHANNELS]
+    return {
+        'channels': len(depths),
+        'queued': sum(depths.values()),
+        'deepest': [{'channel': channel, 'depth': depth} for channel, depth in deepest if depth],
+        'groups': groups,
+    }
+
+
+async def layer_stats(channel_layer):
+    """Queue depth of the channel layer, None if the backend does not tell."""
+    if hasattr(channel_layer, 'stats'):
+        return await channel_layer.stats()
+    # InMemoryChannelLayer
+    channels = getattr(channel_layer, 'channels', None)
+    if channels is None:
+        return None
+    return queue_depths({name: queue.qsize() for name, queue in list(channels.items())}, len(channel_layer.groups))
@@ -1,14 +1,102 @@
 
+from hashlib import sha256
 from account.models import UserProfile
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+# characters of the last message kept on the conversation for the inbox
+PREVIEW_LENGTH = 100
 
 class Conversation(models.Model):
     name = models.CharField(max_length=128)
-    participants = models.ManyToManyField(to=UserProfile, blank=True, related_name='chat_participants')
-    
+    # hash of the sorted participant usernames, so "a.b" and "b.a" are the same conversation
+    key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    participants = models.ManyToManyField(
+        to=UserProfile, blank=True, related_name='chat_participants', through='Participant')
+    # denormalized from the newest message by Message.objects.create_batch
+    last_message = models.ForeignKey(
+        'Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+', editable=False)
+    last_message_from = models.ForeignKey(
+        UserProfile, null=True, blank=True, on_delete=models.SET_NULL, related_name='+', editable=False)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, editable=False)
+    last_message_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # sequence number of the newest message, the next one gets last_seq + 1
+    last_seq = models.PositiveBigIntegerField(default=0, editable=False)
+
     class Meta:
         verbose_name_plural = 'Conversations'
 
+    @staticmethod
+    def make_key(conv_name):
+        usernames = sorted(set(conv_name.split('.')))
+        return sha256('.'.join(usernames).encode('utf-8')).hexdigest()
+
+    def save(self, *args, **kwargs):
+        if not self.key:
+            self.key = self.make_key(self.name)
+        super().save(*args, **kwargs)
+
+
+class Participant(models.Model):
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='memberships')
+    profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='chat_memberships')
+    # time of the newest message in the conversation, copied here so the inbox is one index scan
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_message = models.ForeignKey(
+        'Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'profile'], name='unique_participant'),
+        ]
+        indexes = [
+            models.Index(fields=['profile', 'last_activity_at', 'id'], name='participant_inbox_idx'),
+        ]
+
+
+class MessageManager(models.Manager):
+    def create(self, **kwargs):
+        return self.create_batch([self.model(**kwargs)])[0]
+
+    def create_batch(self, messages):
+        """Inserts `messages` and updates the last message of their conversations
+        and the unread counters of the participants in the same transaction.
+        Messages get consecutive sequence numbers per conversation, in list order."""
+        by_conversation = {}
+        for message in messages:
+            by_conversation.setdefault(message.conversation_id, []).append(message)
+        with transaction.atomic(using=self.db):
+            # the row lock serializes writers of a conversation, unique_message_seq backs it up
+            last_seqs = dict(Conversation.objects.select_for_update().filter(
+                pk__in=by_conversation).values_list('pk', 'last_seq'))
+            for conversation_id, batch in by_conversation.items():
+                for offset, message in enumerate(batch, start=1):
+                    message.seq = last_seqs[conversation_id] + offset
+            messages = self.bulk_create(messages)
+            for conversation_id, batch in by_conversation.items():
+                last = batch[-1]
+                Conversation.objects.filter(pk=conversation_id).update(
+                    last_seq=last.seq,
+                    last_message=last,
+                    last_message_from_id=last.from_user_id,
+                    last_message_preview=last.content[:PREVIEW_LENGTH],
+                    last_message_at=last.timestamp,
+                )
+                sent = {}
+                for message in batch:
+                    sent[message.from_user_id] = sent.get(message.from_user_id, 0) + 1
+                # everybody gets the whole batch as unread except their own messages
+                Participant.objects.filter(conversation_id=conversation_id).update(
+                    last_activity_at=last.timestamp,
+                    unread_count=F('unread_count') + len(batch) - Case(
+                        *(When(profile_id=profile_id, then=Value(count)) for profile_id, count in sent.items()),
+                        default=Value(0),
+                    ),
+                )
+        return messages
+
 
 class Message(models.Model):
     conversation = models.ForeignKey(
@@ -19,7 +107,24 @@ class Message(models.Model):
     )
     content = models.CharField(max_length=512)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # position in the conversation, clients resume from it after a reconnect
+    seq = models.PositiveBigIntegerField(null=True, editable=False)
+
+    objects = MessageManager()
 
     class Meta:
         verbose_name_plural = 'Messages'
         ordering = ['timestamp']
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'seq'], name='unique_message_seq'),
+        ]
+        indexes = [
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conv_ts_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.seq is None:
+            # new messages need their sequence number and the denormalized counters
+            Message.objects.db_manager(kwargs.get('using')).create_batch([self])
+            return
+        super().save(*args, **kwargs)
@@ -0,0 +1,148 @@
+import asyncio
+import time
+from weakref import WeakKeyDictionary
+from django.conf import settings
+
+CHANGES = ('typing', 'stopped_typing', 'online', 'offline')
+
+
+class PresenceCoalescer:
+    """Typing and online state of the sockets of one event loop, kept in memory only.
+
+    Changes are collected per conversation and broadcast as one
+    ``presence_update`` frame per conversation every `interval` seconds at
+    most, carrying only what changed: users who started or stopped typing,
+    came online or went offline. Keystrokes of someone already typing only
+    push their timeout back, and a change undone within the same interval is
+    not sent at all. Typing stops `typing_timeout` seconds after the last
+    keystroke, a user is offline `heartbeat_timeout` seconds after the last
+    heartbeat or when their last socket here disconnects.
+    """
+
+    def __init__(self, channel_layer, interval=0.5, typing_timeout=5, heartbeat_timeout=30):
+        self.channel_layer = channel_layer
+        self.interval = interval
+        self.typing_timeout = typing_timeout
+        self.heartbeat_timeout = heartbeat_timeout
+        # conversation key -> {profile pk: expires}
+        self.typing = {}
+        # conversation key -> {profile pk: [expires, open sockets]}
+        self.online = {}
+        # conversation key -> {change: set of profile pks}
+        self.changes = {}
+        self.names = {}
+        self.flusher = None
+
+    def join(self, conversation, profile_pk):
+        self.names[conversation.key] = conversation.name
+        sockets = self.online.setdefault(conversation.key, {})
+        if profile_pk in sockets:
+            sockets[profile_pk][1] += 1
+        else:
+            self.change(conversation.key, 'online', 'offline', profile_pk)
+            sockets[profile_pk] = [0, 1]
+        sockets[profile_pk][0] = time.monotonic() + self.heartbeat_timeout
+
+    def leave(self, conversation, profile_pk):
+        sockets = self.online.get(conversation.key, {})
+        entry = sockets.get(profile_pk)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            self.go_offline(conversation.key, profile_pk)
+
+    def heartbeat(self, conversation, profile_pk):
+        entry = self.online.get(conversation.key, {}).get(profile_pk)
+        if entry is None:
+            # timed out while the socket stayed open
+            self.join(conversation, profile_pk)
+        else:
+            entry[0] = time.monotonic() + self.heartbeat_timeout
+
+    def start_typing(self, conversation, profile_pk):
+        self.names[conversation.key] = conversation.name
+        typing = self.typing.setdefault(conversation.key, {})
+        if profile_pk not in typing:
+            self.change(conversation.key, 'typing', 'stopped_typing', profile_pk)
+        typing[profile_pk] = time.monotonic() + self.typing_timeout
+
+    def stop_typing(self, conversation, profile_pk):
+        self._stop_typing(conversation.key, profile_pk)
+
+    def _stop_typing(self, key, profile_pk):
+        typing = self.typing.get(key)
+        if typing is None or typing.pop(profile_pk, None) is None:
+            return
+        if not typing:
+            del self.typing[key]
+        self.change(key, 'stopped_typing', 'typing', profile_pk)
+
+    def go_offline(self, key, profile_pk):
+        sockets = self.online[key]
+        del sockets[profile_pk]
+        if not sockets:
+            del self.online[key]
+        self._stop_typing(key, profile_pk)
+        self.change(key, 'offline', 'online', profile_pk)
+
+    def change(self, key, change, opposite, profile_pk):
+        changes = self.changes.setdefault(key, {name: set() for name in CHANGES})
+        if profile_pk in changes[opposite]:
+            # undone before anybody was told
+            changes[opposite].discard(profile_pk)
+        else:
+            changes[change].add(profile_pk)
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.run())
+
+    def expire(self):
+        now = time.monotonic()
+        for key, typing in list(self.typing.items()):
+            for profile_pk, expires in list(typing.items()):
+                if expires < now:
+                    self._stop_typing(key, profile_pk)
+        for key, sockets in list(self.online.items()):
+            for profile_pk, (expires, _) in list(sockets.items()):
+                if expires < now:
+                    self.go_offline(key, profile_pk)
+
+    async def flush(self):
+        self.expire()
+        changes, self.changes = self.changes, {}
+        for key, changed in changes.items():
+            if not any(changed.values()):
+                continue
+            await self.channel_layer.group_send(key, {
+                'type': 'presence_update',
+                'conv_name': self.names.get(key),
+                **{name: sorted(pks) for name, pks in changed.items()},
+            })
+        for key in list(self.names):
+            if key not in self.typing and key not in self.online and key not in self.changes:
+                del self.names[key]
+
+    async def run(self):
+        try:
+            while self.typing or self.online or self.changes:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+        finally:
+            self.flusher = None
+
+
+_coalescers = WeakKeyDictionary()
+
+
+def get_presence(channel_layer):
+    """Coalescer of the running event loop, configured by CHAT_PRESENCE."""
+    loop = asyncio.get_running_loop()
+    if loop not in _coalescers:
+        options = getattr(settings, 'CHAT_PRESENCE', {})
+        _coalescers[loop] = PresenceCoalescer(
+            channel_layer,
+            interval=options.get('INTERVAL', 0.5),
+            typing_timeout=options.get('TYPING_TIMEOUT', 5),
+            heartbeat_timeout=options.get('HEARTBEAT_TIMEOUT', 30),
+        )
+    return _coalescers[loop]
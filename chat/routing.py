@@ -1,8 +1,9 @@
 from django.urls import re_path
  
-from chat.consumers import ChatConsumer
+from chat.consumers import AsyncChatConsumer, MultiplexChatConsumer
  
 websocket_urlpatterns = [
-    re_path("", ChatConsumer.as_asgi()), 
+    re_path(r"^multiplex/$", MultiplexChatConsumer.as_asgi()),
+    re_path("", AsyncChatConsumer.as_asgi()), 
 
 ]
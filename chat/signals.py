@@ -0,0 +1,22 @@
+from django.db.models.signals import m2m_changed, post_delete
+from django.dispatch import receiver
+from chat.conversations import conversation_cache
+from chat.models import Conversation
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def invalidate_participants(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        conversation_cache.invalidate([instance.pk])
+    elif pk_set:
+        conversation_cache.invalidate(pk_set)
+    else:
+        # clearing from the profile side does not report the conversations
+        conversation_cache.clear()
+
+
+@receiver(post_delete, sender=Conversation)
+def invalidate_conversation(sender, instance, **kwargs):
+    conversation_cache.invalidate([instance.pk])
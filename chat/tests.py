@@ -1,3 +1,671 @@
-from django.test import TestCase
+import asyncio
+import os
+import tempfile
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from account.models import UserProfile
+from account.tickets import get_ticket_store
+from chat.buffer import MessageWriteBuffer
+from chat.consumers import AsyncChatConsumer, MultiplexChatConsumer
+from chat.conversations import ResolvedConversation, aresolve_conversation, conversation_cache, resolve_conversation
+from chat.layers import ChannelBroker, UnixSocketChannelLayer
+from chat.metrics import chat_metrics
+from chat.models import Conversation, Message, PREVIEW_LENGTH
+from chat.presence import PresenceCoalescer
+from SocNet.replicas import replicas
+from SocNet.testing import QueryCountMixin
 
-# Create your tests here.
+User = get_user_model()
+
+
+class MessageHistoryTest(APITestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='sender@example.com', username='sender', password='testpass')
+        self.profile = UserProfile.objects.create(user=user)
+        self.conversation = Conversation.objects.create(name='sender.other')
+        self.messages = [
+            Message.objects.create(conversation=self.conversation, from_user=self.profile, content=str(i))
+            for i in range(12)
+        ]
+        self.client.force_authenticate(user=user)
+
+    def test_by_conversation_requires_name(self):
+        response = self.client.get(reverse('messages_by_conversation'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_by_conversation_ignores_participant_order(self):
+        response = self.client.get(reverse('messages_by_conversation'), {'conversation_name': 'other.sender'})
+        self.assertEqual(len(response.data['results']), 5)
+
+    def test_by_conversation_pages_newest_first(self):
+        url = reverse('messages_by_conversation')
+        response = self.client.get(url, {'conversation_name': 'sender.other', 'page_size': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('count', response.data)
+        ids = [message['id'] for message in response.data['results']]
+        self.assertEqual(len(ids), 10)
+        response = self.client.get(response.data['next'])
+        ids += [message['id'] for message in response.data['results']]
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(ids, [message.id for message in reversed(self.messages)])
+
+
+# presence frames would interleave with the ones the tests wait for
+@override_settings(CHAT_PRESENCE={'INTERVAL': 60})
+class AsyncChatConsumerTest(TransactionTestCase):
+    def setUp(self):
+        conversation_cache.clear()
+        for username in ('alice', 'bob'):
+            user = User.objects.create_user(email=f'{username}@example.com', username=username, password='testpass')
+            UserProfile.objects.create(user=user)
+            get_ticket_store().issue(f'ticket-{username}', {'user': user.id, 'socket_for': 'chat'})
+
+    async def connect(self, username, conv_name='alice.bob', query=''):
+        communicator = WebsocketCommunicator(
+            AsyncChatConsumer.as_asgi(), f'/?ticket_uuid=ticket-{username}&conv_name={conv_name}{query}')
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_rejects_unknown_ticket(self):
+        communicator = WebsocketCommunicator(AsyncChatConsumer.as_asgi(), '/?ticket_uuid=missing&conv_name=alice.bob')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_rejects_non_participant(self):
+        user = await database_sync_to_async(User.objects.create_user)(
+            email='eve@example.com', username='eve', password='testpass')
+        await UserProfile.objects.acreate(user=user)
+        get_ticket_store().issue('ticket-eve', {'user': user.id, 'socket_for': 'chat'})
+        alice, _ = await self.connect('alice')
+        await alice.send_json_to({'type': 'form_message', 'message': 'private'})
+        await alice.receive_json_from()
+        eve, connected = await self.connect('eve', query='&since_seq=0')
+        self.assertFalse(connected)
+        self.assertTrue(await eve.receive_nothing())
+        await alice.disconnect()
+
+    async def test_ticket_is_single_use(self):
+        alice, connected = await self.connect('alice')
+        self.assertTrue(connected)
+        replay, connected = await self.connect('alice')
+        self.assertFalse(connected)
+        await alice.disconnect()
+
+    async def test_form_message_is_echoed_to_conversation(self):
+        alice, _ = await self.connect('alice')
+        bob, _ = await self.connect('bob')
+        await alice.send_json_to({'type': 'form_message', 'message': 'hi bob'})
+        for communicator in (alice, bob):
+            event = await communicator.receive_json_from()
+            self.assertEqual(event['type'], 'form_message_echo')
+            self.assertEqual(event['message']['content'], 'hi bob')
+        await alice.disconnect()
+        await bob.disconnect()
+        self.assertEqual(await Message.objects.filter(conversation__name='alice.bob').acount(), 1)
+
+    @override_settings(CHAT_MESSAGE_BUFFER={'MAX_BATCH': 10, 'MAX_DELAY': 0.01})
+    async def test_buffered_message_is_echoed_after_it_is_stored(self):
+        alice, _ = await self.connect('alice')
+        await alice.send_json_to({'type': 'form_message', 'message': 'buffered'})
+        event = await alice.receive_json_from()
+        await alice.disconnect()
+        message = await Message.objects.aget(pk=event['message']['id'])
+        self.assertEqual(message.content, 'buffered')
+
+    @override_settings(CHAT_MESSAGE_BUFFER={'MAX_BATCH': 10, 'MAX_DELAY': 0.01})
+    async def test_buffered_message_pins_sender_to_primary(self):
+        aliases, replicas.aliases = replicas.aliases, ['replica']
+        self.addCleanup(setattr, replicas, 'aliases', aliases)
+        alice, _ = await self.connect('alice')
+        await alice.send_json_to({'type': 'form_message', 'message': 'buffered'})
+        await alice.receive_json_from()
+        await alice.disconnect()
+        user = await User.objects.aget(username='alice')
+        self.assertTrue(await database_sync_to_async(replicas.is_pinned)(user.pk))
+
+    @override_settings(CHAT_BACKFILL_LIMIT=150)
+    async def test_reconnect_replays_missed_messages(self):
+        conversation = await aresolve_conversation('alice.bob')
+        bob = await UserProfile.objects.aget(user__username='bob')
+        await database_sync_to_async(Message.objects.create_batch)([
+            Message(conversation_id=conversation.id, from_user=bob, content=str(i)) for i in range(200)
+        ])
+        alice, _ = await self.connect('alice', query='&since_seq=40')
+        first, second = await alice.receive_json_from(), await alice.receive_json_from()
+        self.assertEqual([message['seq'] for message in first['messages']], list(range(41, 141)))
+        self.assertEqual([message['seq'] for message in second['messages']], list(range(141, 191)))
+        self.assertEqual(await alice.receive_json_from(), {'type': 'backfill_done', 'last_seq': 190, 'truncated': True})
+        await alice.send_json_to({'type': 'form_message', 'message': 'live'})
+        self.assertEqual((await alice.receive_json_from())['message']['seq'], 201)
+        await alice.disconnect()
+
+    async def test_backfilled_echo_is_not_sent_twice(self):
+        alice, _ = await self.connect('alice')
+        await alice.send_json_to({'type': 'form_message', 'message': 'hi'})
+        echo = await alice.receive_json_from()
+        bob, _ = await self.connect('bob', query='&since_seq=0')
+        self.assertEqual((await bob.receive_json_from())['messages'], [echo['message']])
+        self.assertEqual((await bob.receive_json_from())['type'], 'backfill_done')
+        # an echo that was already queued for bob while the replay ran
+        await get_channel_layer().group_send(Conversation.make_key('alice.bob'), echo)
+        self.assertTrue(await bob.receive_nothing())
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_metrics_follow_a_message(self):
+        chat_metrics.reset()
+        alice, _ = await self.connect('alice')
+        bob, _ = await self.connect('bob')
+        await alice.send_json_to({'type': 'form_message', 'message': 'timed'})
+        for communicator in (alice, bob):
+            self.assertNotIn('sent_at', await communicator.receive_json_from())
+        snapshot = chat_metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'connects': 2, 'messages_received': 1, 'echoes': 2})
+        self.assertEqual(snapshot['gauges'], {'sockets': 2, 'subscriptions': 2})
+        self.assertEqual({name: latency['count'] for name, latency in snapshot['latency_ms'].items()},
+                         {'connect': 2, 'db_write': 1, 'group_send': 1, 'delivery': 2})
+        await alice.disconnect()
+        await bob.disconnect()
+        self.assertEqual(chat_metrics.snapshot()['gauges'], {'sockets': 0, 'subscriptions': 0})
+
+
+@override_settings(CHAT_PRESENCE={'INTERVAL': 60})
+class MultiplexChatConsumerTest(TransactionTestCase):
+    def setUp(self):
+        conversation_cache.clear()
+        profiles = {}
+        for username in ('alice', 'bob', 'carol'):
+            user = User.objects.create_user(email=f'{username}@example.com', username=username, password='testpass')
+            profiles[username] = UserProfile.objects.create(user=user)
+        conversation = Conversation.objects.create(name='alice.bob')
+        conversation.participants.add(profiles['alice'], profiles['bob'])
+        self.profiles = profiles
+
+    async def connect(self, username):
+        get_ticket_store().issue(f'multiplex-{username}', {'user': self.profiles[username].pk, 'socket_for': 'chat'})
+        communicator = WebsocketCommunicator(MultiplexChatConsumer.as_asgi(), f'/multiplex/?ticket_uuid=multiplex-{username}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_existing_conversations_are_joined_on_connect(self):
+        alice, bob = await self.connect('alice'), await self.connect('bob')
+        await alice.send_json_to({'type': 'form_message', 'conv_name': 'bob.alice', 'message': 'hi'})
+        for communicator in (alice, bob):
+            event = await communicator.receive_json_from()
+            self.assertEqual(event['type'], 'form_message_echo')
+            self.assertEqual(event['conv_name'], 'alice.bob')
+            self.assertEqual(event['message']['content'], 'hi')
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_subscribe_reaches_other_participants(self):
+        alice, carol = await self.connect('alice'), await self.connect('carol')
+        await alice.send_json_to({'type': 'subscribe', 'conv_name': 'alice.carol'})
+        self.assertEqual((await alice.receive_json_from())['type'], 'subscribed')
+        event = await carol.receive_json_from()
+        self.assertEqual((event['type'], event['conv_name']), ('subscribed', 'alice.carol'))
+        await carol.send_json_to({'type': 'form_message', 'conv_name': 'alice.carol', 'message': 'hey'})
+        self.assertEqual((await alice.receive_json_from())['message']['content'], 'hey')
+        await alice.disconnect()
+        await carol.disconnect()
+
+    async def test_subscribe_since_seq_replays_conversation(self):
+        alice, bob = await self.connect('alice'), await self.connect('bob')
+        for text in ('one', 'two'):
+            await alice.send_json_to({'type': 'form_message', 'conv_name': 'alice.bob', 'message': text})
+            await alice.receive_json_from()
+            await bob.receive_json_from()
+        await bob.send_json_to({'type': 'subscribe', 'conv_name': 'alice.bob', 'since_seq': 1})
+        self.assertEqual((await bob.receive_json_from())['type'], 'subscribed')
+        frame = await bob.receive_json_from()
+        self.assertEqual((frame['type'], frame['conv_name']), ('backfill', 'alice.bob'))
+        self.assertEqual([message['content'] for message in frame['messages']], ['two'])
+        done = await bob.receive_json_from()
+        self.assertEqual((done['type'], done['last_seq'], done['truncated']), ('backfill_done', 2, False))
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_rejects_foreign_and_unsubscribed_conversations(self):
+        carol = await self.connect('carol')
+        await carol.send_json_to({'type': 'subscribe', 'conv_name': 'alice.bob'})
+        self.assertEqual((await carol.receive_json_from())['type'], 'error')
+        await carol.send_json_to({'type': 'form_message', 'conv_name': 'alice.bob', 'message': 'spam'})
+        self.assertEqual((await carol.receive_json_from())['type'], 'error')
+        await carol.disconnect()
+        self.assertEqual(await Message.objects.acount(), 0)
+
+    async def test_subscribe_checks_database_not_stale_cache(self):
+        # what another worker may still hold after the participants changed
+        conversation = await Conversation.objects.aget(name='alice.bob')
+        conversation_cache.set(ResolvedConversation(
+            id=conversation.id, key=conversation.key, name=conversation.name,
+            participants=frozenset({self.profiles['alice'].pk, self.profiles['carol'].pk})))
+        carol, bob = await self.connect('carol'), await self.connect('bob')
+        await carol.send_json_to({'type': 'subscribe', 'conv_name': 'alice.bob'})
+        self.assertEqual((await carol.receive_json_from())['type'], 'error')
+        await bob.send_json_to({'type': 'subscribe', 'conv_name': 'alice.bob'})
+        self.assertEqual((await bob.receive_json_from())['type'], 'subscribed')
+        await carol.disconnect()
+        await bob.disconnect()
+
+    async def test_unsubscribe_stops_delivery(self):
+        alice, bob = await self.connect('alice'), await self.connect('bob')
+        await bob.send_json_to({'type': 'unsubscribe', 'conv_name': 'alice.bob'})
+        self.assertEqual((await bob.receive_json_from())['type'], 'unsubscribed')
+        await alice.send_json_to({'type': 'form_message', 'conv_name': 'alice.bob', 'message': 'hi'})
+        await alice.receive_json_from()
+        self.assertTrue(await bob.receive_nothing())
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class RecordingLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+class PresenceTest(TransactionTestCase):
+    def setUp(self):
+        # the flush reuses the ids of earlier tests' conversations
+        conversation_cache.clear()
+        self.conversation = ResolvedConversation(id=1, key='room', name='alice.bob', participants=frozenset({1, 2}))
+        self.layer = RecordingLayer()
+
+    def frames(self):
+        return [{key: value for key, value in message.items() if value} for _, message in self.layer.sent]
+
+    async def test_keystrokes_are_coalesced(self):
+        presence = PresenceCoalescer(self.layer, interval=0.01)
+        presence.join(self.conversation, 1)
+        for _ in range(50):
+            presence.start_typing(self.conversation, 1)
+            presence.start_typing(self.conversation, 2)
+        await presence.flush()
+        for _ in range(50):
+            presence.start_typing(self.conversation, 1)
+        presence.stop_typing(self.conversation, 2)
+        await presence.flush()
+        self.assertEqual(self.frames(), [
+            {'type': 'presence_update', 'conv_name': 'alice.bob', 'typing': [1, 2], 'online': [1]},
+            {'type': 'presence_update', 'conv_name': 'alice.bob', 'stopped_typing': [2]},
+        ])
+
+    async def test_changes_undone_within_an_interval_are_not_sent(self):
+        presence = PresenceCoalescer(self.layer)
+        presence.join(self.conversation, 1)
+        await presence.flush()
+        presence.start_typing(self.conversation, 1)
+        presence.stop_typing(self.conversation, 1)
+        await presence.flush()
+        self.assertEqual(len(self.layer.sent), 1)
+
+    async def test_typing_and_heartbeat_expire(self):
+        presence = PresenceCoalescer(self.layer, typing_timeout=0.01, heartbeat_timeout=0.1)
+        presence.join(self.conversation, 1)
+        presence.join(self.conversation, 2)
+        presence.start_typing(self.conversation, 1)
+        await presence.flush()
+        await asyncio.sleep(0.06)
+        presence.heartbeat(self.conversation, 2)
+        await presence.flush()
+        await asyncio.sleep(0.06)
+        await presence.flush()
+        self.assertEqual(self.frames()[1:], [
+            {'type': 'presence_update', 'conv_name': 'alice.bob', 'stopped_typing': [1]},
+            {'type': 'presence_update', 'conv_name': 'alice.bob', 'offline': [1]},
+        ])
+        self.assertEqual(presence.typing, {})
+
+    async def test_offline_after_last_socket_leaves(self):
+        presence = PresenceCoalescer(self.layer)
+        presence.join(self.conversation, 1)
+        presence.join(self.conversation, 1)
+        await presence.flush()
+        presence.leave(self.conversation, 1)
+        await presence.flush()
+        presence.leave(self.conversation, 1)
+        await presence.flush()
+        self.assertEqual(self.frames()[1:], [{'type': 'presence_update', 'conv_name': 'alice.bob', 'offline': [1]}])
+
+    @override_settings(CHAT_PRESENCE={'INTERVAL': 0.01})
+    async def test_typing_reaches_conversation(self):
+        for username in ('alice', 'bob'):
+            user = await database_sync_to_async(User.objects.create_user)(
+                email=f'{username}@example.com', username=username, password='testpass')
+            await UserProfile.objects.acreate(user=user)
+            get_ticket_store().issue(f'presence-{username}', {'user': user.id, 'socket_for': 'chat'})
+        alice = WebsocketCommunicator(AsyncChatConsumer.as_asgi(), '/?ticket_uuid=presence-alice&conv_name=alice.bob')
+        await alice.connect()
+        alice_pk = (await UserProfile.objects.aget(user__username='alice')).pk
+        self.assertEqual((await alice.receive_json_from())['online'], [alice_pk])
+        bob = WebsocketCommunicator(AsyncChatConsumer.as_asgi(), '/?ticket_uuid=presence-bob&conv_name=alice.bob')
+        await bob.connect()
+        await bob.receive_json_from()
+        await alice.receive_json_from()
+        for _ in range(20):
+            await alice.send_json_to({'type': 'typing'})
+        event = await bob.receive_json_from()
+        self.assertEqual((event['type'], event['typing']), ('presence_update', [alice_pk]))
+        self.assertTrue(await bob.receive_nothing())
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class MessageWriteBufferTest(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='sender@example.com', username='sender', password='testpass')
+        self.profile = UserProfile.objects.create(user=user)
+        self.conversation = Conversation.objects.create(name='sender')
+
+    def message(self, content):
+        return Message(conversation=self.conversation, from_user=self.profile, content=content)
+
+    async def test_flushes_when_batch_is_full(self):
+        buffer = MessageWriteBuffer(max_batch=3, max_delay=60)
+        messages = await asyncio.gather(*(buffer.write(self.message(str(i))) for i in range(3)))
+        self.assertTrue(all(message.pk for message in messages))
+        self.assertEqual(await Message.objects.acount(), 3)
+
+    async def test_flushes_after_delay(self):
+        buffer = MessageWriteBuffer(max_batch=100, max_delay=0.01)
+        message = await buffer.write(self.message('late'))
+        self.assertIsNotNone(message.pk)
+        self.assertIsNotNone(message.timestamp)
+
+    async def test_cancelled_writer_does_not_block_batch(self):
+        buffer = MessageWriteBuffer(max_batch=100, max_delay=0.05)
+        first = asyncio.ensure_future(buffer.write(self.message('gone')))
+        second = asyncio.ensure_future(buffer.write(self.message('waiting')))
+        await asyncio.sleep(0)
+        first.cancel()
+        message = await asyncio.wait_for(second, 5)
+        self.assertEqual(message.content, 'waiting')
+        self.assertTrue(first.cancelled())
+        self.assertEqual(await Message.objects.acount(), 2)
+
+
+class UnixSocketChannelLayerTest(TestCase):
+    async def start_broker(self, **broker_options):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'channels.sock')
+        self.broker = ChannelBroker(**broker_options)
+        await self.broker.serve(self.path)
+        # two layers with their own sockets stand in for two worker processes
+        self.first = UnixSocketChannelLayer(path=self.path)
+        self.second = UnixSocketChannelLayer(path=self.path)
+
+    async def stop_broker(self):
+        await self.first.close()
+        await self.second.close()
+        await self.broker.close()
+        self.tmpdir.cleanup()
+
+    async def test_send_reaches_other_process(self):
+        await self.start_broker()
+        try:
+            channel = await self.second.new_channel()
+            receiving = asyncio.ensure_future(self.second.receive(channel))
+            await self.first.send(channel, {'type': 'hello', 'n': 1})
+            self.assertEqual(await asyncio.wait_for(receiving, 1), {'type': 'hello', 'n': 1})
+        finally:
+            await self.stop_broker()
+
+    async def test_group_send_reaches_every_process(self):
+        await self.start_broker()
+        try:
+            channels = [await self.first.new_channel(), await self.second.new_channel()]
+            await self.first.group_add('chat', channels[0])
+            await self.second.group_add('chat', channels[1])
+            await self.first.group_send('chat', {'type': 'echo'})
+            self.assertEqual(await self.first.receive(channels[0]), {'type': 'echo'})
+            self.assertEqual(await self.second.receive(channels[1]), {'type': 'echo'})
+
+            await self.second.group_discard('chat', channels[1])
+            await self.second.group_send('chat', {'type': 'again'})
+            self.assertEqual(await self.first.receive(channels[0]), {'type': 'again'})
+            self.assertNotIn(channels[1], self.broker.queues)
+        finally:
+            await self.stop_broker()
+
+    async def test_capacity(self):
+        await self.start_broker(capacity=2)
+        try:
+            channel = await self.second.new_channel()
+            await self.first.group_add('chat', channel)
+            await self.first.send(channel, {'type': 'one'})
+            await self.first.send(channel, {'type': 'two'})
+            with self.assertRaises(ChannelFull):
+                await self.first.send(channel, {'type': 'three'})
+            # group sends drop messages for full channels silently
+            await self.first.group_send('chat', {'type': 'three'})
+            self.assertEqual(await self.second.receive(channel), {'type': 'one'})
+            self.assertEqual(await self.second.receive(channel), {'type': 'two'})
+        finally:
+            await self.stop_broker()
+
+    async def test_expired_message_removes_channel_from_groups(self):
+        await self.start_broker(expiry=0.01, sweep_interval=0.01)
+        try:
+            channel = await self.second.new_channel()
+            idle = await self.second.new_channel()
+            await self.first.group_add('chat', channel)
+            await self.first.group_add('chat', idle)
+            await self.first.group_add('lobby', channel)
+            await self.first.send(channel, {'type': 'lost'})
+            await asyncio.sleep(0.05)
+            self.assertEqual(self.broker.queues, {})
+            self.assertEqual(list(self.broker.groups), ['chat'])
+            self.assertEqual(self.broker.memberships, {idle: {'chat'}})
+        finally:
+            await self.stop_broker()
+
+    async def test_stats_report_queue_depth(self):
+        await self.start_broker()
+        try:
+            channel = await self.second.new_channel()
+            await self.second.group_add('chat', channel)
+            await self.first.group_send('chat', {'type': 'one'})
+            await self.first.group_send('chat', {'type': 'two'})
+            self.assertEqual(await self.first.stats(), {
+                'channels': 1, 'queued': 2, 'deepest': [{'channel': channel, 'depth': 2}],
+                'groups': 1, 'waiting_receives': 0,
+            })
+        finally:
+            await self.stop_broker()
+
+    async def test_cancelled_receive_gives_message_back(self):
+        await self.start_broker()
+        try:
+            channel = await self.second.new_channel()
+            receiving = asyncio.ensure_future(self.second.receive(channel))
+            await asyncio.sleep(0.01)
+            receiving.cancel()
+            await self.first.send(channel, {'type': 'kept'})
+            self.assertEqual(await asyncio.wait_for(self.second.receive(channel), 1), {'type': 'kept'})
+        finally:
+            await self.stop_broker()
+
+
+class ChatMetricsViewTest(APITestCase):
+    def test_metrics_are_admin_only(self):
+        user = User.objects.create_user(email='member@example.com', username='member', password='testpass')
+        self.client.force_authenticate(user=user)
+        self.assertEqual(self.client.get(reverse('chat_metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        admin = User.objects.create_superuser(email='admin@example.com', username='admin', password='testpass')
+        self.client.force_authenticate(user=admin)
+        response = self.client.get(reverse('chat_metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data), {'counters', 'gauges', 'latency_ms', 'channel_layer'})
+        self.assertIn('queued', response.data['channel_layer'])
+
+
+class InboxTest(APITestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = [
+            UserProfile.objects.create(
+                user=User.objects.create_user(email=f'{name}@example.com', username=name, password='testpass'))
+            for name in ('alice', 'bob', 'carol')
+        ]
+        self.with_bob = Conversation.objects.create(name='alice.bob')
+        self.with_bob.participants.add(self.alice, self.bob)
+        self.with_carol = Conversation.objects.create(name='alice.carol')
+        self.with_carol.participants.add(self.alice, self.carol)
+        self.client.force_authenticate(user=self.alice.user)
+
+    def inbox(self):
+        return self.client.get(reverse('conversation-inbox')).data['results']
+
+    def test_message_updates_last_message_and_unread_counts(self):
+        Message.objects.create(conversation=self.with_bob, from_user=self.bob, content='hi alice')
+        last = Message.objects.create(conversation=self.with_bob, from_user=self.alice, content='hi bob ' * 30)
+        counts = dict(self.with_bob.memberships.values_list('profile', 'unread_count'))
+        self.assertEqual(counts, {self.alice.pk: 1, self.bob.pk: 1})
+
+        first = self.inbox()[0]
+        self.assertEqual(first['conversation'], self.with_bob.pk)
+        self.assertEqual(first['unread_count'], 1)
+        self.assertEqual(first['last_message']['id'], last.pk)
+        self.assertEqual(first['last_message']['from_user'], self.alice.pk)
+        self.assertEqual(len(first['last_message']['preview']), PREVIEW_LENGTH)
+
+    def test_inbox_is_ordered_by_last_activity(self):
+        Message.objects.create(conversation=self.with_bob, from_user=self.bob, content='first')
+        Message.objects.create(conversation=self.with_carol, from_user=self.carol, content='second')
+        self.assertEqual([item['conversation'] for item in self.inbox()], [self.with_carol.pk, self.with_bob.pk])
+        self.client.force_authenticate(user=self.bob.user)
+        self.assertEqual([item['conversation'] for item in self.inbox()], [self.with_bob.pk])
+
+    def test_inbox_reads_participants_without_profile_join(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.inbox()
+        self.assertNotIn('account_userprofile', queries[0]['sql'])
+
+    def test_sequence_numbers_are_per_conversation(self):
+        Message.objects.create(conversation=self.with_bob, from_user=self.bob, content='a')
+        Message.objects.create_batch([
+            Message(conversation=conversation, from_user=self.alice, content='b')
+            for conversation in (self.with_carol, self.with_bob, self.with_bob)
+        ])
+        Message(conversation=self.with_carol, from_user=self.carol, content='c').save()
+        self.assertEqual(list(self.with_bob.messages.order_by('pk').values_list('seq', flat=True)), [1, 2, 3])
+        self.assertEqual(list(self.with_carol.messages.order_by('pk').values_list('seq', flat=True)), [1, 2])
+        self.with_bob.refresh_from_db()
+        self.assertEqual(self.with_bob.last_seq, 3)
+
+    def test_batch_counts_messages_of_others(self):
+        Message.objects.create_batch([
+            Message(conversation=self.with_bob, from_user=sender, content=str(i))
+            for i, sender in enumerate([self.bob, self.bob, self.alice, self.bob])
+        ])
+        counts = dict(self.with_bob.memberships.values_list('profile', 'unread_count'))
+        self.assertEqual(counts, {self.alice.pk: 3, self.bob.pk: 1})
+
+    def test_read_marker(self):
+        messages = [
+            Message.objects.create(conversation=self.with_bob, from_user=self.bob, content=str(i)) for i in range(3)
+        ]
+        url = reverse('conversation-read', args=[self.with_bob.pk])
+        response = self.client.post(url, {'message': messages[0].pk}, format='json')
+        self.assertEqual(response.data, {'unread_count': 2, 'last_read_message': messages[0].pk})
+        response = self.client.post(url)
+        self.assertEqual(response.data, {'unread_count': 0, 'last_read_message': messages[2].pk})
+        # an older marker does not move it back
+        response = self.client.post(url, {'message': messages[1].pk}, format='json')
+        self.assertEqual(response.data, {'unread_count': 0, 'last_read_message': messages[2].pk})
+
+    def test_read_marker_rejects_foreign_conversations_and_messages(self):
+        other = Conversation.objects.create(name='bob.carol')
+        other.participants.add(self.bob, self.carol)
+        message = Message.objects.create(conversation=other, from_user=self.bob, content='private')
+        response = self.client.post(reverse('conversation-read', args=[other.pk]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post(reverse('conversation-read', args=[self.with_bob.pk]), {'message': message.pk}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ResolveConversationTest(TestCase):
+    def setUp(self):
+        conversation_cache.clear()
+        for username in ('alice', 'bob', 'carol'):
+            user = User.objects.create_user(email=f'{username}@example.com', username=username, password='testpass')
+            UserProfile.objects.create(user=user)
+
+    def test_participant_order_does_not_matter(self):
+        first = resolve_conversation('alice.bob')
+        self.assertEqual(resolve_conversation('bob.alice').id, first.id)
+        self.assertEqual(Conversation.objects.count(), 1)
+        self.assertEqual(len(first.participants), 2)
+
+    def test_cached_resolution_skips_database(self):
+        resolve_conversation('alice.bob')
+        with self.assertNumQueries(0):
+            resolve_conversation('bob.alice')
+
+    def test_entries_expire(self):
+        conversation_cache.ttl = 0
+        self.addCleanup(setattr, conversation_cache, 'ttl', 30)
+        resolve_conversation('alice.bob')
+        with self.assertNumQueries(2):
+            resolve_conversation('alice.bob')
+
+    def test_participant_change_invalidates_cache(self):
+        entry = resolve_conversation('alice.bob')
+        carol = UserProfile.objects.get(user__username='carol')
+        Conversation.objects.get(pk=entry.id).participants.add(carol)
+        self.assertIn(carol.pk, resolve_conversation('alice.bob').participants)
+
+
+class ChatQueryCountTest(QueryCountMixin, APITestCase):
+    """Sizes are the conversations of member0, the participants besides member0
+    and the messages of the last one."""
+
+    def populate(self, size):
+        User.objects.all().delete()
+        Conversation.objects.all().delete()
+        profiles = [
+            UserProfile.objects.create(
+                user=User.objects.create_user(email=f'member{i}@example.com', username=f'member{i}', password='testpass'))
+            for i in range(size + 1)
+        ]
+        for profile in profiles[1:]:
+            conversation = Conversation.objects.create(name=f'member0.{profile.user.username}')
+            conversation.participants.add(profiles[0], profile)
+        # the last one has `size` participants besides member0 and `size` messages
+        conversation.participants.add(*profiles[1:])
+        for i in range(size):
+            Message.objects.create(conversation=conversation, from_user=profiles[i], content=str(i))
+        self.conversation = conversation
+        self.client.force_authenticate(user=profiles[0].user)
+
+    def test_conversation_list(self):
+        self.assertSameQueries(3, lambda: self.client.get(reverse('conversation-list')))
+
+    def test_conversation_retrieve(self):
+        self.assertSameQueries(
+            2, lambda: self.client.get(reverse('conversation-detail', args=[self.conversation.pk])),
+            lambda response: len(response.data['participants']) - 1)
+
+    def test_message_list(self):
+        self.assertSameQueries(
+            1, lambda: self.client.get(reverse('message-list'), {'page_size': 10}))
+
+    def test_by_conversation(self):
+        self.assertSameQueries(
+            1, lambda: self.client.get(
+                reverse('messages_by_conversation'), {'conversation_name': self.conversation.name, 'page_size': 10}))
+
+    def test_inbox(self):
+        self.assertSameQueries(1, lambda: self.client.get(reverse('conversation-inbox')))
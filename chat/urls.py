@@ -1,4 +1,4 @@
-from chat.views import ConversationViewSet, MessageViewSet
+from chat.views import ConversationViewSet, MessageViewSet, ChatMetricsView
 from django.urls import path, include
 from rest_framework import routers
 
@@ -7,6 +7,7 @@ router.register(r'messages', MessageViewSet)
 router.register(r'conversations', ConversationViewSet)
 
 urlpatterns = [
+    path('metrics', ChatMetricsView.as_view(), name='chat_metrics'),
     path('', include(router.urls)),
     path('messages/by_conversation/', MessageViewSet.as_view({'get': 'by_conversation'}), name='messages_by_conversation')
-]
\ No newline at end of file
+]
\ No newline at end of file
@@ -1,22 +1,61 @@
-from rest_framework_simplejwt.authentication import JWTAuthentication
-from rest_framework.permissions import IsAuthenticated
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from account.authentication import CachedJWTAuthentication
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
-from chat.api.serializers import MessageSerializer, ConversationSerializer
-from chat.models import Message, Conversation
+from rest_framework.views import APIView
+from chat.api.serializers import MessageSerializer, ConversationSerializer, InboxSerializer, ReadMarkerSerializer
+from chat.api.paginators import MessagePagination, InboxPagination
+from chat.conversations import mark_read
+from chat.metrics import chat_metrics, layer_stats
+from chat.models import Message, Conversation, Participant
 from rest_framework import viewsets 
 from rest_framework.decorators import action
 from rest_framework.parsers import  FormParser, JSONParser
 from rest_framework import status
+from rest_framework.exceptions import NotFound, ValidationError
+from django.db.models import Prefetch
+from account.models import UserProfile
+from SocNet.replicas import ReplicaReadMixin
 
 class ConversationViewSet(viewsets.ModelViewSet):
-    authentication_classes = (JWTAuthentication, )
+    authentication_classes = (CachedJWTAuthentication, )
     permission_classes = (IsAuthenticated, )
     parser_classes = (JSONParser, FormParser)
-    queryset = Conversation.objects.all()
+    queryset = Conversation.objects.prefetch_related(
+        Prefetch('participants', queryset=UserProfile.objects.only('user'))
+    )
     serializer_class = ConversationSerializer
 
-class MessageViewSet(viewsets.ModelViewSet):
-    authentication_classes = (JWTAuthentication, )
+    @action(detail=False, methods=['get'], pagination_class=InboxPagination)
+    def inbox(self, request):
+        queryset = Participant.objects.filter(profile_id=request.user.pk).select_related('conversation')
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(InboxSerializer(page, many=True).data)
+
+    @action(detail=True, methods=['post'])
+    def read(self, request, pk=None):
+        serializer = ReadMarkerSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        participant = Participant.objects.filter(
+            conversation_id=pk, profile_id=request.user.pk).select_related('conversation').first()
+        if participant is None:
+            raise NotFound('Conversation not found')
+        message_id = serializer.validated_data.get('message')
+        if message_id is None:
+            message_id = participant.conversation.last_message_id
+        elif not Message.objects.filter(pk=message_id, conversation_id=pk).exists():
+            raise ValidationError({'message': 'Message is not part of this conversation'})
+        if message_id is not None:
+            mark_read(participant, message_id)
+        return Response({
+            'unread_count': participant.unread_count,
+            'last_read_message': participant.last_read_message_id,
+        })
+
+class MessageViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
+    pagination_class = MessagePagination
+    authentication_classes = (CachedJWTAuthentication, )
     permission_classes = (IsAuthenticated, )
     parser_classes = (JSONParser, FormParser)
     queryset = Message.objects.all()
@@ -27,7 +66,17 @@ class MessageViewSet(viewsets.ModelViewSet):
         conversation_name = request.query_params.get('conversation_name')
         if not conversation_name:
             return Response({'error': 'conversation_name is required'}, status=400)
-        queryset = self.get_queryset().filter(conversation__name=conversation_name)
+        queryset = self.get_queryset().filter(conversation__key=Conversation.make_key(conversation_name))
         page = self.paginate_queryset(queryset)
         serializer = self.get_serializer(page, many=True)
         return self.get_paginated_response(serializer.data)
+
+class ChatMetricsView(APIView):
+    """Websocket counters and latencies of this process, see chat/metrics.py."""
+    authentication_classes = (CachedJWTAuthentication, )
+    permission_classes = (IsAdminUser, )
+
+    def get(self, request):
+        snapshot = chat_metrics.snapshot()
+        snapshot['channel_layer'] = async_to_sync(layer_stats)(get_channel_layer())
+        return Response(snapshot)
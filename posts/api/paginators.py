@@ -0,0 +1,5 @@
+from rest_framework.pagination import CursorPagination
+
+
+class PostPagination(CursorPagination):
+    ordering = ('-created_at', '-id')
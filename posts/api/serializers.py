@@ -1,14 +1,17 @@
 from rest_framework import serializers
+from SocNet.timing import TimedSerializerMixin
 from posts.models import Post
 from account.models import UserProfile
+from SocNet.images import ImageVariantsField
 
-class PostSerializer(serializers.ModelSerializer):
-    author = serializers.ReadOnlyField(source='author.id')
+class PostSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    author = serializers.ReadOnlyField(source='author_id')
     image=serializers.ImageField(required=False)
+    image_variants = ImageVariantsField(source='image')
     
     class Meta:
         model = Post
-        fields = ['id', 'author', 'text_content', "image", 'created_at']
+        fields = ['id', 'author', 'text_content', "image", 'image_variants', 'created_at']
     
     def perform_create(self, serializer):
         serializer.save(author=UserProfile.objects.get(user=self.request.user))
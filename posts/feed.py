@@ -0,0 +1,83 @@
+from heapq import merge
+from itertools import islice
+from django.conf import settings
+from account.models import Friendship, UserProfile
+from posts.models import Post, TimelineEntry
+
+
+def get_fanout_limit():
+    return getattr(settings, 'FEED_FANOUT_LIMIT', 1000)
+
+
+def followers_for_fan_out(author):
+    """Ids of the profiles that have `author` as a friend, or None when there are
+    too many of them to write a timeline entry for each one."""
+    limit = get_fanout_limit()
+    followers = list(Friendship.objects.filter(to_profile=author).values_list('from_profile_id', flat=True)[:limit + 1])
+    if len(followers) > limit:
+        return None
+    return followers
+
+
+def mark_popular(author):
+    """Sends the feed readers of `author` to the fan-in query, called for a post that was not fanned out."""
+    UserProfile.objects.filter(pk=author.pk, popular=False).update(popular=True)
+
+
+def fan_out(post, followers):
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(owner_id=follower, post=post) for follower in followers],
+        ignore_conflicts=True,
+    )
+
+
+def backfill_timelines(pairs, batch_size=1000):
+    """Timeline entries of the fanned-out posts of `to` for each new (from, to)
+    friendship. Posts that were not fanned out come in through the fan-in query."""
+    owners_of = {}
+    for owner, author in pairs:
+        owners_of.setdefault(author, []).append(owner)
+    posts = Post.objects.filter(author__in=owners_of, fanned_out=True).order_by().values_list('pk', 'author_id')
+    entries = []
+    for post, author in posts.iterator(chunk_size=batch_size):
+        entries.extend(TimelineEntry(owner_id=owner, post_id=post) for owner in owners_of[author])
+        if len(entries) >= batch_size:
+            TimelineEntry.objects.bulk_create(entries, ignore_conflicts=True)
+            entries = []
+    TimelineEntry.objects.bulk_create(entries, ignore_conflicts=True)
+
+
+def prune_timelines(pairs):
+    """Drops the posts of `to` from the timeline of `from` for each ended friendship."""
+    authors_of = {}
+    for owner, author in pairs:
+        authors_of.setdefault(owner, []).append(author)
+    for owner, authors in authors_of.items():
+        TimelineEntry.objects.filter(owner_id=owner, post__author_id__in=authors).delete()
+
+
+def get_feed_page(profile, before=None, size=10):
+    """Newest-first page of posts written by the friends of `profile`.
+
+    Posts that were fanned out are read from the timeline of `profile`, posts of
+    authors with too many followers are pulled in with a fan-in query. That one
+    only looks at the friends of `profile` that are popular, found by probing
+    its friendships with the few popular profiles. Both are keyset lookups on
+    the post id, so the cost does not depend on the page number.
+    Returns the posts and the cursor of the next page (None on the last page).
+    """
+    entries = TimelineEntry.objects.filter(owner=profile).select_related('post')
+    popular_friends = Friendship.objects.filter(
+        from_profile=profile, to_profile__in=UserProfile.objects.filter(popular=True).values('pk'))
+    fan_in = Post.objects.filter(author__in=popular_friends.values('to_profile'), fanned_out=False)
+    if before is not None:
+        entries = entries.filter(post_id__lt=before)
+        fan_in = fan_in.filter(id__lt=before)
+
+    fanned_out_posts = [entry.post for entry in entries.order_by('-post_id')[:size + 1]]
+    fan_in_posts = list(fan_in.order_by('-id')[:size + 1])
+    posts = list(islice(merge(fanned_out_posts, fan_in_posts, key=lambda post: post.id, reverse=True), size + 1))
+
+    if len(posts) > size:
+        return posts[:size], posts[size - 1].id
+    return posts, None
@@ -10,6 +10,24 @@ class Post(models.Model):
     text_content = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     image = models.ImageField(upload_to='posts_pics', null=True, blank=True)
+    # False when the author had too many followers to fan the post out on write,
+    # feeds then pull it in with a fan-in query instead.
+    fanned_out = models.BooleanField(default=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['author', 'created_at', 'id'], name='post_author_created_idx'),
+            models.Index(fields=['author', 'fanned_out', 'id'], name='post_author_fanout_idx'),
+        ]
+
+
+class TimelineEntry(models.Model):
+    owner = models.ForeignKey(to=UserProfile, on_delete=models.CASCADE, related_name="timeline")
+    post = models.ForeignKey(to=Post, on_delete=models.CASCADE, related_name="timeline_entries")
+
+    class Meta:
+        verbose_name_plural = 'Timeline entries'
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'post'], name='timeline_owner_post_uniq'),
+        ]
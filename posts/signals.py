@@ -0,0 +1,19 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from account.friendships import friendships_changed
+from posts.feed import backfill_timelines, prune_timelines
+from posts.models import Post
+from SocNet.images import schedule_variants
+
+
+@receiver(post_save, sender=Post)
+def render_post_image(sender, instance, **kwargs):
+    schedule_variants(instance.image)
+
+
+@receiver(friendships_changed)
+def follow_friendships(sender, added=(), removed=(), **kwargs):
+    if added:
+        backfill_timelines(added)
+    if removed:
+        prune_timelines(removed)
@@ -0,0 +1,198 @@
+import os
+import shutil
+import tempfile
+from PIL import Image
+from django.contrib.auth import get_user_model
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from account.friendships import add_friends, remove_friends
+from account.models import UserProfile
+from posts.models import Post, TimelineEntry
+from SocNet.images import VARIANTS, FORMATS, image_version, render_variants, variant_name
+from SocNet.testing import QueryCountMixin
+
+User = get_user_model()
+
+
+class FeedTest(APITestCase):
+    def setUp(self):
+        self.reader = self.create_profile('reader')
+        self.friend = self.create_profile('friend')
+        self.stranger = self.create_profile('stranger')
+        self.reader.friends.add(self.friend)
+
+    def create_profile(self, username):
+        user = User.objects.create_user(email=f'{username}@example.com', username=username, password='testpass')
+        return UserProfile.objects.create(user=user)
+
+    def create_post(self, profile, text):
+        self.client.force_authenticate(user=profile.user)
+        response = self.client.post(reverse('posts-list'), {'text_content': text})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return Post.objects.get(pk=response.data['id'])
+
+    def get_feed(self, **params):
+        self.client.force_authenticate(user=self.reader.user)
+        return self.client.get(reverse('posts-feed'), params)
+
+    def test_create_fans_out_to_followers(self):
+        post = self.create_post(self.friend, 'hello')
+        self.assertTrue(post.fanned_out)
+        self.assertTrue(TimelineEntry.objects.filter(owner=self.reader, post=post).exists())
+        self.assertFalse(TimelineEntry.objects.filter(owner=self.stranger).exists())
+
+    def test_feed_contains_only_friends_posts_newest_first(self):
+        first = self.create_post(self.friend, 'first')
+        self.create_post(self.stranger, 'not a friend')
+        second = self.create_post(self.friend, 'second')
+        response = self.get_feed()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([post['id'] for post in response.data['results']], [second.id, first.id])
+        self.assertIsNone(response.data['next'])
+
+    def test_feed_pages_with_before_cursor(self):
+        posts = [self.create_post(self.friend, str(i)) for i in range(12)]
+        response = self.get_feed()
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertIsNotNone(response.data['next'])
+        response = self.get_feed(before=posts[2].id)
+        self.assertEqual([post['id'] for post in response.data['results']], [posts[1].id, posts[0].id])
+
+    @override_settings(FEED_FANOUT_LIMIT=0)
+    def test_feed_falls_back_to_fan_in_for_popular_authors(self):
+        post = self.create_post(self.friend, 'popular')
+        self.friend.friends.add(self.stranger)
+        self.create_post(self.stranger, 'popular, not a friend of the reader')
+        self.assertFalse(post.fanned_out)
+        self.assertFalse(TimelineEntry.objects.exists())
+        self.assertEqual(set(UserProfile.objects.filter(popular=True)), {self.friend, self.stranger})
+        response = self.get_feed()
+        self.assertEqual([post['id'] for post in response.data['results']], [post.id])
+
+    def test_unfriended_author_leaves_feed(self):
+        post = self.create_post(self.friend, 'before the split')
+        remove_friends(self.reader.pk, [self.friend.pk])
+        self.assertFalse(TimelineEntry.objects.filter(owner=self.reader, post=post).exists())
+        self.assertEqual(self.get_feed().data['results'], [])
+        # through the m2m manager as well
+        add_friends(self.reader.pk, [self.friend.pk])
+        self.reader.friends.remove(self.friend)
+        self.assertEqual(self.get_feed().data['results'], [])
+
+    def test_new_friend_posts_are_backfilled(self):
+        post = self.create_post(self.stranger, 'from before')
+        self.assertTrue(post.fanned_out)
+        add_friends(self.reader.pk, [self.stranger.pk])
+        self.assertEqual([item['id'] for item in self.get_feed().data['results']], [post.id])
+        self.reader.friends.clear()
+        self.assertEqual(self.get_feed().data['results'], [])
+        # through the m2m manager as well
+        self.reader.friends.add(self.stranger)
+        self.assertEqual([item['id'] for item in self.get_feed().data['results']], [post.id])
+
+    def test_feed_rejects_invalid_cursor(self):
+        response = self.get_feed(before='abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ByAuthorPaginationTest(APITestCase):
+    def setUp(self):
+        user = User.objects.create_user(email='author@example.com', username='author', password='testpass')
+        self.author = UserProfile.objects.create(user=user)
+        self.posts = [Post.objects.create(author=self.author, text_content=str(i)) for i in range(15)]
+        self.client.force_authenticate(user=user)
+
+    def test_by_author_walks_pages_with_cursor(self):
+        response = self.client.get(reverse('posts-by-author', args=[self.author.pk]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('count', response.data)
+        ids = [post['id'] for post in response.data['results']]
+        response = self.client.get(response.data['next'])
+        ids += [post['id'] for post in response.data['results']]
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(ids, [post.id for post in reversed(self.posts)])
+
+
+class ImageVariantsTest(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        os.makedirs(os.path.join(self.media_root, 'posts_pics'))
+        Image.new('RGB', (2000, 1000), 'red').save(os.path.join(self.media_root, 'posts_pics', 'wide.png'))
+
+    def version(self, name):
+        return image_version(os.path.getmtime(os.path.join(self.media_root, name)))
+
+    def test_render_variants_fits_every_size(self):
+        render_variants(self.media_root, 'posts_pics/wide.png')
+        version = self.version('posts_pics/wide.png')
+        for variant, (width, height) in VARIANTS.items():
+            for fmt in FORMATS:
+                name = variant_name('posts_pics/wide.png', version, variant, fmt)
+                with Image.open(os.path.join(self.media_root, name)) as image:
+                    self.assertLessEqual(image.width, width)
+                    self.assertLessEqual(image.height, height)
+                    self.assertEqual(image.width, 2 * image.height)
+
+    def test_variants_follow_extension_and_reupload(self):
+        Image.new('RGB', (100, 100), 'blue').save(os.path.join(self.media_root, 'posts_pics', 'wide.jpg'))
+        render_variants(self.media_root, 'posts_pics/wide.png')
+        render_variants(self.media_root, 'posts_pics/wide.jpg')
+        old = os.path.join(self.media_root, variant_name('posts_pics/wide.png', self.version('posts_pics/wide.png'), 'full', 'jpeg'))
+        with Image.open(old) as image:
+            self.assertEqual(image.size, (1600, 800))
+        # a re-upload under the same name gets its own variants, the old ones are removed
+        path = os.path.join(self.media_root, 'posts_pics', 'wide.png')
+        Image.new('RGB', (300, 300), 'green').save(path)
+        os.utime(path, (os.path.getmtime(path) + 10,) * 2)
+        render_variants(self.media_root, 'posts_pics/wide.png')
+        new = os.path.join(self.media_root, variant_name('posts_pics/wide.png', self.version('posts_pics/wide.png'), 'full', 'jpeg'))
+        with Image.open(new) as image:
+            self.assertEqual(image.size, (300, 300))
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'posts_pics', 'variants'))), 2 * len(VARIANTS) * len(FORMATS))
+
+    def test_post_payload_links_original_until_variants_exist(self):
+        user = User.objects.create_user(email='images@example.com', username='images', password='testpass')
+        author = UserProfile.objects.create(user=user)
+        post = Post.objects.create(author=author, image='posts_pics/wide.png')
+        self.client.force_authenticate(user=user)
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = self.client.get(reverse('posts-detail', args=[post.pk]))
+            self.assertTrue(response.data['image_variants']['thumbnail']['webp'].endswith('/media/posts_pics/wide.png'))
+            render_variants(self.media_root, 'posts_pics/wide.png')
+            response = self.client.get(reverse('posts-detail', args=[post.pk]))
+        self.assertTrue(response.data['image_variants']['thumbnail']['webp'].endswith(
+            '/media/' + variant_name('posts_pics/wide.png', self.version('posts_pics/wide.png'), 'thumbnail', 'webp')))
+
+
+class PostQueryCountTest(QueryCountMixin, APITestCase):
+    """Sizes are the posts of a friend of the reader."""
+
+    def populate(self, size):
+        User.objects.all().delete()
+        user = User.objects.create_user(email='reader@example.com', username='reader', password='testpass')
+        self.reader = UserProfile.objects.create(user=user)
+        friend = UserProfile.objects.create(
+            user=User.objects.create_user(email='friend@example.com', username='friend', password='testpass'))
+        self.reader.friends.add(friend)
+        for i in range(size):
+            self.post = Post.objects.create(author=friend, text_content=str(i))
+            TimelineEntry.objects.create(owner=self.reader, post=self.post)
+        self.client.force_authenticate(user=user)
+
+    def test_list(self):
+        self.assertSameQueries(1, lambda: self.client.get(reverse('posts-list')))
+        response = self.client.get(reverse('posts-list'))
+        self.assertEqual(response.data['results'][0]['author'], self.post.author_id)
+
+    def test_retrieve(self):
+        self.assertSameQueries(1, lambda: self.client.get(reverse('posts-detail', args=[self.post.pk])), results=None)
+
+    def test_by_author(self):
+        self.assertSameQueries(1, lambda: self.client.get(reverse('posts-by-author', args=[self.post.author_id])))
+
+    def test_feed(self):
+        self.assertSameQueries(3, lambda: self.client.get(reverse('posts-feed')))
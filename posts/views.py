@@ -1,17 +1,21 @@
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from account.authentication import CachedJWTAuthentication, get_request_profile
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from posts.api.serializers import PostSerializer
+from posts.api.paginators import PostPagination
 from posts.models import Post
+from posts.feed import followers_for_fan_out, fan_out, get_feed_page, mark_popular
 from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.parsers import JSONParser, FormParser, MultiPartParser
 from rest_framework import status
-from rest_framework.pagination import PageNumberPagination
-from account.models import UserProfile
+from django.db import transaction
+from SocNet.replicas import ReplicaReadMixin
 
-class PostViewSet(viewsets.ModelViewSet):
-    pagination_class = PageNumberPagination
-    authentication_classes = (JWTAuthentication, )
+class PostViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
+    pagination_class = PostPagination
+    authentication_classes = (CachedJWTAuthentication, )
     permission_classes = (IsAuthenticated, )
 
     parser_classes = (JSONParser, FormParser, MultiPartParser)
@@ -19,15 +23,35 @@ class PostViewSet(viewsets.ModelViewSet):
     queryset = Post.objects.all()
 
     def perform_create(self, serializer):
-        serializer.save(author=UserProfile.objects.get(user=self.request.user))
+        author = get_request_profile(self.request)
+        followers = followers_for_fan_out(author)
+        with transaction.atomic():
+            post = serializer.save(author=author, fanned_out=followers is not None)
+            if followers is None:
+                mark_popular(author)
+            elif followers:
+                fan_out(post, followers)
 
  
     @action(detail=False, methods=['get'])
     def by_author(self, request, user_id=None):
         if user_id is not None:
-            posts = self.queryset.filter(author__user__id=user_id)
+            posts = self.queryset.filter(author_id=user_id)
             page=self.paginate_queryset(posts)
             serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
         else: 
             return super().retrieve(request)
+
+    @action(detail=False, methods=['get'])
+    def feed(self, request):
+        before = request.query_params.get('before')
+        if before is not None and not before.isdigit():
+            return Response({'error': 'before must be a post id'}, status=status.HTTP_400_BAD_REQUEST)
+        profile = get_request_profile(request)
+        posts, next_before = get_feed_page(profile, before=int(before) if before else None, size=self.paginator.page_size)
+        next_url = None
+        if next_before is not None:
+            next_url = replace_query_param(request.build_absolute_uri(), 'before', next_before)
+        serializer = self.get_serializer(posts, many=True)
+        return Response({'next': next_url, 'results': serializer.data})